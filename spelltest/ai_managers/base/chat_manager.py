@@ -1,3 +1,4 @@
+import copy
 from abc import ABC, abstractmethod
 from typing import List
 from ...entities.managers import ConversationState, MessageType, Message
@@ -20,6 +21,35 @@ class ChatManagerBase(ABC):
         if not hasattr(self, "prompt_version_id"):
             raise TypeError(f"Instances of {self.__class__.__name__} must have a `prompt_version_id` attribute.")
 
+    def spawn(self, input_corpus_slot: int = None):
+        """
+        Manager for one simulation, created from this one as from a prototype.
+        Deep copies the manager by default, override it to share chains, templates and clients
+        and to create only the per-simulation state (see `_spawn_sharing_chains`).
+        Synthetic user managers get the slot of the simulation in the user input corpus.
+        """
+        return copy.deepcopy(self)
+
+    def _spawn_sharing_chains(self):
+        manager = copy.copy(self)
+        manager.chat_history = []
+        manager.state = ConversationState.CREATED
+        manager.cost_tracker_layer = None
+        return manager
+
+    def fork(self):
+        """
+        Manager which continues the current conversation independently of this one, a branch of a conversation tree.
+        Deep copies the manager by default, override it to share chains, templates and clients
+        and to copy only the conversation state (see `_fork_sharing_chains`).
+        """
+        return copy.deepcopy(self)
+
+    def _fork_sharing_chains(self):
+        manager = copy.copy(self)
+        manager.chat_history = list(self.chat_history)
+        return manager
+
     @abstractmethod
     def initialize_conversation(self):
         """
@@ -1,8 +1,16 @@
+import copy
 from abc import ABC, abstractmethod
 from ...entities.managers import EvaluationResult
 
 class EvaluationManagerBase(ABC):
 
+    def spawn(self):
+        """
+        Manager for one simulation, created from this one as from a prototype.
+        Deep copies the manager by default, override it to share chains, templates and clients.
+        """
+        return copy.deepcopy(self)
+
     def initialize_evaluation(self) -> None:
         pass
 
@@ -20,6 +28,19 @@ class EvaluationManagerBase(ABC):
         """
         pass
 
+    async def evaluate_chat_stream(self, message_queue, user_persona_manager, *args, **kwargs) -> EvaluationResult:
+        """
+        Evaluate a chat while it is being generated, messages come from `message_queue` until None.
+        Collects the whole chat and evaluates it with `evaluate_chat` by default,
+        override it to start evaluation before the conversation is over.
+        """
+        chat_history = []
+        message = await message_queue.get()
+        while message is not None:
+            chat_history.append(message)
+            message = await message_queue.get()
+        return await self.evaluate_chat(chat_history, user_persona_manager)
+
     @abstractmethod
     async def evaluate_raw_completion(self, *args, **kwargs) -> EvaluationResult:
         """
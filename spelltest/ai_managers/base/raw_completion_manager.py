@@ -1,3 +1,4 @@
+import copy
 from abc import ABC, abstractmethod
 from typing import Dict
 from ...entities.managers import ConversationState, MessageType, Message
@@ -11,6 +12,13 @@ class SyntheticUserRawCompletionManagerBase(ABC):
         if not hasattr(self, 'metrics'):
             raise TypeError(f"Instances of {self.__class__.__name__} must have a `metrics` attribute.")
 
+    def spawn(self, input_corpus_slot: int = None):
+        """
+        Manager for one simulation, created from this one as from a prototype, with the slot of the simulation
+        in the user input corpus. Deep copies the manager by default, override it to share chains, templates and clients.
+        """
+        return copy.deepcopy(self)
+
     @abstractmethod
     def generate_user_input(self) -> Dict:
         pass
@@ -29,6 +37,13 @@ class AIModelDefaultCompletionManagerBase(ABC):
         if not hasattr(self, "prompt_version_id"):
             raise TypeError(f"Instances of {self.__class__.__name__} must have a `prompt_version_id` attribute.")
 
+    def spawn(self):
+        """
+        Manager for one simulation, created from this one as from a prototype.
+        Deep copies the manager by default, override it to share chains, templates and clients.
+        """
+        return copy.deepcopy(self)
+
     @abstractmethod
     def generate_completion(self) -> Message:
         pass
\ No newline at end of file
@@ -1,14 +1,16 @@
+import asyncio
+import dataclasses
 import os
 from typing import List
 from uuid import uuid4
 from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferWindowMemory
 
 from .tracing.cost_calculation_tracing import CostCalculationTracer
-from .utils.chain import CustomConversationChain
+from .utils.chain import CustomConversationChain, CustomLLMChain
+from .utils.input_corpus import get_input_corpus, simulation_slot, InputKind
 from ..entities.synthetic_user import SyntheticUser
 from ..entities.managers import MessageType, ConversationState, Message
-from ..utils import load_prompt, extract_fields, prep_history
+from ..utils import load_prompt, extract_fields, prep_history, render_persona_prompt, RollingHistory
 from .base.chat_manager import ChatManagerBase
 from .tracing.promtelligence_tracing import PromptTemplate, PromptelligenceTracer
 
@@ -17,11 +19,13 @@ SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "http://spellforge.ai/")
 SPELLFORGE_API_KEY = os.environ.get("SPELLFORGE_API_KEY")
 
 class SyntheticUserChatManager(ChatManagerBase):
-    def __init__(self, user: SyntheticUser, openai_api_key):
+    def __init__(self, user: SyntheticUser, openai_api_key, history_window: int = RollingHistory.DEFAULT_WINDOW):
         self.user = user
         self.metrics = user.metrics
         self.openai_api_key = openai_api_key
         self.chat_id = str(uuid4())
+        self.history = RollingHistory(history_window)
+        self.input_corpus_slot = None   # slot of the simulation in the user input corpus, set on spawn
         system_pre_prompt = PromptTemplate(
             template=load_prompt("chat_manager/system.chat_user_agent.txt.jinja2"),
             template_format="jinja2",
@@ -31,10 +35,12 @@ class SyntheticUserChatManager(ChatManagerBase):
             ],
             alias="Synthetic user system prompt"
         )
-        system_prompt_text = system_pre_prompt.format_prompt(
+        system_prompt_text = render_persona_prompt(
+            self.user,
+            system_pre_prompt,
             APP_DESCRIPTION=self.user.params.description,
             USER_DESCRIPTION=self.user.params.user_knowledge_about_app
-        ).text
+        )
         self.system_prompt = PromptTemplate(
             template=system_prompt_text,
             input_variables=["history", "input"],
@@ -43,46 +49,87 @@ class SyntheticUserChatManager(ChatManagerBase):
         self.tracing_layer = PromptelligenceTracer(prompt=system_pre_prompt)
 
         llm = ChatOpenAI(openai_api_key=openai_api_key, model_name=self.user.params.llm_name)
-        self.chain = CustomConversationChain(llm=llm, prompt=self.system_prompt)
+        # conversation history comes from `self.history`, the chain itself is stateless and shared by spawned managers
+        self.chain = CustomLLMChain(llm=llm, prompt=self.system_prompt)
         super().__init__(role=MessageType.USER, opposite_role=MessageType.ASSISTANT)
 
+    def _append_message(self, message: Message):
+        self.chat_history.append(message)
+        self.history.append(message)
+
     async def initialize_conversation(self, app_welcome_message: Message) -> Message:
         self.set_cost_tracker_layer()
 
+        history = self.history.text()
         if app_welcome_message:
-            self.chat_history.append(app_welcome_message)
-        user_response = await self.chain.arun(
-                history=prep_history(self.chat_history),
-                input=app_welcome_message.text,
-                callbacks=[self.tracing_layer, self.cost_tracker_layer],
+            self._append_message(app_welcome_message)
+        input_corpus = get_input_corpus()
+        if input_corpus is not None and self.input_corpus_slot is not None:
+            key = input_corpus.make_key(self.user, InputKind.CHAT_FIRST_MESSAGE)
+            stored_message = await input_corpus.get_or_generate(
+                key,
+                self.input_corpus_slot,
+                lambda: self._generate_first_message(history, app_welcome_message),
             )
-        user_response_message = Message(
+            user_response_message = Message(
+                author=MessageType.USER,
+                text=stored_message["text"],
+                run_id=stored_message["run_id"]
+            )
+        else:
+            user_response_message = await self._generate_first_message(history, app_welcome_message)
+        self._append_message(user_response_message)
+        self.state = ConversationState.STARTED
+        return user_response_message
+
+    async def _generate_first_message(self, history: str, app_welcome_message: Message) -> Message:
+        user_response = await self.chain.arun(
+            history=history,
+            input=app_welcome_message.text,
+            callbacks=[self.tracing_layer, self.cost_tracker_layer],
+        )
+        return Message(
             author=MessageType.USER,
-            text=user_response["response"].split("> AI:")[0],
+            text=user_response[self.chain.output_key].split("> AI:")[0],
             run_id=str(user_response["__run"].run_id)
         )
-        self.chat_history.append(user_response_message)
-        self.state = ConversationState.STARTED
-        return user_response_message
 
     def set_cost_tracker_layer(self):
         self.cost_tracker_layer = CostCalculationTracer()
 
+    def spawn(self, input_corpus_slot: int = None):
+        manager = self._spawn_sharing_chains()
+        manager.chat_id = str(uuid4())
+        manager.history = RollingHistory(self.history.window)
+        manager.input_corpus_slot = simulation_slot(self.user, input_corpus_slot)
+        return manager
+
+    def fork(self):
+        manager = self._fork_sharing_chains()
+        manager.chat_id = str(uuid4())
+        manager.history = self.history.copy()
+        return manager
+
     async def next_message(self, app_message: Message = None, chat_history: List[Message] = None) -> Message:
-        if app_message and not chat_history:
-            self.chat_history.append(app_message)
+        if chat_history:
+            # conversation of someone else (e.g. perfect chat), own history stays untouched
+            history = prep_history(chat_history, self.history.window)
+        else:
+            history = self.history.text()
+            if app_message:
+                self._append_message(app_message)
         user_response = await self.chain.arun(
-            history=prep_history(self.chat_history if not chat_history else chat_history),
+            history=history,
             input=app_message.text,
             callbacks=[self.tracing_layer, self.cost_tracker_layer],
         )
         user_response_message = Message(
             author=MessageType.USER,
-            text=user_response["response"].split("> AI:")[0],
+            text=user_response[self.chain.output_key].split("> AI:")[0],
             run_id=str(user_response["__run"].run_id)
         )
         if not chat_history:
-            self.chat_history.append(user_response_message)
+            self._append_message(user_response_message)
         if "FINISHED" in user_response_message.text:
             user_response_message.text = user_response_message.text.replace("FINISHED", "")
             self.finish()
@@ -99,6 +146,39 @@ class SyntheticUserChatManager(ChatManagerBase):
         self.state = ConversationState.FINISHED
 
 
+class WelcomeMessagePool:
+    """
+    `size` app welcome messages, generated once and shared by all conversations of the same prompt.
+    The first conversation starts the generation, the others wait for it instead of sending their own request.
+    Conversations get the messages round-robin in the order they ask for them, so a replayed run
+    uses every message as often as the recorded run did.
+    """
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"Unexpected welcome message pool size: {size}")
+        self.size = size
+        self.messages = None
+        self._generation = None
+        self._requests = 0
+
+    async def get(self, generate_message) -> Message:
+        index = self._requests % self.size
+        self._requests += 1
+        if self.messages is None:
+            if self._generation is None:
+                self._generation = asyncio.ensure_future(
+                    asyncio.gather(*[generate_message() for _ in range(self.size)])
+                )
+            try:
+                # a cancelled conversation must not cancel the generation other conversations wait for
+                self.messages = await asyncio.shield(self._generation)
+            except Exception:
+                self._generation = None   # the next conversation tries again
+                raise
+        return dataclasses.replace(self.messages[index])
+
+
 class AIModelDefaultChatManager(ChatManagerBase):
     USER_PSEUDO_REQUEST_FOR_APP_WELCOME_MESSAGE = "Give me your welcome message"
     def __init__(self,
@@ -107,6 +187,8 @@ class AIModelDefaultChatManager(ChatManagerBase):
                  openai_api_key,
                  target_prompt_params={},
                  temperature=0.5,
+                 history_window: int = RollingHistory.DEFAULT_WINDOW,
+                 welcome_message_pool_size: int = None,
                  *args,
                  **kwargs
                  ):
@@ -115,10 +197,13 @@ class AIModelDefaultChatManager(ChatManagerBase):
             input_variables=extract_fields(target_prompt),
             alias="Customer prompt"
         )
-        self.prompt_version_id = self.target_prompt.promptelligence_params.db_version_id
         self.llm_name = llm_name
         self.openai_api_key = openai_api_key
         self.temperature = temperature
+        self.history = RollingHistory(history_window)
+        # shared by spawned managers, so the pool is generated once per prompt version
+        self.welcome_message_pool = WelcomeMessagePool(welcome_message_pool_size) \
+            if welcome_message_pool_size else None
         system_pre_prompt = PromptTemplate(
             template=load_prompt(
                 "chat_manager/system.chat_assistant.txt.jinja2"
@@ -138,12 +223,29 @@ class AIModelDefaultChatManager(ChatManagerBase):
         self.tracing_layer = PromptelligenceTracer(prompt=system_pre_prompt)
 
         llm = ChatOpenAI(openai_api_key=openai_api_key, model_name=llm_name, temperature=self.temperature)
-        self.chain = CustomConversationChain(
-            llm=llm,
-            memory=ConversationBufferWindowMemory(k=6)
-        )
+        # conversation history comes from `self.history`, the chain itself is stateless and shared by spawned managers
+        self.chain = CustomLLMChain(llm=llm, prompt=self.system_prompt)
         super().__init__(*args, **kwargs)
 
+    @property
+    def prompt_version_id(self):
+        # read on every access, a prompt created in `batch_prompt_registration` gets its version id later
+        return self.target_prompt.promptelligence_params.db_version_id
+
+    def spawn(self):
+        manager = self._spawn_sharing_chains()
+        manager.history = RollingHistory(self.history.window)
+        return manager
+
+    def fork(self):
+        manager = self._fork_sharing_chains()
+        manager.history = self.history.copy()
+        return manager
+
+    def _append_message(self, message: Message):
+        self.chat_history.append(message)
+        self.history.append(message)
+
     async def initialize_conversation(self):
         self.cost_tracker_layer = CostCalculationTracer()
         system_message = Message(
@@ -151,33 +253,40 @@ class AIModelDefaultChatManager(ChatManagerBase):
             text=self.system_prompt.template,
         )
         self.chat_history.append(system_message)
+        if self.welcome_message_pool:
+            app_message = await self.welcome_message_pool.get(self._generate_welcome_message)
+        else:
+            app_message = await self._generate_welcome_message()
+        self._append_message(app_message)
+        self.state = ConversationState.STARTED
+        return app_message
+
+    async def _generate_welcome_message(self) -> Message:
         app_response = await self.chain.arun(
-            history=prep_history(self.chat_history),
+            history="",
             input=self.USER_PSEUDO_REQUEST_FOR_APP_WELCOME_MESSAGE,
             callbacks=[self.tracing_layer, self.cost_tracker_layer],
         )
-        app_message = Message(
+        return Message(
             author=MessageType.ASSISTANT,
-            text=app_response["response"],
+            text=app_response[self.chain.output_key],
             run_id=str(app_response["__run"].run_id)
         )
-        self.chat_history.append(app_message)
-        self.state = ConversationState.STARTED
-        return app_message
 
     async def next_message(self, user_message: Message) -> Message:
-        self.chat_history.append(user_message)
+        history = self.history.text()
+        self._append_message(user_message)
         app_response = await self.chain.arun(
-            history=prep_history(self.chat_history),
+            history=history,
             input=user_message.text,
             callbacks=[self.tracing_layer, self.cost_tracker_layer],
         )
         app_message = Message(
             author=MessageType.ASSISTANT,
-            text=app_response["response"].split(">> Human:")[0],
+            text=app_response[self.chain.output_key].split(">> Human:")[0],
             run_id=str(app_response["__run"].run_id)
         )
-        self.chat_history.append(app_message)
+        self._append_message(app_message)
         # print(MessageType.ASSISTANT, ":\n")
         # print(app_response)
         # print(":\n")
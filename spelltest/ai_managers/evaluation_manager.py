@@ -1,13 +1,17 @@
+import copy
+import json
+import math
 import os
 import asyncio
 import openai
-from typing import List
+from typing import List, Dict
 from langchain import OpenAI, PromptTemplate as DefaultPromptTemplate
+from langchain.chat_models import ChatOpenAI
 
-from .tracing.cost_calculation_tracing import CostCalculationTracer
+from .tracing.cost_calculation_tracing import CostCalculationTracer, CostCalculationManager
 from ..utils import load_prompt, calculate_accuracy, \
-    calculate_deviation_factor, prep_history
-from .utils.chain import CustomConversationChain, CustomLLMChain
+    calculate_deviation_factor, prep_history, render_persona_prompt
+from .utils.chain import CustomLLMChain, CustomSamplingLLMChain
 from ..ai_managers.tracing.promtelligence_tracing import PromptTemplate as TracedPromptTemplate, PromptelligenceTracer
 from ..entities.managers import EvaluationResult, MessageType, Message, ConversationState
 from .base.evaluation_manager import EvaluationManagerBase
@@ -15,12 +19,16 @@ from .base.evaluation_manager import EvaluationManagerBase
 
 SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "http://spellforge.ai/")
 SPELLFORGE_API_KEY = os.environ.get("SPELLFORGE_API_KEY")
+CHAT_MODEL_PREFIXES = ("gpt-3.5-turbo", "gpt-4")
 
 
 class EvaluationManager(EvaluationManagerBase):
     ACCURACY_EVALUATION_SHOTS = 5
+    ACCURACY_EVALUATION_MIN_SHOTS = 2
+    ACCURACY_DEVIATION_TOLERANCE = 0.05   # shots within ~5 points of each other agree
     RATIONALE_SHOTS = 3
-    DEFAULT_SLEEP_TIME_IF_ERROR = 10
+    RATIONALE_MAX_TOKENS = 256     # OpenAI completion models default, multi-metric rationale gets it per metric
+    STREAM_WINDOW_MESSAGES = 4     # two exchanges of a chat
     def __init__(self,
                  openai_api_key,
                  synthetic_user_persona_manager,
@@ -29,6 +37,8 @@ class EvaluationManager(EvaluationManagerBase):
                  llm_name_perfect=None,
                  llm_name_rationale=None,
                  llm_name_accuracy=None,
+                 multi_metric_rationale=False,
+                 adaptive_accuracy: Dict = None,
                  ):
         self.metric_definitions = metric_definitions if metric_definitions else synthetic_user_persona_manager.metrics
         self.llm_name_perfect = llm_name_perfect if llm_name_perfect else llm_name_default
@@ -36,13 +46,40 @@ class EvaluationManager(EvaluationManagerBase):
         self.llm_name_accuracy = llm_name_accuracy if llm_name_accuracy else llm_name_default
         self.openai_api_key = openai_api_key
         self.synthetic_user_persona_manager = synthetic_user_persona_manager
-        self.perfect_chat_response_key = "response"
+        self.perfect_chat_response_key = "text"
+        # one rationale call for all metrics instead of one call (with the whole transcript) per metric
+        self.multi_metric_rationale = multi_metric_rationale
+        # sequential accuracy sampling: stop drawing shots as soon as they agree, see `_accuracy_with_shots`
+        self.adaptive_accuracy = adaptive_accuracy is not None
+        adaptive_accuracy = adaptive_accuracy or {}
+        self.accuracy_min_shots = adaptive_accuracy.get("min_shots", self.ACCURACY_EVALUATION_MIN_SHOTS)
+        self.accuracy_max_shots = adaptive_accuracy.get("max_shots", self.ACCURACY_EVALUATION_SHOTS)
+        self.accuracy_tolerance = adaptive_accuracy.get("tolerance", self.ACCURACY_DEVIATION_TOLERANCE)
+        if not 1 <= self.accuracy_min_shots <= self.accuracy_max_shots:
+            raise Exception("Adaptive accuracy expects 1 <= min_shots <= max_shots")
+        self.chains_initialized = False
+        self.failed_metrics: List[str] = []   # names of metrics whose last evaluation failed, see `_evaluate`
+
+    def spawn(self):
+        # chains are built once on the prototype and shared read-only by all its simulations
+        self.initialize_chains()
+        manager = copy.copy(self)
+        manager.cost_tracker_layer = None
+        manager.failed_metrics = []
+        return manager
 
     def initialize_evaluation(self):
+        """Per-simulation state, chains are reused if they are already built"""
         self.enable_cost_tracker_layer()
+        self.initialize_chains()
+
+    def initialize_chains(self):
+        if self.chains_initialized:
+            return
         self._init_perfect_chain()
         self._init_rationale_chain()
         self._init_accuracy_chain()
+        self.chains_initialized = True
 
     def _init_perfect_chain(self):
         perfect_llm = OpenAI(openai_api_key=self.openai_api_key,
@@ -55,13 +92,16 @@ class EvaluationManager(EvaluationManagerBase):
         )
         self.perfect_chat_tracing_layer = PromptelligenceTracer(prompt=perfect_chat_pre_prompt)
         self.perfect_chat_prompt = DefaultPromptTemplate(
-            template=perfect_chat_pre_prompt.format_prompt(
+            template=render_persona_prompt(
+                self.synthetic_user_persona_manager.user,
+                perfect_chat_pre_prompt,
                 USER_DESCRIPTION=self.synthetic_user_persona_manager.user.params.description,
                 USER_EXPECTATION=self.synthetic_user_persona_manager.user.params.expectation,
-            ).text,
+            ),
             input_variables=["history", "input"]
         )
-        self.perfect_chat_chain = CustomConversationChain(
+        # perfect chat history is passed with every call, the chain keeps no memory and is shared by spawned managers
+        self.perfect_chat_chain = CustomLLMChain(
             llm=perfect_llm,
             prompt=self.perfect_chat_prompt,
         )
@@ -73,10 +113,12 @@ class EvaluationManager(EvaluationManagerBase):
         )
         self.perfect_completion_tracing_layer = PromptelligenceTracer(prompt=perfect_completion_pre_prompt)
         self.perfect_completion_prompt = DefaultPromptTemplate(
-            template=perfect_completion_pre_prompt.format_prompt(
+            template=render_persona_prompt(
+                self.synthetic_user_persona_manager.user,
+                perfect_completion_pre_prompt,
                 USER_DESCRIPTION=self.synthetic_user_persona_manager.user.params.description,
                 USER_EXPECTATION=self.synthetic_user_persona_manager.user.params.expectation,
-            ).text,
+            ),
             input_variables=["prompt", "completion"]
         )
         self.perfect_completion_chain = CustomLLMChain(llm=perfect_llm, prompt=self.perfect_completion_prompt)
@@ -99,37 +141,142 @@ class EvaluationManager(EvaluationManagerBase):
         )
         self.rationale_tracing_layer = PromptelligenceTracer(prompt=self.rationale_prompt)
         self.rationale_chain = CustomLLMChain(llm=rationale_llm, prompt=self.rationale_prompt)
+        if self.multi_metric_rationale:
+            self._init_multi_metric_rationale_chain()
+
+    def _init_multi_metric_rationale_chain(self):
+        llm_kwargs = {}
+        if not (self.llm_name_rationale and self.llm_name_rationale.startswith(CHAT_MODEL_PREFIXES)):
+            # chat models have no completion length limit by default
+            llm_kwargs["max_tokens"] = self.RATIONALE_MAX_TOKENS * max(len(self.metric_definitions), 1)
+        multi_metric_rationale_llm = OpenAI(openai_api_key=self.openai_api_key,
+                                            model_name=self.llm_name_rationale,
+                                            **llm_kwargs)
+        self.multi_metric_rationale_prompt = TracedPromptTemplate(
+            template=load_prompt("evaluation/rationale_multi_metric.txt.jinja2"),
+            template_format="jinja2",
+            input_variables=[
+                "METRICS",
+                "USER_EXPECTATION",
+                "ENVIRONMENT_AWARENESS",
+                "REAL_RESULT",
+            ],
+            alias="Multi-metric rationale"
+        )
+        self.multi_metric_rationale_tracing_layer = PromptelligenceTracer(prompt=self.multi_metric_rationale_prompt)
+        self.multi_metric_rationale_chain = CustomLLMChain(llm=multi_metric_rationale_llm,
+                                                           prompt=self.multi_metric_rationale_prompt)
 
     def _init_accuracy_chain(self):
-        accuracy_llm = OpenAI(openai_api_key=self.openai_api_key,
-                               model_name=self.llm_name_rationale)
+        first_shots = self.accuracy_min_shots if self.adaptive_accuracy else self.ACCURACY_EVALUATION_SHOTS
+        accuracy_llm = self._init_sampling_llm(self.llm_name_accuracy, first_shots)
         self.accuracy_prompt = TracedPromptTemplate(
             template=load_prompt('evaluation/accuracy.txt.jinja2'),
             template_format="jinja2",
             input_variables=["ALL_SIMULATION_TEXT"],
             alias="Accuracy"
         )
-        self.accuracy_tracing_layer = PromptelligenceTracer(prompt=self.rationale_prompt)
-        self.accuracy_chain = CustomLLMChain(llm=accuracy_llm, prompt=self.accuracy_prompt)
+        self.accuracy_tracing_layer = PromptelligenceTracer(prompt=self.accuracy_prompt)
+        self.accuracy_chain = CustomSamplingLLMChain(llm=accuracy_llm, prompt=self.accuracy_prompt)
+        # adaptive accuracy draws the following shots in batches, one chain per batch size, see `_accuracy_batch_chain`
+        self.accuracy_batch_chains = {first_shots: self.accuracy_chain}
+
+    def _accuracy_batch_chain(self, shots):
+        """Sampling chain which returns `shots` accuracy evaluations in one request"""
+        if shots not in self.accuracy_batch_chains:
+            self.accuracy_batch_chains[shots] = CustomSamplingLLMChain(
+                llm=self._init_sampling_llm(self.llm_name_accuracy, shots),
+                prompt=self.accuracy_prompt,
+            )
+        return self.accuracy_batch_chains[shots]
+
+    def _init_sampling_llm(self, model_name, n):
+        """LLM which returns `n` samples in one request"""
+        if model_name and model_name.startswith(CHAT_MODEL_PREFIXES):
+            # OpenAI() wraps chat models into OpenAIChat, which reads only the first choice of the response.
+            # OpenAIChat sends no temperature, keep API default one
+            return ChatOpenAI(openai_api_key=self.openai_api_key, model_name=model_name, n=n, temperature=1.0)
+        return OpenAI(openai_api_key=self.openai_api_key, model_name=model_name, n=n, best_of=n)
 
     async def evaluate_chat(self, chat_history, user_persona_manager) -> List[EvaluationResult]:
-        # self.perfect_chat_history = await self._generate_perfect_chat(chat_history)
+        # self.perfect_chat_history = await self._generate_perfect_chat(chat_history, user_persona_manager)
         return await self._evaluate(chat_history)
 
+    async def evaluate_chat_stream(self, message_queue, user_persona_manager,
+                                   window_messages=STREAM_WINDOW_MESSAGES) -> List[EvaluationResult]:
+        """
+        Evaluate a chat while it is being generated, messages come from `message_queue` until None.
+        Rationales of every `window_messages` messages are requested as soon as the window is complete,
+        when the chat is over partial rationales of every metric are merged and only accuracy is left to sample.
+        """
+        if window_messages < 1:
+            raise ValueError(f"Unexpected evaluation window: {window_messages}")
+        chat_history, window, window_tasks = [], [], []
+        try:
+            while True:
+                message = await message_queue.get()
+                if message is not None:
+                    chat_history.append(message)
+                    window.append(message)
+                if window and (message is None or len(window) >= window_messages):
+                    window_tasks.append(asyncio.ensure_future(
+                        self._window_rationales(window, len(chat_history) - len(window) + 1)
+                    ))
+                    window = []
+                if message is None:
+                    break
+            window_rationales = await asyncio.gather(*window_tasks)
+        except BaseException:
+            for window_task in window_tasks:
+                window_task.cancel()
+            raise
+        rationales = {}
+        for metric_definition in self.metric_definitions:
+            partial_rationales = [
+                f"Messages {first}-{last}:\n{rationales_by_metric[metric_definition.name]}"
+                for first, last, rationales_by_metric in window_rationales
+                if metric_definition.name in rationales_by_metric
+            ]
+            if partial_rationales:
+                rationales[metric_definition.name] = "\n\n".join(partial_rationales)
+        return await self._evaluate(chat_history, rationales=rationales)
+
+    async def _window_rationales(self, window, first_message_number):
+        """Partial rationales of a window of chat messages by metric name, failed metrics are left out"""
+        rationales = {}
+        if self.multi_metric_rationale and len(self.metric_definitions) > 1:
+            rationales = await self._multi_metric_rationale(window)
+        missing_metric_definitions = [metric_definition for metric_definition in self.metric_definitions
+                                      if metric_definition.name not in rationales]
+        results = await asyncio.gather(
+            *[self._rationale(window, metric_definition) for metric_definition in missing_metric_definitions],
+            return_exceptions=True,
+        )
+        for metric_definition, result in zip(missing_metric_definitions, results):
+            if isinstance(result, Exception):
+                self._warn(f"Rationale of metric '{metric_definition.name}' for messages {first_message_number}-"
+                           f"{first_message_number + len(window) - 1} failed: {result!r}")
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            rationale_input, rationales[metric_definition.name] = result
+        return first_message_number, first_message_number + len(window) - 1, rationales
+
     async def evaluate_raw_completion(self, prompt, completion, user_persona_manager) -> List[EvaluationResult]:
         # self.perfect_completion = await self._generate_perfect_completion(prompt, completion)
         return await self._evaluate("USER:\n"+prompt.text+completion.text)
 
-    async def _generate_perfect_chat(self, chat_history: List[Message]) -> List[Message]:
+    async def _generate_perfect_chat(self, chat_history: List[Message], user_persona_manager) -> List[Message]:
+        # next user messages come from the user manager of the simulation, not from the shared one of the prototype
         re_ask_user_manager = False
         perfect_chat_history = []
         for message in chat_history[1:]:
             if message.author is MessageType.USER:
                 if re_ask_user_manager:
-                    new_user_message = await self.synthetic_user_persona_manager.next_message(new_message, perfect_chat_history)
+                    new_user_message = await user_persona_manager.next_message(new_message, perfect_chat_history)
                     perfect_chat_history.append(new_user_message)
                     re_ask_user_manager = False
-                    if self.synthetic_user_persona_manager.conversation_state() is ConversationState.FINISHED:
+                    if user_persona_manager.conversation_state() is ConversationState.FINISHED:
                         break
                 else:
                     perfect_chat_history.append(message)
@@ -167,50 +314,112 @@ class EvaluationManager(EvaluationManagerBase):
             run_id=str(response["__run"].run_id)
         )
 
-    async def _evaluate(self, chat_history):
-        evaluations = []
-        for metric_definition in self.metric_definitions:
-            evaluations.append(await self._evaluate_single(chat_history, metric_definition))
+    async def _evaluate(self, chat_history, rationales=None):
+        """
+        Evaluate all metrics concurrently (LLM calls are still limited by the concurrency controller of the run).
+        Every metric keeps its own backoff, a failed metric is left out and its name is recorded in `failed_metrics`,
+        the rest keep definition order.
+        In multi-metric rationale mode rationales of all metrics come from one call,
+        metrics without a parsed rationale fall back to their own rationale call.
+        `rationales` by metric name (e.g. merged rationales of a streamed chat) are used instead of requesting them.
+        """
+        if rationales is None:
+            rationales = {}
+            if self.multi_metric_rationale and len(self.metric_definitions) > 1:
+                rationales = await self._multi_metric_rationale(chat_history)
+        results = await asyncio.gather(
+            *[self._evaluate_single(chat_history, metric_definition, rationale=rationales[metric_definition.name])
+              if metric_definition.name in rationales else self._evaluate_single(chat_history, metric_definition)
+              for metric_definition in self.metric_definitions],
+            return_exceptions=True,
+        )
+        evaluations, self.failed_metrics = [], []
+        for metric_definition, result in zip(self.metric_definitions, results):
+            if isinstance(result, Exception):
+                self._warn(f"Evaluation of metric '{metric_definition.name}' failed: {result!r}")
+                self.failed_metrics.append(metric_definition.name)
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            evaluations.append(result)
         return evaluations
 
-    async def _evaluate_single(self, chat_history, metric_definition, sleep_time_if_error=DEFAULT_SLEEP_TIME_IF_ERROR):
-        try:
-            rationale_input, rationale_output = await self._rationale(chat_history,
-                                                                      metric_definition)
-            accuracy, accuracy_deviation = await self._accuracy(rationale_output)
-            return EvaluationResult(
-                metric=metric_definition,
-                accuracy=accuracy,
-                accuracy_deviation=accuracy_deviation,
-                rationale=rationale_output
-            )
-        except openai.error.RateLimitError:
-            # TODO: add log
-            print(f"openai.error.RateLimitError, {sleep_time_if_error=}")
-            if sleep_time_if_error is not None:
-                await asyncio.sleep(sleep_time_if_error)
-                return await self._evaluate_single(chat_history, metric_definition, sleep_time_if_error*2)
-            raise openai.error.RateLimitError
+    async def _evaluate_single(self, chat_history, metric_definition, rationale=None):
+        # rate limit errors are retried by the chains
+        if rationale is None:
+            rationale_input, rationale = await self._rationale(chat_history, metric_definition)
+        accuracy, accuracy_deviation, shots = await self._accuracy_with_shots(rationale)
+        return EvaluationResult(
+            metric=metric_definition,
+            accuracy=accuracy,
+            accuracy_deviation=accuracy_deviation,
+            rationale=rationale,
+            shots=shots,
+        )
 
     async def _accuracy(self, all_simulation_text):
-        tasks = []
-        for _ in range(self.ACCURACY_EVALUATION_SHOTS):
-            task = self.accuracy_chain.arun(
-                ALL_SIMULATION_TEXT=all_simulation_text,
-                callbacks=[
-                    self.accuracy_tracing_layer, self.cost_tracker_layer
-                ])
-            tasks.append(task)
+        accuracy, accuracy_deviation, shots = await self._accuracy_with_shots(all_simulation_text)
+        return accuracy, accuracy_deviation
 
+    async def _accuracy_with_shots(self, all_simulation_text):
+        """
+        Accuracy, its deviation and the number of drawn shots.
+        In adaptive mode `min_shots` are drawn first, then batches doubling the drawn shots
+        until the deviation of the scores is within the tolerance or `max_shots` are drawn.
+        Every request re-sends the whole transcript, so a batch costs about as much prompt as one shot:
+        doubling needs a logarithmic number of requests for at most twice the shots convergence needs.
+        """
+        if not self.adaptive_accuracy:
+            samples = await self._accuracy_shots(all_simulation_text, self.ACCURACY_EVALUATION_SHOTS)
+            quality_evaluations = self._parse_accuracy_shots(samples)
+        else:
+            samples = await self._accuracy_shots(all_simulation_text, self.accuracy_min_shots)
+            quality_evaluations = self._parse_accuracy_shots(samples)
+            while len(samples) < self.accuracy_max_shots and not self._accuracy_converged(quality_evaluations):
+                batch = min(len(samples), self.accuracy_max_shots - len(samples))
+                new_samples = await self._accuracy_shots(all_simulation_text, batch,
+                                                         chain=self._accuracy_batch_chain(batch))
+                if not new_samples:
+                    break
+                samples.extend(new_samples)
+                quality_evaluations.extend(self._parse_accuracy_shots(new_samples))
+        accuracy = calculate_accuracy(quality_evaluations)
+        accuracy_deviation = calculate_deviation_factor(quality_evaluations)
+        return accuracy, accuracy_deviation, len(samples)
+
+    def _accuracy_converged(self, quality_evaluations):
+        return len(quality_evaluations) >= self.accuracy_min_shots and \
+            calculate_deviation_factor(quality_evaluations) <= self.accuracy_tolerance
+
+    @staticmethod
+    def _parse_accuracy_shots(samples):
         quality_evaluations = []
-        for shot_accuracy in await asyncio.gather(*tasks):
+        for shot_accuracy in samples:
             try:
-                quality_evaluations.append(float(shot_accuracy["text"]))
+                quality_evaluations.append(float(shot_accuracy))
             except ValueError:
                 pass
-        accuracy = calculate_accuracy(quality_evaluations)
-        accuracy_deviation = calculate_deviation_factor(quality_evaluations)
-        return accuracy, accuracy_deviation
+        return quality_evaluations
+
+    async def _accuracy_shots(self, all_simulation_text, shots, chain=None):
+        """Sample `shots` accuracy evaluations, sampling chain returns all of them in one request"""
+        chain = chain or self.accuracy_chain
+
+        async def sample():
+            response = await chain.arun(
+                ALL_SIMULATION_TEXT=all_simulation_text,
+                callbacks=[
+                    self.accuracy_tracing_layer, self.cost_tracker_layer
+                ])
+            return response["text"] if isinstance(response["text"], list) else [response["text"]]
+
+        samples = await sample()
+        # LLMs which don't support `n` return fewer samples (usually one), ask for the rest the same way
+        if samples and len(samples) < shots:
+            requests = math.ceil((shots - len(samples)) / len(samples))
+            for missing_samples in await asyncio.gather(*[sample() for _ in range(requests)]):
+                samples.extend(missing_samples)
+        return samples[:shots]
 
     async def _rationale(self, chat_history, metric_definition):
         kwargs = dict(
@@ -229,16 +438,58 @@ class EvaluationManager(EvaluationManagerBase):
         )
         return input_text, rationale["text"]
 
+    async def _multi_metric_rationale(self, chat_history):
+        """
+        Rationales of all metrics from one call, the transcript is sent once.
+        Returns rationales by metric name, metrics which are missing in the response (or the whole response
+        if it is not JSON) are left out, so only they are evaluated with their own rationale call.
+        """
+        kwargs = dict(
+            METRICS=[{"name": metric_definition.name, "definition": metric_definition.definition}
+                     for metric_definition in self.metric_definitions],
+            USER_EXPECTATION=self.synthetic_user_persona_manager.user.params.expectation,
+            ENVIRONMENT_AWARENESS=self.synthetic_user_persona_manager.user.params.user_knowledge_about_app,
+            REAL_RESULT=chat_history,
+        )
+        try:
+            response = await self.multi_metric_rationale_chain.arun(
+                **kwargs,
+                callbacks=[
+                    self.multi_metric_rationale_tracing_layer, self.cost_tracker_layer
+                ],
+            )
+        except openai.error.OpenAIError as error:
+            self._warn(f"Multi-metric rationale failed, falling back to rationale per metric: {error!r}")
+            return {}
+        return self._parse_multi_metric_rationale(response["text"])
+
+    def _parse_multi_metric_rationale(self, text):
+        try:
+            # models like to wrap JSON into a markdown code block or to add a sentence around it
+            parsed = json.loads(text[text.index("{"):text.rindex("}") + 1])
+        except ValueError:
+            self._warn("Multi-metric rationale is not valid JSON, falling back to rationale per metric")
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+        rationales = {}
+        for metric_definition in self.metric_definitions:
+            rationale = parsed.get(metric_definition.name)
+            if isinstance(rationale, str) and rationale.strip():
+                rationales[metric_definition.name] = rationale
+            else:
+                self._warn(f"Multi-metric rationale has no rationale for metric '{metric_definition.name}', "
+                           f"falling back to rationale per metric")
+        return rationales
+
+    @staticmethod
+    def _warn(message):
+        # evaluations run while the live cost display is shown
+        CostCalculationManager().print(message, style="yellow", markup=False)
+
     def enable_cost_tracker_layer(self):
+        # only this manager is traced, user managers of simulations set their own tracer
         self.cost_tracker_layer = CostCalculationTracer()
-        try:
-            self.synthetic_user_persona_manager.set_cost_tracker_layer()
-        except:
-            pass
 
     def disable_cost_tracker_layer(self):
         self.cost_tracker_layer = None
-        try:
-            self.synthetic_user_persona_manager.cost_tracker_layer = None
-        except:
-            pass
\ No newline at end of file
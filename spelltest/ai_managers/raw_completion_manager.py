@@ -1,11 +1,15 @@
+import asyncio
+import copy
 import json
 import os
-from typing import Dict
+from collections import deque
+from typing import Dict, List
 from langchain import PromptTemplate as DefaultPromptTemplate
 from langchain.llms import OpenAI
 
 from .tracing.cost_calculation_tracing import CostCalculationTracer
 from .utils.chain import CustomLLMChain
+from .utils.input_corpus import get_input_corpus, simulation_slot, InputKind
 from ..entities.managers import Message, MessageType
 from .tracing.promtelligence_tracing import PromptTemplate, PromptelligenceTracer
 from .base.raw_completion_manager import SyntheticUserRawCompletionManagerBase, AIModelDefaultCompletionManagerBase
@@ -17,9 +21,38 @@ SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "https://spellforge.ai/")
 SPELLFORGE_API_KEY = os.environ.get("SPELLFORGE_API_KEY")
 
 
+class UserInputPool:
+    """
+    Synthetic user inputs generated in bulk and shared by all simulations of a persona.
+    Every simulation takes one input, the next batch is generated when the pool is empty
+    and simulations which need an input meanwhile wait for it instead of sending their own requests.
+    All inputs of a batch keep the run of the bulk call as `shared_run_id`, only the first one has it as `run_id`,
+    so the run is counted once among run ids of the simulations.
+    """
+
+    def __init__(self):
+        self.inputs = deque()
+        self._generation = None
+
+    async def get(self, generate_inputs) -> Message:
+        while not self.inputs:
+            if self._generation is None:
+                self._generation = asyncio.ensure_future(self._fill(generate_inputs))
+            # a cancelled simulation must not cancel the generation other simulations wait for
+            await asyncio.shield(self._generation)
+        return self.inputs.popleft()
+
+    async def _fill(self, generate_inputs):
+        try:
+            self.inputs.extend(await generate_inputs())
+        finally:
+            self._generation = None   # failed generation is retried by the next simulation
+
+
 class SyntheticUserCompletionManager(SyntheticUserRawCompletionManagerBase):
     USER_INPUT_ATTEMPTS = 3
-    def __init__(self, user: SyntheticUser, target_prompt, openai_api_key, *args, **kwargs):
+    def __init__(self, user: SyntheticUser, target_prompt, openai_api_key, bulk_user_inputs: int = None,
+                 *args, **kwargs):
         self.user = user
         self.metrics = user.metrics
         self.openai_api_key = openai_api_key
@@ -48,10 +81,44 @@ class SyntheticUserCompletionManager(SyntheticUserRawCompletionManagerBase):
             llm=llm,
             prompt=self.system_prompt,
         )
+        self.input_corpus_slot = None   # slot of the simulation in the user input corpus, set on spawn
+        # bulk mode: one call returns `bulk_user_inputs` inputs, shared by spawned managers through the pool
+        self.bulk_user_inputs = bulk_user_inputs
+        self.user_input_pool = None
+        if bulk_user_inputs:
+            if bulk_user_inputs < 1:
+                raise ValueError(f"Unexpected number of bulk user inputs: {bulk_user_inputs}")
+            self.user_input_pool = UserInputPool()
+            self.bulk_system_prompt = PromptTemplate(
+                template=load_prompt(
+                    "completion_manager/system.completion_user_agent_bulk.txt.jinja2"
+                ),
+                template_format="jinja2",
+                input_variables=["APP_DESCRIPTION", "USER_DESCRIPTION", "input_variables", "target_prompt", "COUNT"],
+                alias="Synthetic user bulk completion system prompt"
+            )
+            self.bulk_tracing_layer = PromptelligenceTracer(prompt=self.bulk_system_prompt)
+            self.bulk_chain = CustomLLMChain(
+                llm=llm,
+                prompt=self.bulk_system_prompt,
+            )
         super().__init__(*args, **kwargs)
 
     async def generate_user_input(self) -> Message:
         self.set_cost_tracker_layer()
+        input_corpus = get_input_corpus()
+        if input_corpus is not None and self.input_corpus_slot is not None:
+            key = input_corpus.make_key(self.user, InputKind.COMPLETION_INPUT, self._input_variables())
+            stored_input = await input_corpus.get_or_generate(key, self.input_corpus_slot, self._generate_new_user_input)
+            return Message(author=MessageType.USER, text=stored_input["text"], run_id=stored_input["run_id"])
+        return await self._generate_new_user_input()
+
+    async def _generate_new_user_input(self) -> Message:
+        if self.user_input_pool is not None:
+            return await self.user_input_pool.get(self._generate_user_inputs)
+        return await self._generate_user_input()
+
+    async def _generate_user_input(self) -> Message:
         for _ in range(self.USER_INPUT_ATTEMPTS):
             try:
                 if self.target_prompt.input_variables:
@@ -77,9 +144,67 @@ class SyntheticUserCompletionManager(SyntheticUserRawCompletionManagerBase):
                 print(str(json_error))
         raise Exception(f"Expected JSON format from LLM but got {response}")
 
+    async def _generate_user_inputs(self) -> List[Message]:
+        """
+        One batch of `bulk_user_inputs` inputs from one call.
+        Elements which are not an object with all input variables or repeat another element are generated one by one.
+        """
+        for _ in range(self.USER_INPUT_ATTEMPTS):
+            response = await self.bulk_chain.arun(
+                APP_DESCRIPTION=self.user.params.user_knowledge_about_app,
+                USER_DESCRIPTION=self.user.params.description,
+                input_variables=self._input_variables(),
+                target_prompt=self.target_prompt.template,
+                COUNT=self.bulk_user_inputs,
+                callbacks=[
+                    self.bulk_tracing_layer, self.cost_tracker_layer
+                ],
+            )
+            text = response["text"]
+            try:
+                # models like to wrap JSON into a markdown code block or to add a sentence around it
+                elements = json.loads(text[text.index("["):text.rindex("]") + 1])
+            except ValueError as error:
+                print(str(error))
+                continue
+            if isinstance(elements, list):
+                break
+        else:
+            raise Exception(f"Expected JSON array from LLM but got {response}")
+        bulk_run_id = str(response["__run"].run_id)
+        user_inputs = []
+        generated = set()
+        for element in elements[:self.bulk_user_inputs]:
+            text = json.dumps(element, sort_keys=True)
+            if self._is_valid_user_input(element) and text not in generated:
+                generated.add(text)
+                user_inputs.append(Message(
+                    author=MessageType.USER,
+                    text=text,
+                    run_id=None if user_inputs else bulk_run_id,
+                    shared_run_id=bulk_run_id,
+                ))
+        missing = self.bulk_user_inputs - len(user_inputs)
+        if missing:
+            print(f"{missing} of {self.bulk_user_inputs} bulk user inputs are missing or invalid, generating them one by one")
+            user_inputs.extend(await asyncio.gather(*[self._generate_user_input() for _ in range(missing)]))
+        return user_inputs
+
+    def _input_variables(self):
+        return self.target_prompt.input_variables if self.target_prompt.input_variables else ["USER_INPUT"]
+
+    def _is_valid_user_input(self, element) -> bool:
+        return isinstance(element, dict) and all(variable in element for variable in self._input_variables())
+
     def set_cost_tracker_layer(self):
         self.cost_tracker_layer = CostCalculationTracer()
 
+    def spawn(self, input_corpus_slot: int = None):
+        manager = copy.copy(self)
+        manager.cost_tracker_layer = None
+        manager.input_corpus_slot = simulation_slot(self.user, input_corpus_slot)
+        return manager
+
 
 class AIModelDefaultCompletionManager(AIModelDefaultCompletionManagerBase):
     def __init__(self, target_prompt, llm_name, openai_api_key, *args, **kwargs):
@@ -92,7 +217,6 @@ class AIModelDefaultCompletionManager(AIModelDefaultCompletionManagerBase):
                 input_variables=extract_fields(target_prompt),
                 alias="Customer prompt",
             )
-        self.prompt_version_id = self.target_prompt.promptelligence_params.db_version_id
         self.system_prompt = PromptTemplate(
             template=load_prompt(
                 "completion_manager/system.completion_assistant.txt.jinja2"
@@ -110,12 +234,25 @@ class AIModelDefaultCompletionManager(AIModelDefaultCompletionManagerBase):
         )
         super().__init__(*args, **kwargs)
 
+    @property
+    def prompt_version_id(self):
+        # read on every access, a prompt created in `batch_prompt_registration` gets its version id later
+        return self.target_prompt.promptelligence_params.db_version_id
+
+    def spawn(self):
+        manager = copy.copy(self)
+        manager.cost_tracker_layer = None
+        return manager
+
     async def generate_completion(self, input_variables: Dict) -> Message:
         self.cost_tracker_layer = CostCalculationTracer()
         if not self.target_prompt.input_variables and "USER_INPUT" in input_variables:
-            self.target_prompt.template = f"\n USER_INPUT:\n{input_variables.pop('USER_INPUT')}\nAI:"
+            # target prompt is shared by simulations, the user input is appended to its text instead of the template
+            system_prompt_text = f"{self.target_prompt.template}\n USER_INPUT:\n{input_variables['USER_INPUT']}\nAI:"
+        else:
+            system_prompt_text = self.target_prompt.format_prompt(**input_variables).text
         response = await self.chain.arun(
-            SYSTEM_PROMPT=self.target_prompt.format_prompt(**input_variables).text,
+            SYSTEM_PROMPT=system_prompt_text,
             callbacks=[
                 self.tracing_layer, self.cost_tracker_layer
             ],
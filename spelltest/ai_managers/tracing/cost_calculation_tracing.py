@@ -43,6 +43,10 @@ class CostCalculationManager:
     def update_cost(self):
         self.live.update(self._render())
 
+    def print(self, *objects, **kwargs):
+        """Print above the live cost display, a bare print would break it while it is running"""
+        self.live.console.print(*objects, **kwargs)
+
 
 class CostCalculationTracer(BaseCallbackHandler, ABC):
     """Tracing for each individual model."""
@@ -79,20 +83,21 @@ class CostCalculationTracer(BaseCallbackHandler, ABC):
         self, response: LLMResult, run_id, parent_run_id: Optional = None, **kwargs: Any
     ) -> None:
         """End a trace for an LLM run."""
+        if response.llm_output["token_usage"]:
+            # token usage covers all generations of the response (there are `n` of them when sampling)
+            model_name = response.llm_output["model_name"]
+            token_length = response.llm_output["token_usage"]["completion_tokens"]
+            self.cost_manager.cost_usd += self._calculate_cost_usd(model_name, token_length, "completion")
+            self.cost_manager.update_cost()
+            return
         for generation_group in response.generations:
             for generation in generation_group:
-                if not response.llm_output["token_usage"]:
-                    model_name = kwargs["invocation_params"]["model_name"]
-                    # TODO: validate this approach calculates tokens properly
-                    token_length = self._calculate_token_len(
-                        model_name=model_name,
-                        text=generation.text
-                    )
-                else:
-                    model_name = response.llm_output["model_name"]
-                    token_length = response.llm_output["token_usage"][
-                            "completion_tokens"
-                        ]
+                model_name = kwargs["invocation_params"]["model_name"]
+                # TODO: validate this approach calculates tokens properly
+                token_length = self._calculate_token_len(
+                    model_name=model_name,
+                    text=generation.text
+                )
                 self.cost_manager.cost_usd += self._calculate_cost_usd(model_name, token_length, "completion")
                 self.cost_manager.update_cost()
     def _calculate_token_len(self, model_name, text):
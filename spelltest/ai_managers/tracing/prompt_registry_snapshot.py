@@ -0,0 +1,63 @@
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Optional
+
+
+class PromptRegistrySnapshot:
+    """
+    Local copy of the prompt registry of a project (prompts with their latest versions),
+    so a client started within `max_age_seconds` after the last sync doesn't fetch the registry again.
+    The file is keyed by the backend URL, the project and its environment and carries a format version,
+    snapshots of another format are ignored.
+    """
+    FORMAT_VERSION = 1
+    DEFAULT_DIRECTORY = os.path.join(".spelltest_cache", "prompt_registry")
+    DEFAULT_MAX_AGE_SECONDS = 300
+
+    def __init__(self,
+                 base_url: str,
+                 project_name: str,
+                 environment: str,
+                 directory: str = DEFAULT_DIRECTORY,
+                 max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+                 ):
+        self.base_url = base_url
+        self.project_name = project_name
+        self.environment = environment
+        self.max_age_seconds = max_age_seconds
+        file_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{project_name}-{environment}") + ".json"
+        self.path = os.path.join(directory, file_name)
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Project id and prompts of a fresh snapshot, None if there is none"""
+        if self.max_age_seconds <= 0 or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("format_version") != self.FORMAT_VERSION or snapshot.get("base_url") != self.base_url:
+            return None
+        if time.time() - snapshot["saved_at"] > self.max_age_seconds:
+            return None
+        return snapshot
+
+    def save(self, project_id: int, prompts: Dict[str, Any]):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        snapshot = {
+            "format_version": self.FORMAT_VERSION,
+            "base_url": self.base_url,
+            "project_name": self.project_name,
+            "environment": self.environment,
+            "project_id": project_id,
+            "saved_at": time.time(),
+            "prompts": prompts,
+        }
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, ensure_ascii=False)
+        os.replace(temporary_path, self.path)
@@ -1,5 +1,7 @@
 import atexit
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 import requests
 import tiktoken
 import uuid
@@ -11,6 +13,11 @@ from langchain.prompts.base import DEFAULT_FORMATTER_MAPPING
 from langchain.schema import LLMResult
 from pydantic import BaseModel, Field
 
+from ...utils import render_jinja2_template
+from .usage_log_exporter import UsageLogExporter
+from .usage_log_spool import UsageLogSpool, SpoolUploader
+from .prompt_registry_snapshot import PromptRegistrySnapshot
+
 
 client = None   # TODO:  refactor this
 
@@ -67,6 +74,8 @@ class PromptTemplate(DefaultPromptTemplate):
     def format(self, **kwargs: Any) -> str:
         """Format the prompt with the inputs and log the usage to LangChainClient."""
         kwargs = self._merge_partial_and_user_variables(**kwargs)
+        if self.template_format == "jinja2":
+            return render_jinja2_template(self.template, **kwargs)
         formatted_prompt = DEFAULT_FORMATTER_MAPPING[self.template_format](
             self.template, **kwargs
         )
@@ -74,16 +83,38 @@ class PromptTemplate(DefaultPromptTemplate):
 
 
 class PromptelligenceClient:
+    PROMPT_VERSION_USAGE_LOGS_ENDPOINT = "/api/prompt-version-usage-logs/"
+    LLM_USAGE_LOGS_ENDPOINT = "/api/llm-usage-logs/"
+    EXPORT_REQUEST_TIMEOUT_SECONDS = 10.0
+    EXIT_DRAIN_TIMEOUT_SECONDS = 30.0   # logs not exported by then are lost, or stay in the spool
+
     def __init__(
         self,
         project: str = 'Default',
         api_key: str or None = None,
         environment: str or None = None,
         base_url: str = "http://127.0.0.1:8000",
-        ignore: bool = False
+        ignore: bool = False,
+        background_export: bool = True,
+        export_options: Dict = None,
+        spool: Dict = None,
+        registry_snapshot_max_age_seconds: float = PromptRegistrySnapshot.DEFAULT_MAX_AGE_SECONDS,
+        fetch_concurrency: int = 8,
     ):
+        """
+        With `background_export` usage logs are sent in batches by a background thread (see `UsageLogExporter`,
+        `export_options` are its parameters) and the `send_*_usage_log` methods don't return ids,
+        so `llm_usage_log_ids` is only set on LLM results when usage logs are sent synchronously.
+        With `spool` (parameters of `UsageLogSpool`) usage logs are appended to a local spool instead
+        and uploaded from it in background, logs which were not uploaded survive the run (`spelltest trace-upload`).
+        The prompt registry of the project is saved to a local snapshot after every sync, a client started
+        within `registry_snapshot_max_age_seconds` after that uses the snapshot instead of fetching the registry.
+        """
         self.project_name = project
         self.environment = environment
+        self.exporter = None
+        self.spool = None
+        self.spool_uploader = None
         if ignore:
             self.ignore_tracing = True
         else:
@@ -96,10 +127,37 @@ class PromptelligenceClient:
                 "Authorization": f"Api-Key {api_key}",
             }
             self._session = requests.Session()
+            # the exporter (or uploader) thread gets its own session, sessions are not thread-safe
+            self._export_session = requests.Session()
+            self._bulk_usage_logs = True   # False once the backend turned out not to support bulk usage logs
+            if spool is not None:
+                self.spool = UsageLogSpool(**spool)
+                self.spool_uploader = SpoolUploader(self.spool.directory, self._send_usage_log_batch, spool=self.spool)
+                self.spool_uploader.start()
+            elif background_export:
+                self.exporter = UsageLogExporter(self._send_usage_log_batch, **(export_options or {}))
             atexit.register(self._cleanup)
-            self._get_or_create_project()
+            self.fetch_concurrency = max(fetch_concurrency, 1)
             self.uploaded_prompts = {}
-            self._upload_prompts()
+            self._known_versions = {}     # (alias, template) -> version registered by this client or fetched
+            self._pending_versions = None  # versions waiting for registration, see `batch_registration`
+            self._fresh_aliases = set()    # prompts whose last version is known to be the latest one of the backend
+            self.registry_snapshot = PromptRegistrySnapshot(
+                base_url, project, environment if environment else "dev",
+                max_age_seconds=registry_snapshot_max_age_seconds,
+            )
+            snapshot = self.registry_snapshot.load()
+            if snapshot:
+                self.project_id = snapshot["project_id"]
+                self.uploaded_prompts = snapshot["prompts"]
+            else:
+                self._get_or_create_project()
+                self._upload_prompts()
+                self._save_snapshot()
+            for alias, uploaded_prompt in self.uploaded_prompts.items():
+                if uploaded_prompt.get("last_version"):
+                    self._known_versions[(alias, uploaded_prompt["last_version"].get("template_body"))] = \
+                        uploaded_prompt["last_version"]
 
         global client
         client = self
@@ -112,6 +170,23 @@ class PromptelligenceClient:
         else:
             self._sync_prompt(prompt)
 
+    @contextmanager
+    def batch_registration(self):
+        """
+        New versions of the prompts created inside are registered with one request on exit,
+        version ids of the prompts are set then. No prompt created inside may be used before that.
+        """
+        if self._pending_versions is not None:
+            yield   # nested, the outer one registers
+            return
+        self._pending_versions = []
+        try:
+            yield
+        finally:
+            pending_versions, self._pending_versions = self._pending_versions, None
+            if pending_versions:
+                self._register_prompt_versions(pending_versions)
+
     def delete_prompt(self, prompt: PromptTemplate):
         response = self._session.delete(
             self.base_url + f"/api/prompts/{prompt.promptelligence_params.db_id}/",
@@ -119,40 +194,126 @@ class PromptelligenceClient:
         )
         response.raise_for_status()
         del self.uploaded_prompts[prompt.alias]
+        self._save_snapshot()
 
     def send_prompt_version_usage_log(self, usage_log: PromptVersionUsageLog):
-        response = self._session.post(
-            self.base_url + "/api/prompt-version-usage-logs/",
-            json=usage_log.dict(),
-            headers=self.header,
-        )
-        response.raise_for_status()
-        return response.json()["id"]
+        return self._send_usage_log(self.PROMPT_VERSION_USAGE_LOGS_ENDPOINT, usage_log)
 
     def send_llm_usage_log(self, usage_log: LLMUsageLog):
+        return self._send_usage_log(self.LLM_USAGE_LOGS_ENDPOINT, usage_log)
+
+    @property
+    def returns_usage_log_ids(self) -> bool:
+        """Whether `send_*_usage_log` return ids, usage logs exported in background get them later"""
+        return not self.ignore_tracing and self.exporter is None and self.spool is None
+
+    def flush(self, timeout: float = None):
+        """Wait until the usage logs sent in background so far are exported"""
+        if self.exporter:
+            self.exporter.flush(timeout)
+        if self.spool_uploader:
+            self.spool_uploader.upload_pending(timeout)
+
+    def usage_log_stats(self) -> Optional[Dict[str, int]]:
+        """Usage logs exported in background so far by outcome, None unless they are exported in background"""
+        if not self.exporter:
+            return None
+        return {
+            "exported": self.exporter.exported,
+            "failed": self.exporter.failed,
+            "dropped": self.exporter.dropped,
+            "spilled": self.exporter.spilled,
+        }
+
+    def _send_usage_log(self, endpoint, usage_log: BaseModel):
+        if self.spool:
+            self.spool.append(endpoint, usage_log.dict())
+            return None
+        if self.exporter:
+            self.exporter.submit(endpoint, usage_log.dict())
+            return None
         response = self._session.post(
-            self.base_url + "/api/llm-usage-logs/",
+            self.base_url + endpoint,
             json=usage_log.dict(),
             headers=self.header,
+            timeout=self.EXPORT_REQUEST_TIMEOUT_SECONDS,
         )
         response.raise_for_status()
         return response.json()["id"]
 
+    def _send_usage_log_batch(self, endpoint, usage_logs: List[Dict]):
+        """Sends the logs with one request if the backend supports it, one by one otherwise"""
+        if self._bulk_usage_logs:
+            response = self._export_session.post(
+                self.base_url + endpoint + "bulk/",
+                json=usage_logs,
+                headers=self.header,
+                timeout=self.EXPORT_REQUEST_TIMEOUT_SECONDS,
+            )
+            if response.status_code not in (404, 405):
+                response.raise_for_status()
+                return
+            self._bulk_usage_logs = False
+        for usage_log in usage_logs:
+            response = self._export_session.post(
+                self.base_url + endpoint,
+                json=usage_log,
+                headers=self.header,
+                timeout=self.EXPORT_REQUEST_TIMEOUT_SECONDS,
+            )
+            response.raise_for_status()
+
     def _sync_prompt(self, prompt: PromptTemplate):
-        if not prompt.promptelligence_params.db_id:
+        assign_version = not prompt.promptelligence_params.db_id
+        if assign_version:
             prompt.promptelligence_params.db_id = self.uploaded_prompts[prompt.alias]["id"]
-            prompt.promptelligence_params.db_version_id = self.uploaded_prompts[
-                prompt.alias
-            ]["last_version"]["id"]
+        version = self.uploaded_prompts[prompt.alias]["last_version"]
         if self._is_prompt_changed(prompt):
-            self._register_new_prompt_version(prompt)
+            # e.g. prompts compared in one run, every one of them is registered once
+            version = self._known_versions.get((prompt.alias, prompt.template))
+            if version is None:
+                self._register_new_prompt_version(prompt)
+                return
+            assign_version = True
+        if assign_version:
+            self._assign_version(prompt, version)
 
     def _sync_with_parent_prompt(self, prompt):
         if not prompt.promptelligence_params.db_id:
             prompt.promptelligence_params.db_id = self.uploaded_prompts[prompt.parent_alias]["id"]
-            prompt.promptelligence_params.db_version_id = self.uploaded_prompts[
-                prompt.parent_alias
-            ]["last_version"]["id"]
+            self._assign_version(prompt, self.uploaded_prompts[prompt.parent_alias]["last_version"])
+
+    def _assign_version(self, prompt: PromptTemplate, version: Dict):
+        prompt.promptelligence_params.db_version_id = version["id"]
+        if version["id"] is None and self._pending_versions:
+            for pending_version in self._pending_versions:
+                if pending_version["record"] is version:
+                    pending_version["prompts"].append(prompt)
+
+    def _set_last_version(self, alias: str, version: Dict):
+        self.uploaded_prompts[alias]["last_version"] = version
+        self._known_versions[(alias, version.get("template_body"))] = version
+        self._fresh_aliases.add(alias)
+
+    def _refresh_last_version(self, alias: str) -> Dict:
+        """
+        Last version of the prompt, fetched again unless this client registered it or fetched it already:
+        the registry snapshot (or another process) may be behind the backend
+        """
+        if alias not in self._fresh_aliases:
+            response = self._session.get(
+                self.base_url + f"/api/prompt-versions/{self.uploaded_prompts[alias]['id']}/latest/",
+                headers=self.header,
+            )
+            if response.status_code != 404:
+                response.raise_for_status()
+                self._set_last_version(alias, response.json())
+            self._fresh_aliases.add(alias)
+        return self.uploaded_prompts[alias]["last_version"]
+
+    def _save_snapshot(self):
+        if not self._pending_versions:   # pending versions have no ids yet
+            self.registry_snapshot.save(self.project_id, self.uploaded_prompts)
 
     def _get_or_create_project(self):
         params = {
@@ -184,12 +345,35 @@ class PromptelligenceClient:
         )
         response.raise_for_status()
         prompts = response.json()
+        last_versions = self._get_last_prompt_versions([i["id"] for i in prompts])
         for i in prompts:
-            i["last_version"] = self._get_last_prompt_version(i["id"])
+            i["last_version"] = last_versions.get(i["id"])
             self.uploaded_prompts[i["alias"]] = i
 
-    def _get_last_prompt_version(self, prompt_id):
+    def _get_last_prompt_versions(self, prompt_ids):
+        """Latest versions of the prompts by prompt id, with one request if the backend supports it"""
+        if not prompt_ids:
+            return {}
         response = self._session.get(
+            self.base_url + "/api/prompt-versions/latest/",
+            params={"project_id": self.project_id},
+            headers=self.header,
+        )
+        if response.status_code not in (404, 405):
+            response.raise_for_status()
+            return {version["prompt_id"]: version for version in response.json()}
+        # no bulk endpoint, latest versions are fetched concurrently over a pooled session
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.fetch_concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+                last_versions = executor.map(lambda prompt_id: self._get_last_prompt_version(prompt_id, session),
+                                             prompt_ids)
+                return dict(zip(prompt_ids, last_versions))
+
+    def _get_last_prompt_version(self, prompt_id, session=None):
+        response = (session or self._session).get(
             self.base_url + f"/api/prompt-versions/{prompt_id}/latest/",
             headers=self.header,
         )
@@ -208,9 +392,11 @@ class PromptelligenceClient:
         if first_version:
             prompt.promptelligence_params.version = "v1"
         else:
-            uploaded_prompt_version = self.uploaded_prompts[prompt.alias][
-                "last_version"
-            ]
+            # the next version name is derived from the latest version, not from a possibly stale snapshot
+            uploaded_prompt_version = self._refresh_last_version(prompt.alias)
+            if uploaded_prompt_version.get("template_body") == prompt.template:
+                self._assign_version(prompt, uploaded_prompt_version)   # registered by another process meanwhile
+                return
             splitted_old_version = uploaded_prompt_version[
                 "version_or_git_commit"
             ].split("v")
@@ -225,6 +411,12 @@ class PromptelligenceClient:
         }
         if len(prompt.template) > 0:
             data["template_body"] = prompt.template
+        if self._pending_versions is not None:
+            version = {**data, "template_body": prompt.template, "id": None}   # the id is set on registration
+            self._pending_versions.append({"data": data, "record": version, "prompts": [prompt]})
+            self._set_last_version(prompt.alias, version)
+            prompt.promptelligence_params.db_version_id = None
+            return
         response = self._session.post(
             self.base_url + "/api/prompt-versions/", json=data, headers=self.header
         )
@@ -234,8 +426,34 @@ class PromptelligenceClient:
             print(str(e))
             raise e
         result = response.json()
-        self.uploaded_prompts[prompt.alias]["last_version"] = result
+        self._set_last_version(prompt.alias, result)
         prompt.promptelligence_params.db_version_id = result["id"]
+        self._save_snapshot()
+
+    def _register_prompt_versions(self, pending_versions):
+        """Registers the versions with one request if the backend supports it, one by one otherwise"""
+        response = self._session.post(
+            self.base_url + "/api/prompt-versions/bulk/",
+            json=[pending_version["data"] for pending_version in pending_versions],
+            headers=self.header,
+        )
+        if response.status_code not in (404, 405):
+            response.raise_for_status()
+            results = response.json()
+        else:
+            results = []
+            for pending_version in pending_versions:
+                response = self._session.post(
+                    self.base_url + "/api/prompt-versions/", json=pending_version["data"], headers=self.header
+                )
+                response.raise_for_status()
+                results.append(response.json())
+        for pending_version, result in zip(pending_versions, results):
+            # the record is shared by `uploaded_prompts` and the known versions
+            pending_version["record"].update(result)
+            for prompt in pending_version["prompts"]:
+                prompt.promptelligence_params.db_version_id = result["id"]
+        self._save_snapshot()
 
     def _register_new_prompt(self, prompt: PromptTemplate):
         data = {
@@ -256,15 +474,33 @@ class PromptelligenceClient:
         self._register_new_prompt_version(prompt, first_version=True)
 
     def _cleanup(self):
+        # logs of the run are sent before exit
+        if self.exporter and not self.exporter.close(self.EXIT_DRAIN_TIMEOUT_SECONDS):
+            print(f"Usage logs were not exported within {self.EXIT_DRAIN_TIMEOUT_SECONDS:.0f}s, the rest is dropped")
+        if self.spool_uploader:
+            self.spool_uploader.close(self.EXIT_DRAIN_TIMEOUT_SECONDS)
+            self.spool.close()
+        self._export_session.close()
         self._session.close()
 
 
+def batch_prompt_registration():
+    """`PromptelligenceClient.batch_registration` of the current client, nothing if tracing is off"""
+    if client is None or client.ignore_tracing:
+        return nullcontext()
+    return client.batch_registration()
+
+
 class PromptelligenceTracer(BaseCallbackHandler, ABC):
     """Base interface for tracers."""
 
     def __init__(self, prompt):
         self.prompt = prompt
-        self.prompt_version_id = prompt.promptelligence_params.db_version_id
+
+    @property
+    def prompt_version_id(self):
+        # read on every call, the version of a prompt created in `batch_registration` is registered later
+        return self.prompt.promptelligence_params.db_version_id
 
     def on_llm_start(
         self,
@@ -341,7 +577,8 @@ class PromptelligenceTracer(BaseCallbackHandler, ABC):
                     )
                 llm_usage_log_id = client.send_llm_usage_log(llm_usage_log)
                 llm_usage_log_ids.append(llm_usage_log_id)
-        response.Config.fields["llm_usage_log_ids"] = llm_usage_log_ids
+        if client.returns_usage_log_ids:
+            response.Config.fields["llm_usage_log_ids"] = llm_usage_log_ids
 
     def _calculate_token_len(self, model_name, text):
         tokenizer = tiktoken.encoding_for_model(model_name)
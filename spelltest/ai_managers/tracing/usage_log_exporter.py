@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from .usage_log_spool import UsageLogSpool
+
+
+class OverflowPolicy:
+    DROP_NEWEST = "drop_newest"   # logs submitted while the queue is full are dropped
+    DROP_OLDEST = "drop_oldest"   # the oldest queued log is dropped to make room for the new one
+    SPILL = "spill"               # logs submitted while the queue is full, or of failed batches, go to a spool
+
+
+class UsageLogExporter:
+    """
+    Exports usage logs from a background thread, so tracing callbacks never wait for the tracing backend.
+    Logs are kept in a bounded queue and sent by `send_batch(endpoint, logs)` in batches of at most `batch_size`
+    logs of the same endpoint, a batch is sent when it is full or `flush_interval_seconds` after its first log.
+    `overflow_policy` decides what happens to logs submitted while the queue is full.
+    A failed batch is counted as failed and dropped, with the SPILL policy it is spilled instead:
+    spilled logs are appended to a `UsageLogSpool` in `spill_directory`, `spelltest trace-upload` uploads them.
+    """
+    DEFAULT_QUEUE_SIZE = 10000
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_FLUSH_INTERVAL_SECONDS = 2.0
+
+    def __init__(self,
+                 send_batch: Callable[[str, List[Dict[str, Any]]], Any],
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval_seconds: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 overflow_policy: str = OverflowPolicy.DROP_NEWEST,
+                 spill_directory: str = UsageLogSpool.DEFAULT_DIRECTORY,
+                 ):
+        if overflow_policy not in (OverflowPolicy.DROP_NEWEST, OverflowPolicy.DROP_OLDEST, OverflowPolicy.SPILL):
+            raise ValueError(f"Unexpected usage log overflow policy: {overflow_policy}")
+        self.send_batch = send_batch
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+        self.spill_directory = spill_directory
+        self.exported = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        self.queue_size = max(queue_size, 1)
+        self._logs = deque()
+        self._condition = threading.Condition()
+        self._submitted = 0     # logs accepted into the queue
+        self._processed = 0     # accepted logs which were sent, failed or dropped from the queue
+        self._flush_requests = 0
+        self._spill_lock = threading.Lock()
+        self._spill_spool = None   # created with the first spilled log
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="spelltest-usage-log-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, endpoint: str, log: Dict[str, Any]) -> bool:
+        """Queue the log without waiting, returns False if it was dropped or spilled"""
+        with self._condition:
+            if self._closed:
+                raise Exception("Usage log exporter is closed")
+            if len(self._logs) < self.queue_size or self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                if len(self._logs) >= self.queue_size:
+                    self._logs.popleft()
+                    self.dropped += 1
+                    self._processed += 1
+                self._logs.append((endpoint, log))
+                self._submitted += 1
+                self._condition.notify_all()
+                return True
+        if self.overflow_policy == OverflowPolicy.SPILL:
+            self._spill(endpoint, log)
+        else:
+            self.dropped += 1
+        return False
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every log queued so far is sent, returns False on timeout"""
+        with self._condition:
+            target = self._submitted
+            self._flush_requests += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(lambda: self._processed >= target, timeout)
+            finally:
+                self._flush_requests -= 1
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """
+        Send the queued logs and stop the background thread, returns False if they were not sent within `timeout`
+        (the thread is a daemon, logs still queued at interpreter exit are lost)
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+        with self._spill_lock:
+            if self._spill_spool is not None:
+                self._spill_spool.close()
+                self._spill_spool = None
+        return True
+
+    def _run(self):
+        batches: Dict[str, List[Dict[str, Any]]] = {}
+        deadline = None
+        while True:
+            with self._condition:
+                while not self._logs and not self._closed and not (self._flush_requests and batches):
+                    if deadline is not None and time.monotonic() >= deadline:
+                        break
+                    self._condition.wait(None if deadline is None else deadline - time.monotonic())
+                item = self._logs.popleft() if self._logs else None
+                # queued logs are sent before a flush (or close) completes
+                flush = not self._logs and (self._flush_requests > 0 or self._closed)
+                closed = self._closed and not self._logs
+            if item is not None:
+                endpoint, log = item
+                batch = batches.setdefault(endpoint, [])
+                batch.append(log)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval_seconds
+                if len(batch) >= self.batch_size:
+                    self._send(endpoint, batches.pop(endpoint))
+            if flush or (deadline is not None and time.monotonic() >= deadline):
+                for endpoint in list(batches):
+                    self._send(endpoint, batches.pop(endpoint))
+            if not batches:
+                deadline = None
+            if closed and not batches:
+                return
+
+    def _send(self, endpoint, logs):
+        try:
+            self.send_batch(endpoint, logs)
+            self.exported += len(logs)
+        except Exception as e:
+            if self.overflow_policy == OverflowPolicy.SPILL:
+                for log in logs:
+                    self._spill(endpoint, log)
+                print(f"Failed to export {len(logs)} usage logs to {endpoint}, spilled to {self.spill_directory}: {e}")
+            else:
+                self.failed += len(logs)
+                print(f"Failed to export {len(logs)} usage logs to {endpoint}: {e}")
+        with self._condition:
+            self._processed += len(logs)
+            self._condition.notify_all()
+
+    def _spill(self, endpoint, log):
+        with self._spill_lock:
+            if self._spill_spool is None:
+                self._spill_spool = UsageLogSpool(self.spill_directory)
+            self._spill_spool.append(endpoint, log)
+            self.spilled += 1
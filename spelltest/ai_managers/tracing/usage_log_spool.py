@@ -0,0 +1,320 @@
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+
+class UsageLogSpool:
+    """
+    Write-ahead spool of usage logs: an append-only local file split into segments of at most `segment_max_bytes`,
+    so tracing costs a local append only and nothing is lost when the tracing backend is slow or down.
+    `SpoolUploader` drains the segments to the backend.
+    Every spool writes its own segments (named after its writer id) and holds a lock on its writer lock file
+    while it is open, so processes can share the directory and uploaders never delete a segment being written.
+    """
+    DEFAULT_DIRECTORY = os.path.join(".spelltest_cache", "usage_log_spool")
+    DEFAULT_SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".jsonl"
+    WRITER_LOCK_PREFIX = "writer-"
+    LOCK_SUFFIX = ".lock"
+
+    def __init__(self,
+                 directory: str = DEFAULT_DIRECTORY,
+                 segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES,
+                 fsync: bool = False,
+                 ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # a new run never appends to a segment of another run, which may end with a partial line of a crash
+        self.writer = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._segment_number = 1
+        self._file = None
+        # locked before it gets its name, an uploader never sees the lock file of a live writer unlocked
+        temporary_path = os.path.join(directory, f".{self.writer}{self.LOCK_SUFFIX}")
+        self._writer_lock_file = open(temporary_path, "a+")
+        try_lock(self._writer_lock_file)
+        os.replace(temporary_path, writer_lock_path(directory, self.writer))
+
+    @property
+    def active_segment(self) -> str:
+        return segment_name(self.writer, self._segment_number)
+
+    @property
+    def segment_path(self) -> str:
+        return os.path.join(self.directory, self.active_segment)
+
+    def append(self, endpoint: str, log: Dict[str, Any]):
+        line = json.dumps({"endpoint": endpoint, "log": log}, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.segment_path, "a", encoding="utf-8")
+            elif self._file.tell() >= self.segment_max_bytes:
+                self._file.close()
+                self._segment_number += 1
+                self._file = open(self.segment_path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._writer_lock_file is not None:
+                self._writer_lock_file.close()   # releases the lock
+                self._writer_lock_file = None
+
+
+def segment_name(writer: str, number: int) -> str:
+    return f"{UsageLogSpool.SEGMENT_PREFIX}{writer}-{number:08d}{UsageLogSpool.SEGMENT_SUFFIX}"
+
+
+def segment_writer(name: str) -> str:
+    return name[len(UsageLogSpool.SEGMENT_PREFIX):-len(UsageLogSpool.SEGMENT_SUFFIX)].rsplit("-", 1)[0]
+
+
+def segment_number(name: str) -> int:
+    return int(name[len(UsageLogSpool.SEGMENT_PREFIX):-len(UsageLogSpool.SEGMENT_SUFFIX)].rsplit("-", 1)[1])
+
+
+def writer_lock_path(directory: str, writer: str) -> str:
+    return os.path.join(directory, f"{UsageLogSpool.WRITER_LOCK_PREFIX}{writer}{UsageLogSpool.LOCK_SUFFIX}")
+
+
+def list_segments(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        (name for name in os.listdir(directory)
+         if name.startswith(UsageLogSpool.SEGMENT_PREFIX) and name.endswith(UsageLogSpool.SEGMENT_SUFFIX)),
+        key=lambda name: (segment_writer(name), segment_number(name)),
+    )
+
+
+def try_lock(file) -> bool:
+    """Take an exclusive lock on the open file without waiting, returns False if another file holds it"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def is_writer_alive(directory: str, writer: str) -> bool:
+    try:
+        with open(writer_lock_path(directory, writer), "a+") as file:
+            return not try_lock(file)   # closing the file releases the lock
+    except OSError:
+        return False
+
+
+class SpoolUploader:
+    """
+    Uploads spooled usage logs with `send_batch(endpoint, logs)` in batches of at most `batch_size` logs.
+    The position of the last uploaded log of every writer is stored in the offset file after every batch,
+    so an upload interrupted by a crash resumes where it stopped (the last batch may be sent twice).
+    Uploaded segments are deleted, except the last one of a writer which is still running.
+    Uploads of processes sharing the directory take turns on the upload lock file.
+    A failed batch stops the upload, the next one retries it.
+    """
+    OFFSET_FILE_NAME = "upload.offset"
+    UPLOAD_LOCK_FILE_NAME = "upload.lock"
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_INTERVAL_SECONDS = 2.0
+    DEFAULT_REQUEST_TIMEOUT_SECONDS = 30.0
+
+    def __init__(self,
+                 directory: str,
+                 send_batch: Callable[[str, List[Dict[str, Any]]], Any],
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 spool: Optional[UsageLogSpool] = None,
+                 ):
+        self.directory = directory
+        self.send_batch = send_batch
+        self.spool = spool
+        self.batch_size = max(batch_size, 1)
+        self.uploaded = 0
+        self.failed_batches = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def offset_path(self) -> str:
+        return os.path.join(self.directory, self.OFFSET_FILE_NAME)
+
+    def read_offsets(self) -> Dict[str, Dict[str, Any]]:
+        """Segment and offset of the last uploaded log of every writer"""
+        if not os.path.exists(self.offset_path):
+            return {}
+        with open(self.offset_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _write_offsets(self, offsets: Dict[str, Dict[str, Any]]):
+        temporary_path = self.offset_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(offsets, file)
+        os.replace(temporary_path, self.offset_path)   # atomic, a crash never leaves a broken offset file
+
+    def upload_pending(self, timeout: Optional[float] = None) -> int:
+        """
+        Upload everything spooled so far, returns the number of uploaded logs.
+        With `timeout` no new batch is sent after it, what is left stays in the spool.
+        Nothing is uploaded while another process is uploading from the directory.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._lock.acquire(timeout=-1 if timeout is None else max(timeout, 0)):
+            return 0
+        try:
+            if not os.path.isdir(self.directory):
+                return 0
+            with open(os.path.join(self.directory, self.UPLOAD_LOCK_FILE_NAME), "a+") as upload_lock_file:
+                if not try_lock(upload_lock_file):
+                    return 0
+                uploaded_before = self.uploaded
+                self._upload_writers(deadline)
+                return self.uploaded - uploaded_before
+        finally:
+            self._lock.release()
+
+    def _upload_writers(self, deadline):
+        offsets = self.read_offsets()
+        writers: Dict[str, List[str]] = {}
+        for segment in list_segments(self.directory):
+            writers.setdefault(segment_writer(segment), []).append(segment)
+        for name in os.listdir(self.directory):
+            if name.startswith(UsageLogSpool.WRITER_LOCK_PREFIX) and name.endswith(UsageLogSpool.LOCK_SUFFIX):
+                writers.setdefault(name[len(UsageLogSpool.WRITER_LOCK_PREFIX):-len(UsageLogSpool.LOCK_SUFFIX)], [])
+        for writer, segments in writers.items():
+            alive = (self.spool is not None and writer == self.spool.writer) or is_writer_alive(self.directory, writer)
+            # a running writer appends to its last segment only (listed before the check, it may rotate meanwhile)
+            active_segment = segments[-1] if alive and segments else None
+            if not self._upload_writer(writer, segments, active_segment, offsets, deadline):
+                return
+            if not alive:
+                offsets.pop(writer, None)
+                self._write_offsets(offsets)
+                if os.path.exists(writer_lock_path(self.directory, writer)):
+                    os.remove(writer_lock_path(self.directory, writer))
+
+    def _upload_writer(self, writer, segments, active_segment, offsets, deadline) -> bool:
+        offset = offsets.get(writer, {})
+        for segment in segments:
+            if offset and segment_number(segment) < segment_number(offset["segment"]):
+                os.remove(os.path.join(self.directory, segment))   # uploaded before a crash, not deleted yet
+                continue
+            start = offset["offset"] if offset and segment == offset["segment"] else 0
+            if not self._upload_segment(writer, segment, start, offsets, deadline):
+                return False
+            if segment != active_segment:
+                os.remove(os.path.join(self.directory, segment))
+        return True
+
+    def _upload_segment(self, writer, segment, start, offsets, deadline) -> bool:
+        with open(os.path.join(self.directory, segment), "rb") as file:
+            file.seek(start)
+            data = file.read()
+        endpoint, logs, end = None, [], start
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break   # the spool is writing the line right now (or crashed while writing it)
+            record = json.loads(line)
+            if logs and (record["endpoint"] != endpoint or len(logs) >= self.batch_size):
+                if not self._upload_batch(writer, segment, endpoint, logs, end, offsets, deadline):
+                    return False
+                logs = []
+            endpoint = record["endpoint"]
+            logs.append(record["log"])
+            end += len(line)
+        if logs:
+            return self._upload_batch(writer, segment, endpoint, logs, end, offsets, deadline)
+        offsets[writer] = {"segment": segment, "offset": end}
+        self._write_offsets(offsets)
+        return True
+
+    def _upload_batch(self, writer, segment, endpoint, logs, end, offsets, deadline) -> bool:
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        try:
+            self.send_batch(endpoint, logs)
+        except Exception as e:
+            self.failed_batches += 1
+            print(f"Failed to upload {len(logs)} spooled usage logs to {endpoint}, they stay in the spool: {e}")
+            return False
+        self.uploaded += len(logs)
+        offsets[writer] = {"segment": segment, "offset": end}
+        self._write_offsets(offsets)
+        return True
+
+    def start(self, interval_seconds: float = DEFAULT_INTERVAL_SECONDS):
+        """Drain the spool every `interval_seconds` in a background thread"""
+        def run():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    self.upload_pending()
+                except Exception as e:
+                    # e.g. an unreadable segment, the next round tries again
+                    print(f"Failed to upload spooled usage logs from {self.directory}: {e!r}")
+
+        self._thread = threading.Thread(target=run, name="spelltest-spool-uploader", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: Optional[float] = None):
+        """Stop the background thread and upload what is left, with `timeout` for at most that long"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.upload_pending(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+
+def upload_spool(directory: str = UsageLogSpool.DEFAULT_DIRECTORY,
+                 base_url: str = "http://127.0.0.1:8000",
+                 api_key: str = None,
+                 batch_size: int = SpoolUploader.DEFAULT_BATCH_SIZE,
+                 request_timeout_seconds: float = SpoolUploader.DEFAULT_REQUEST_TIMEOUT_SECONDS,
+                 ) -> int:
+    """
+    Upload pending segments of a spool (e.g. left by a crashed run or a run without connection to the backend),
+    returns the number of uploaded logs. The segment a running process is writing to is uploaded but kept.
+    """
+    if not api_key:
+        api_key = os.environ.get("PROMTELLIGENCE_API_KEY")
+    header = {
+        "Content-Type": "application/json",
+        "Authorization": f"Api-Key {api_key}",
+    }
+    with requests.Session() as session:
+        def send_batch(endpoint, logs):
+            response = session.post(base_url + endpoint + "bulk/", json=logs, headers=header,
+                                    timeout=request_timeout_seconds)
+            if response.status_code not in (404, 405):
+                response.raise_for_status()
+                return
+            # no bulk endpoint, the logs are sent one by one
+            for log in logs:
+                response = session.post(base_url + endpoint, json=log, headers=header, timeout=request_timeout_seconds)
+                response.raise_for_status()
+
+        return SpoolUploader(directory, send_batch, batch_size=batch_size).upload_pending()
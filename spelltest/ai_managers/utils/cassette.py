@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+from collections import defaultdict, deque
+from typing import Any, Dict, List
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManager
+from langchain.schema import LLMResult, Generation
+
+
+cassette = None   # cassette of the current run, see `set_cassette`
+
+
+def get_cassette():
+    return cassette
+
+
+def set_cassette(new_cassette):
+    global cassette
+    cassette = new_cassette
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+class CassetteMode:
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+class LLMCallRecorder(BaseCallbackHandler):
+    """Collects what LLM callbacks receive during one chain call, so that replay can fire them again"""
+    run_inline = True
+
+    def __init__(self):
+        self.llm_runs = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs: Any) -> None:
+        self.llm_runs[run_id] = {
+            "prompts": prompts,
+            "invocation_params": kwargs.get("invocation_params", {}),
+        }
+
+    def on_llm_end(self, response: LLMResult, *, run_id, parent_run_id=None, **kwargs: Any) -> None:
+        self.llm_runs[run_id]["generations"] = [
+            [{"text": generation.text, "generation_info": generation.generation_info} for generation in generations]
+            for generations in response.generations
+        ]
+        self.llm_runs[run_id]["llm_output"] = response.llm_output
+
+    def recorded_llm_runs(self) -> List[Dict[str, Any]]:
+        return [llm_run for llm_run in self.llm_runs.values() if "generations" in llm_run]
+
+
+class LLMCassette:
+    """
+    JSON lines file with every LLM request/response pair of a run.
+    Record mode starts the file anew, every chain call is appended to it as soon as it finishes.
+    In replay mode responses (and run ids) are served from the file in the recorded order,
+    LLM callbacks (cost calculation, tracing) are fired with the recorded data and no request is sent.
+    """
+
+    def __init__(self, path: str, mode: str):
+        if mode not in (CassetteMode.RECORD, CassetteMode.REPLAY):
+            raise ValueError(f"Unexpected cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._recorded = defaultdict(deque)
+        if self.replaying:
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._recorded[record["key"]].append(record)
+            self._file = None
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # records of a previous run would be replayed before the new ones of the same requests
+            self._file = open(path, "w", encoding="utf-8")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == CassetteMode.REPLAY
+
+    @staticmethod
+    def make_key(llm_name: str, invocation_params: Dict[str, Any], prompt: str) -> str:
+        request = json.dumps(
+            {"llm_name": llm_name, "invocation_params": invocation_params, "prompt": prompt},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def record(self, key: str, llm_name: str, prompt: str, outputs: Dict[str, Any], run_id: str,
+               recorder: LLMCallRecorder):
+        record = {
+            "key": key,
+            "llm_name": llm_name,
+            "prompt": prompt,
+            "outputs": outputs,
+            "run_id": run_id,
+            "llm_runs": recorder.recorded_llm_runs(),
+        }
+        self._file.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+        self._file.flush()
+
+    def replay(self, key: str, prompt: str) -> Dict[str, Any]:
+        if not self._recorded[key]:
+            raise CassetteMissError(f"There is no recorded response in '{self.path}' for prompt:\n{prompt}")
+        return self._recorded[key].popleft()
+
+    @staticmethod
+    async def replay_callbacks(record: Dict[str, Any], callbacks):
+        handlers = [handler for handler in callbacks or [] if handler is not None]
+        if not handlers:
+            return
+        callback_manager = AsyncCallbackManager(handlers=handlers, parent_run_id=UUID(record["run_id"]))
+        for llm_run in record["llm_runs"]:
+            run_managers = await callback_manager.on_llm_start(
+                {"name": record["llm_name"]},
+                llm_run["prompts"],
+                invocation_params=llm_run["invocation_params"],
+            )
+            generations = [[Generation(**generation) for generation in generation_group]
+                           for generation_group in llm_run["generations"]]
+            for run_manager in run_managers:
+                await run_manager.on_llm_end(LLMResult(
+                    generations=generations,
+                    llm_output=json.loads(json.dumps(llm_run["llm_output"])),   # callbacks may modify it
+                ))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
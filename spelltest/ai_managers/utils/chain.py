@@ -1,11 +1,28 @@
 import asyncio
-from typing import Any, Optional, List, Dict, Union
+import contextlib
+from typing import Any, Optional, List, Dict
+from uuid import uuid4, UUID
 
 import openai
-from langchain.callbacks.manager import Callbacks, AsyncCallbackManager, AsyncCallbackManagerForChainRun
+from langchain.callbacks.manager import Callbacks
 from langchain.chains import ConversationChain, LLMChain
+from langchain.schema import RUN_KEY, RunInfo, LLMResult
+
+from .cassette import get_cassette, LLMCallRecorder
+from .concurrency import get_concurrency_controller, get_retry_after
+from .llm_cache import get_llm_cache
+from .rate_limit import get_rate_limiter
+
+
+class RateLimitedChainMixin:
+    """
+    `arun` which returns all chain outputs (with run info) and waits and repeats the call on `RateLimitError`.
+    Every call is recorded to (or replayed from) the cassette, served from the LLM cache, throttled by
+    the rate limiter and sent through the concurrency controller of the current run, if there are ones.
+    """
+    RATE_LIMIT_SLEEP_TIME = 1
+    MAX_RATE_LIMIT_SLEEP_TIME = 60
 
-class CustomConversationChain(ConversationChain):
     async def arun(
         self,
         *args: Any,
@@ -14,81 +31,116 @@ class CustomConversationChain(ConversationChain):
         metadata: Optional[Dict[str, Any]] = None,
         **kwargs: Any,
     ) -> Dict[str, Any]:
-        try:
-            if len(self.output_keys) != 1:
-                raise ValueError(
-                    f"`run` not supported when there is not exactly "
-                    f"one output key. Got {self.output_keys}."
-                )
-            elif args and not kwargs:
-                if len(args) != 1:
-                    raise ValueError("`run` supports only one positional argument.")
-                return await self.acall(
-                        args[0], callbacks=callbacks, tags=tags, metadata=metadata, include_run_info=True
-                    )
-            if kwargs and not args:
-                return await self.acall(
-                        kwargs, callbacks=callbacks, tags=tags, metadata=metadata, include_run_info=True
-                    )
+        if len(self.output_keys) != 1:
             raise ValueError(
-                f"`run` supported with either positional arguments or keyword arguments"
-                f" but not both. Got args: {args} and kwargs: {kwargs}."
+                f"`run` not supported when there is not exactly "
+                f"one output key. Got {self.output_keys}."
             )
-        except openai.error.RateLimitError as e:
-            print(str(e))
-            wait_and_repeat_if_limit = kwargs.get("wait_and_repeat_if_limit", 1)
-            if wait_and_repeat_if_limit:
-                await asyncio.sleep(wait_and_repeat_if_limit)
-                kwargs["wait_and_repeat_if_limit"] = wait_and_repeat_if_limit * 2
-                return await self.arun(
-                    *args,
-                    callbacks=callbacks,
-                    tags=tags,
-                    metadata=metadata,
-                    **kwargs
-                )
-            raise openai.error.RateLimitError
-
-class CustomLLMChain(LLMChain):
-    async def arun(
-        self,
-        *args: Any,
-        callbacks: Callbacks = None,
-        tags: Optional[List[str]] = None,
-        metadata: Optional[Dict[str, Any]] = None,
-        **kwargs: Any,
-    ) -> Dict[str, Any]:
-        try:
-            if len(self.output_keys) != 1:
-                raise ValueError(
-                    f"`run` not supported when there is not exactly "
-                    f"one output key. Got {self.output_keys}."
-                )
-            elif args and not kwargs:
-                if len(args) != 1:
-                    raise ValueError("`run` supports only one positional argument.")
-                return await self.acall(
-                        args[0], callbacks=callbacks, tags=tags, metadata=metadata, include_run_info=True
-                    )
-            if kwargs and not args:
-                return await self.acall(
-                        kwargs, callbacks=callbacks, tags=tags, metadata=metadata, include_run_info=True
-                    )
+        elif args and not kwargs:
+            if len(args) != 1:
+                raise ValueError("`run` supports only one positional argument.")
+            inputs = args[0]
+        elif kwargs and not args:
+            inputs = kwargs
+        else:
             raise ValueError(
                 f"`run` supported with either positional arguments or keyword arguments"
                 f" but not both. Got args: {args} and kwargs: {kwargs}."
             )
-        except openai.error.RateLimitError as e:
-            print(str(e))
-            wait_and_repeat_if_limit = kwargs.get("wait_and_repeat_if_limit", 1)
-            if wait_and_repeat_if_limit:
-                await asyncio.sleep(wait_and_repeat_if_limit)
-                kwargs["wait_and_repeat_if_limit"] = wait_and_repeat_if_limit * 2
-                return await self.arun(
-                    *args,
-                    callbacks=callbacks,
-                    tags=tags,
-                    metadata=metadata,
-                    **kwargs
-                )
-            raise openai.error.RateLimitError
\ No newline at end of file
+        return await self._acall_with_cassette(inputs, callbacks=callbacks, tags=tags, metadata=metadata)
+
+    async def _acall_with_cassette(self, inputs, callbacks=None, tags=None, metadata=None) -> Dict[str, Any]:
+        cassette = get_cassette()
+        if cassette is None:
+            return await self._acall_with_cache(inputs, callbacks=callbacks, tags=tags, metadata=metadata)
+        inputs = self.prep_inputs(inputs)
+        prompt_text = self.format_prompt_text(inputs)
+        key = cassette.make_key(self.llm_name, self.llm_params, prompt_text)
+        if cassette.replaying:
+            record = cassette.replay(key, prompt_text)
+            await cassette.replay_callbacks(record, callbacks)
+            return self._stored_outputs(inputs, record["outputs"], UUID(record["run_id"]))
+        recorder = LLMCallRecorder()
+        outputs = await self._acall_with_cache(
+            inputs, callbacks=list(callbacks or []) + [recorder], tags=tags, metadata=metadata
+        )
+        cassette.record(
+            key,
+            llm_name=self.llm_name,
+            prompt=prompt_text,
+            outputs={output_key: outputs[output_key] for output_key in self.output_keys},
+            run_id=str(outputs[RUN_KEY].run_id),
+            recorder=recorder,
+        )
+        return outputs
+
+    async def _acall_with_cache(self, inputs, callbacks=None, tags=None, metadata=None) -> Dict[str, Any]:
+        llm_cache = get_llm_cache()
+        if llm_cache is None:
+            return await self._acall_with_retry(inputs, callbacks=callbacks, tags=tags, metadata=metadata)
+        inputs = self.prep_inputs(inputs)
+        key = llm_cache.make_key(self.llm_name, self.llm_params, self.format_prompt_text(inputs))
+        cached_outputs = llm_cache.get(key)
+        if cached_outputs is not None:
+            return self._stored_outputs(inputs, cached_outputs, uuid4())
+        outputs = await self._acall_with_retry(inputs, callbacks=callbacks, tags=tags, metadata=metadata)
+        llm_cache.set(key, {output_key: outputs[output_key] for output_key in self.output_keys})
+        return outputs
+
+    async def _acall_with_retry(self, inputs, callbacks=None, tags=None, metadata=None) -> Dict[str, Any]:
+        sleep_time = self.RATE_LIMIT_SLEEP_TIME
+        while True:
+            rate_limiter = get_rate_limiter()
+            if rate_limiter and rate_limiter.is_limited(self.llm_name):
+                await rate_limiter.acquire(self.llm_name, self.format_prompt_text(inputs))
+            controller = get_concurrency_controller()
+            try:
+                async with controller.slot() if controller else contextlib.nullcontext():
+                    return await self.acall(
+                        inputs, callbacks=callbacks, tags=tags, metadata=metadata, include_run_info=True
+                    )
+            except openai.error.RateLimitError as e:
+                print(str(e))
+                retry_after = get_retry_after(e)
+                await asyncio.sleep(retry_after if retry_after else sleep_time)
+                sleep_time = min(sleep_time * 2, self.MAX_RATE_LIMIT_SLEEP_TIME)
+
+    def _stored_outputs(self, inputs, outputs, run_id) -> Dict[str, Any]:
+        """Chain outputs built from previously stored outputs, the same way `acall` builds them"""
+        final_outputs = self.prep_outputs(inputs, outputs)   # saves the exchange into memory as well
+        final_outputs[RUN_KEY] = RunInfo(run_id=run_id)
+        return final_outputs
+
+    @property
+    def llm_name(self) -> Optional[str]:
+        return getattr(self.llm, "model_name", None)
+
+    @property
+    def llm_params(self) -> Dict[str, Any]:
+        return {**getattr(self.llm, "_identifying_params", {}), **self.llm_kwargs}
+
+    def format_prompt_text(self, inputs) -> str:
+        """Prompt which is sent to LLM for the given inputs (including ones added by memory)"""
+        inputs = self.prep_inputs(inputs)
+        return self.prompt.format_prompt(**{key: inputs[key] for key in self.prompt.input_variables}).to_string()
+
+
+class CustomConversationChain(RateLimitedChainMixin, ConversationChain):
+    pass
+
+
+class CustomLLMChain(RateLimitedChainMixin, LLMChain):
+    pass
+
+
+class CustomSamplingLLMChain(CustomLLMChain):
+    """
+    LLM chain which output is the list of all samples LLM returned for the prompt.
+    Use it with LLM configured to return `n` samples per request, so prompt is sent and billed once.
+    """
+
+    def create_outputs(self, llm_result: LLMResult) -> List[Dict[str, Any]]:
+        return [
+            {self.output_key: [generation.text for generation in generations]}
+            for generations in llm_result.generations
+        ]
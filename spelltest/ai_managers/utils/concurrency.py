@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+
+import openai
+
+
+controller = None   # controller of the current run, see `set_concurrency_controller`
+
+
+def get_concurrency_controller():
+    return controller
+
+
+def set_concurrency_controller(new_controller):
+    global controller
+    controller = new_controller
+
+
+def get_retry_after(error: openai.error.OpenAIError):
+    """Return `Retry-After` of the OpenAI error in seconds, or None if the header is missing"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD (additive increase, multiplicative decrease) limit of in-flight LLM calls.
+    Every successful call grows the limit by `increase_step / limit` (so roughly +`increase_step` per
+    `limit` calls), every rate limit error cuts it by `decrease_factor`. A `Retry-After` pauses all new calls.
+    """
+    DEFAULT_MIN_CONCURRENCY = 1
+    DEFAULT_MAX_CONCURRENCY = 64
+    DEFAULT_INCREASE_STEP = 1.0
+    DEFAULT_DECREASE_FACTOR = 0.5
+    DECREASE_COOLDOWN = 1.0  # seconds, rate limit errors of calls sent before the last decrease are ignored
+
+    def __init__(self,
+                 initial_concurrency=None,
+                 min_concurrency=DEFAULT_MIN_CONCURRENCY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 increase_step=DEFAULT_INCREASE_STEP,
+                 decrease_factor=DEFAULT_DECREASE_FACTOR,
+                 ):
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise ValueError(f"Expected 1 <= min_concurrency <= max_concurrency, "
+                             f"got {min_concurrency=}, {max_concurrency=}")
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        initial_concurrency = initial_concurrency if initial_concurrency else min_concurrency
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.in_flight = 0
+        self.peak_concurrency = 0
+        self.successes = 0
+        self.rate_limit_errors = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters = deque()
+
+    @property
+    def concurrency(self) -> int:
+        return int(self.limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one in-flight LLM call, feeding the outcome of the call back into the controller"""
+        await self.acquire()
+        try:
+            yield
+        except openai.error.RateLimitError as e:
+            self.on_rate_limit(get_retry_after(e))
+            raise
+        else:
+            self.on_success()
+        finally:
+            self.release()
+
+    async def acquire(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.in_flight < self.concurrency:
+                self.in_flight += 1
+                self.peak_concurrency = max(self.peak_concurrency, self.in_flight)
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake_up_waiters()
+
+    def on_success(self):
+        self.successes += 1
+        self.limit = min(self.max_concurrency, self.limit + self.increase_step / self.limit)
+        self._wake_up_waiters()
+
+    def on_rate_limit(self, retry_after=None):
+        self.rate_limit_errors += 1
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        # calls which were already in flight fail together, count them as one congestion signal
+        if now - self._last_decrease >= self.DECREASE_COOLDOWN:
+            self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+            self._last_decrease = now
+
+    def _wake_up_waiters(self):
+        free_slots = self.concurrency - self.in_flight
+        while free_slots > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+
+input_corpus = None   # synthetic user input corpus of the current run, see `set_input_corpus`
+
+
+def get_input_corpus():
+    return input_corpus
+
+
+def set_input_corpus(new_input_corpus):
+    global input_corpus
+    input_corpus = new_input_corpus
+
+
+def simulation_slot(user, slot: int = None) -> Optional[int]:
+    """Slot of a spawned simulation in the current corpus, the next free one of the persona if `slot` isn't given"""
+    if input_corpus is None:
+        return None
+    return slot if slot is not None else input_corpus.reserve_slot(user)
+
+
+class InputCorpusMode:
+    READ_WRITE = "read_write"   # replays stored inputs, stores the ones it had to generate
+    READ_ONLY = "read_only"     # replays stored inputs, generated ones are not written to the file
+
+
+class InputKind:
+    COMPLETION_INPUT = "completion_input"        # input variables of a raw completion simulation
+    CHAT_FIRST_MESSAGE = "chat_first_message"    # first message of the synthetic user in a chat simulation
+
+
+class UserInputCorpus:
+    """
+    Synthetic user inputs stored in a JSON lines file, so that runs of different prompt versions
+    are fed with the same inputs (the comparison is paired) and the synthetic user stage costs nothing.
+    Inputs are stored per persona: the key is a hash of the persona description, the kind of the input
+    and the input variables of the prompt. The run passes the simulation number as the slot when it spawns
+    the manager of a simulation, so the n-th simulation of the persona gets the n-th stored input of every run,
+    and the compared prompts of a simulation get the same input whatever order they start in.
+    Managers spawned without a slot reserve the next free one of the persona.
+    Without `path` the corpus lives in memory for one run only.
+    """
+    DEFAULT_PATH = os.path.join(".spelltest_cache", "user_inputs.jsonl")
+
+    def __init__(self, path: Optional[str] = DEFAULT_PATH, mode: str = InputCorpusMode.READ_WRITE):
+        if mode not in (InputCorpusMode.READ_WRITE, InputCorpusMode.READ_ONLY):
+            raise ValueError(f"Unexpected user input corpus mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.replayed = 0
+        self.generated = 0
+        self._inputs: Dict[tuple, Dict[str, Any]] = {}
+        self._generations: Dict[tuple, asyncio.Future] = {}
+        self._slots = defaultdict(int)
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._inputs.setdefault((record["key"], record["slot"]), record)
+        if self.read_only or not path:
+            self._file = None
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+
+    @property
+    def read_only(self) -> bool:
+        return self.mode == InputCorpusMode.READ_ONLY
+
+    @staticmethod
+    def make_key(user, kind: str, input_variables: List[str] = None) -> str:
+        persona = json.dumps(
+            {
+                "description": user.params.description,
+                "user_knowledge_about_app": user.params.user_knowledge_about_app,
+                "kind": kind,
+                "input_variables": sorted(input_variables or []),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(persona.encode("utf-8")).hexdigest()
+
+    def reserve_slot(self, user) -> int:
+        """Slot of the next simulation of the persona, the same for inputs of every kind"""
+        persona = self.make_key(user, kind="")
+        slot = self._slots[persona]
+        self._slots[persona] += 1
+        return slot
+
+    async def get_or_generate(self, key: str, slot: int, generate_message) -> Dict[str, Any]:
+        """
+        Stored input of the slot, `generate_message()` creates it (a message) if there is none.
+        Simulations which need the same slot meanwhile wait for the generation instead of sending their own requests.
+        """
+        record = self.get(key, slot)
+        if record is not None:
+            return record
+        if (key, slot) not in self._generations:
+            self._generations[(key, slot)] = asyncio.ensure_future(generate_message())
+        generation = self._generations[(key, slot)]
+        try:
+            # a cancelled simulation must not cancel the generation other simulations wait for
+            message = await asyncio.shield(generation)
+        finally:
+            if self._generations.get((key, slot)) is generation and generation.done():
+                del self._generations[(key, slot)]   # a failed generation is retried by the next simulation
+        if (key, slot) in self._inputs:
+            return self.get(key, slot)   # generated for another simulation of the slot
+        return self.put(key, slot, message.text, message.run_id)
+
+    def get(self, key: str, slot: int) -> Optional[Dict[str, Any]]:
+        record = self._inputs.get((key, slot))
+        if record is not None:
+            self.replayed += 1
+        return record
+
+    def put(self, key: str, slot: int, text: str, run_id: str = None) -> Dict[str, Any]:
+        """Keeps the input for the rest of the run, the file gets it unless the corpus is read-only"""
+        self.generated += 1
+        if (key, slot) in self._inputs:
+            return self._inputs[(key, slot)]
+        record = {"key": key, "slot": slot, "text": text, "run_id": run_id}
+        self._inputs[(key, slot)] = record
+        if self._file is not None:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._file.flush()
+        return record
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
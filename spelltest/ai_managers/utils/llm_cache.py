@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+
+llm_cache = None   # cache of the current run, see `set_llm_cache`
+
+
+def get_llm_cache():
+    return llm_cache
+
+
+def set_llm_cache(new_llm_cache):
+    global llm_cache
+    llm_cache = new_llm_cache
+
+
+class LLMCacheMode:
+    READ_WRITE = "read_write"
+    READ_ONLY = "read_only"   # use it in CI: serves what is in the cache and never writes
+
+
+class LLMResponseCache:
+    """
+    Content-addressed cache of chain outputs stored in a local SQLite file.
+    The key is a hash of the model name, the invocation params (temperature etc.) and the formatted prompt.
+    When temperature > 0 the key also includes the sample index: the n-th identical request of a run
+    gets the n-th cached sample, so `size` simulations still get distinct responses.
+    Entries older than `max_age_days` are evicted, then least recently used ones until the file fits `max_size_mb`.
+    """
+    DEFAULT_PATH = os.path.join(".spelltest_cache", "llm_cache.sqlite")
+    DEFAULT_MAX_SIZE_MB = 512
+    DEFAULT_MAX_AGE_DAYS = 30
+    # models which don't report temperature (e.g. chat models without an explicit one) sample with the API default
+    DEFAULT_TEMPERATURE = 1.0
+
+    def __init__(self,
+                 path: str = DEFAULT_PATH,
+                 mode: str = LLMCacheMode.READ_WRITE,
+                 max_size_mb: float = DEFAULT_MAX_SIZE_MB,
+                 max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+                 ):
+        if mode not in (LLMCacheMode.READ_WRITE, LLMCacheMode.READ_ONLY):
+            raise ValueError(f"Unexpected LLM cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self._sample_counters = defaultdict(int)
+        self._connection = self._connect()
+        if not self.read_only:
+            self.evict()
+
+    @property
+    def read_only(self) -> bool:
+        return self.mode == LLMCacheMode.READ_ONLY
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self.read_only:
+            if not os.path.exists(self.path):
+                return None
+            return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        connection.commit()
+        return connection
+
+    def make_key(self, llm_name: str, invocation_params: Dict[str, Any], prompt: str) -> str:
+        request = json.dumps(
+            {"llm_name": llm_name, "invocation_params": invocation_params, "prompt": prompt},
+            sort_keys=True,
+            default=str,
+        )
+        request_key = hashlib.sha256(request.encode("utf-8")).hexdigest()
+        if not invocation_params.get("temperature", self.DEFAULT_TEMPERATURE):
+            return request_key
+        sample_index = self._sample_counters[request_key]
+        self._sample_counters[request_key] += 1
+        return f"{request_key}:{sample_index}"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = None
+        if self._connection is not None:
+            row = self._connection.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not self.read_only:
+            self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any]):
+        if self.read_only:
+            return
+        serialized_value = json.dumps(value)
+        now = time.time()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, serialized_value, len(serialized_value), now, now),
+        )
+        self._connection.commit()
+
+    def evict(self):
+        self._connection.execute("DELETE FROM llm_cache WHERE created_at < ?",
+                                 (time.time() - self.max_age_seconds,))
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total_size > self.max_size_bytes:
+            rows = self._connection.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at").fetchall()
+            evicted_keys = []
+            for key, size in rows:
+                if total_size <= self.max_size_bytes:
+                    break
+                evicted_keys.append((key,))
+                total_size -= size
+            self._connection.executemany("DELETE FROM llm_cache WHERE key = ?", evicted_keys)
+        self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            if not self.read_only:
+                self.evict()
+            self._connection.close()
+            self._connection = None
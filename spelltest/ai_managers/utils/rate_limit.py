@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Dict
+
+import tiktoken
+
+
+rate_limiter = None   # rate limiter of the current run, see `set_rate_limiter`
+
+
+def get_rate_limiter():
+    return rate_limiter
+
+
+def set_rate_limiter(new_rate_limiter):
+    global rate_limiter
+    rate_limiter = new_rate_limiter
+
+
+class TokenBucket:
+    """Bucket of `capacity` tokens which is refilled continuously at `capacity` tokens per minute"""
+
+    def __init__(self, capacity: float):
+        if capacity <= 0:
+            raise ValueError(f"Expected positive bucket capacity, got {capacity}")
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.refill_rate = self.capacity / 60
+        self.updated_at = time.monotonic()
+
+    async def acquire(self, amount: float = 1):
+        # a request bigger than the bucket would wait forever, let it go when the bucket is full
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.refill_rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+
+class ModelRateLimiter:
+    """
+    Requests per minute (`rpm`) and tokens per minute (`tpm`) limits keyed by model name, e.g.
+    `{"gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000}}`. Models without limits are not throttled.
+    Tokens are counted before the request is sent, using tiktoken estimate of the prompt.
+    """
+    LIMIT_KEYS = ("rpm", "tpm")
+    DEFAULT_ENCODING = "cl100k_base"
+
+    def __init__(self, rate_limits: Dict[str, Dict[str, float]]):
+        self.request_buckets = {}
+        self.token_buckets = {}
+        for model_name, limits in (rate_limits or {}).items():
+            unexpected_keys = set(limits) - set(self.LIMIT_KEYS)
+            if unexpected_keys:
+                raise ValueError(f"Unexpected rate limit keys for model '{model_name}': {unexpected_keys}, "
+                                 f"expected any of {self.LIMIT_KEYS}")
+            if limits.get("rpm"):
+                self.request_buckets[model_name] = TokenBucket(limits["rpm"])
+            if limits.get("tpm"):
+                self.token_buckets[model_name] = TokenBucket(limits["tpm"])
+        self._encodings = {}
+
+    def is_limited(self, model_name) -> bool:
+        return model_name in self.request_buckets or model_name in self.token_buckets
+
+    async def acquire(self, model_name, prompt_text: str):
+        if model_name in self.request_buckets:
+            await self.request_buckets[model_name].acquire(1)
+        if model_name in self.token_buckets:
+            await self.token_buckets[model_name].acquire(self.estimate_tokens(model_name, prompt_text))
+
+    def estimate_tokens(self, model_name, text: str) -> int:
+        if model_name not in self._encodings:
+            try:
+                self._encodings[model_name] = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                self._encodings[model_name] = tiktoken.get_encoding(self.DEFAULT_ENCODING)
+        return len(self._encodings[model_name].encode(text, disallowed_special=()))
@@ -5,6 +5,8 @@ import time
 import argparse
 from spelltest.discover_spelltests import run_spelltests
 from spelltest.yaml_tests import run_yaml_tests
+from spelltest.ai_managers.tracing.usage_log_spool import UsageLogSpool, upload_spool, list_segments
+from spelltest.tracing_server import TracingServer
 
 def main():
     parser = argparse.ArgumentParser(
@@ -12,6 +14,70 @@ def main():
         epilog='Enjoy using SpellTest!'
     )
 
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=['trace-upload', 'tracing-server'],
+        help='trace-upload: upload usage logs left in the tracing spool to the tracing backend, '
+             'tracing-server: run a local tracing backend'
+    )
+
+    parser.add_argument(
+        '--spool-dir',
+        type=str,
+        default=UsageLogSpool.DEFAULT_DIRECTORY,
+        help='Tracing spool directory (trace-upload)'
+    )
+
+    parser.add_argument(
+        '--base-url',
+        type=str,
+        default='http://127.0.0.1:8000',
+        help='Tracing backend URL (trace-upload)'
+    )
+
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1',
+        help='Host to listen on (tracing-server)'
+    )
+
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help='Port to listen on (tracing-server)'
+    )
+
+    parser.add_argument(
+        '--db',
+        type=str,
+        default=TracingServer.DEFAULT_DB_PATH,
+        help='SQLite file of the tracing server, :memory: keeps nothing (tracing-server)'
+    )
+
+    parser.add_argument(
+        '--latency-ms',
+        type=float,
+        default=0.0,
+        help='Latency added to every request (tracing-server)'
+    )
+
+    parser.add_argument(
+        '--latency-jitter-ms',
+        type=float,
+        default=0.0,
+        help='Random latency of up to this value added to every request (tracing-server)'
+    )
+
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='Share of requests which fail with 503, from 0 to 1 (tracing-server)'
+    )
+
     parser.add_argument(
         '--config_file',
         type=str,
@@ -24,6 +90,20 @@ def main():
         help='Analyze the results of the simulation'
     )
 
+    parser.add_argument(
+        '--record',
+        type=str,
+        metavar='CASSETTE_FILE',
+        help='Record every LLM request/response of the run to the file'
+    )
+
+    parser.add_argument(
+        '--replay',
+        type=str,
+        metavar='CASSETTE_FILE',
+        help='Replay LLM responses recorded with --record, without sending any request'
+    )
+
     # Add the new argument for processing all directories.
     parser.add_argument(
         '--all-dirs',
@@ -33,23 +113,56 @@ def main():
 
     args = parser.parse_args()
 
-    if args.analyze:
+    if args.command == 'trace-upload':
+        run_trace_upload(args.spool_dir, args.base_url)
+    elif args.command == 'tracing-server':
+        run_tracing_server(args.host, args.port, args.db, args.latency_ms, args.latency_jitter_ms, args.error_rate)
+    elif args.analyze:
         run_analysis()
     elif args.all_dirs:
-        run_simulation()
+        run_simulation(record=args.record, replay=args.replay)
     else:
-        run_simulation(config_file=args.config_file)
+        run_simulation(config_file=args.config_file, record=args.record, replay=args.replay)
 
-def run_simulation(config_file=None):
+def run_simulation(config_file=None, record=None, replay=None):
     import openai
     openai.verify_ssl_certs = False
     if config_file is not None:
-        run_yaml_tests(config_file)
+        run_yaml_tests(config_file, record=record, replay=replay)
     else:
-        run_yaml_tests()
+        run_yaml_tests(record=record, replay=replay)
         run_spelltests()
 
 
+def run_trace_upload(spool_dir, base_url):
+    uploaded = upload_spool(spool_dir, base_url=base_url)
+    pending = list_segments(spool_dir)
+    print(f"Uploaded {uploaded} usage logs from {spool_dir}"
+          + (f", {len(pending)} segments are still pending" if pending else ""))
+
+
+def run_tracing_server(host, port, db, latency_ms, latency_jitter_ms, error_rate):
+    server = TracingServer(
+        host=host,
+        port=port,
+        db_path=db,
+        latency_seconds=latency_ms / 1000,
+        latency_jitter_seconds=latency_jitter_ms / 1000,
+        error_rate=error_rate,
+        verbose=True,
+    )
+    # SPELLFORGE_HOST is joined with "api/...", the client base url with "/api/..."
+    print(f"Tracing server is listening on {server.url} (latency {latency_ms:.0f}ms, error rate {error_rate:.0%}), "
+          f"use SPELLFORGE_HOST={server.url}/ and PromptelligenceClient(base_url=\"{server.url}\")")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(f"Served {server.requests} requests, {server.injected_errors} injected errors")
+
+
 def run_analysis():
     # Get the absolute path to the Streamlit app
     script_dir = os.path.dirname(os.path.abspath(__file__))
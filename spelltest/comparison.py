@@ -0,0 +1,76 @@
+from typing import List, Optional
+
+import numpy as np
+
+from .entities.simulation import Simulation, SimulationComparison
+from .entities.simulation_job_result import PairedAccuracyComparison
+
+
+def simulation_accuracy(simulation: Simulation) -> Optional[float]:
+    """Mean accuracy of the simulation evaluations, None if nothing was evaluated"""
+    if simulation is None or not simulation.evaluations:
+        return None
+    return float(np.mean([evaluation.accuracy for evaluation in simulation.evaluations]))
+
+
+class PairedComparison:
+    """
+    Compares every prompt with the first one (the baseline) on simulations which got the same user input.
+    Every pair contributes the difference of the mean accuracies of its two simulations,
+    the confidence interval of the mean delta is bootstrapped and the p-value comes from a sign-flip permutation test,
+    so nothing is assumed about the distribution of the deltas.
+    """
+    DEFAULT_CONFIDENCE = 0.95
+    RESAMPLES = 2000
+
+    def __init__(self, prompts: List[str], confidence: float = DEFAULT_CONFIDENCE, seed: int = 0):
+        if len(prompts) < 2:
+            raise Exception("Comparison requires at least two prompts")
+        if not 0 < confidence < 1:
+            raise ValueError(f"Unexpected comparison confidence: {confidence}")
+        self.prompts = prompts
+        self.confidence = confidence
+        self._random = np.random.default_rng(seed)
+
+    def compare(self, simulation_comparisons: List[SimulationComparison]) -> List[PairedAccuracyComparison]:
+        return [self._compare_variant(simulation_comparisons, variant) for variant in range(1, len(self.prompts))]
+
+    def _compare_variant(self, simulation_comparisons, variant) -> PairedAccuracyComparison:
+        deltas = []
+        for simulation_comparison in simulation_comparisons:
+            baseline_accuracy = simulation_accuracy(simulation_comparison.simulations[0])
+            variant_accuracy = simulation_accuracy(simulation_comparison.simulations[variant])
+            if baseline_accuracy is not None and variant_accuracy is not None:
+                deltas.append(variant_accuracy - baseline_accuracy)
+        deltas_array = np.array(deltas)
+        return PairedAccuracyComparison(
+            baseline=self.prompts[0],
+            variant=self.prompts[variant],
+            pairs=len(deltas),
+            mean_delta=float(deltas_array.mean()) if deltas else 0.0,
+            delta_deviation=float(deltas_array.std(ddof=1)) if len(deltas) > 1 else 0.0,
+            confidence_interval=self._bootstrap_confidence_interval(deltas_array),
+            p_value=self._sign_flip_p_value(deltas_array),
+            wins=int((deltas_array > 0).sum()),
+            losses=int((deltas_array < 0).sum()),
+            ties=int((deltas_array == 0).sum()),
+            deltas=deltas,
+            confidence=self.confidence,
+        )
+
+    def _bootstrap_confidence_interval(self, deltas) -> List[float]:
+        if len(deltas) == 0:
+            return [0.0, 0.0]
+        resampled_means = self._random.choice(deltas, size=(self.RESAMPLES, len(deltas))).mean(axis=1)
+        tail = (1 - self.confidence) / 2 * 100
+        lower, upper = np.percentile(resampled_means, [tail, 100 - tail])
+        return [float(lower), float(upper)]
+
+    def _sign_flip_p_value(self, deltas) -> float:
+        if len(deltas) == 0:
+            return 1.0
+        signs = self._random.choice([-1.0, 1.0], size=(self.RESAMPLES, len(deltas)))
+        permuted_means = np.abs((signs * deltas).mean(axis=1))
+        observed = abs(deltas.mean())
+        # the observed deltas count as one of the permutations, so the p-value is never 0
+        return float(((permuted_means >= observed - 1e-12).sum() + 1) / (self.RESAMPLES + 1))
@@ -0,0 +1,49 @@
+import asyncio
+from typing import List
+from uuid import uuid4
+
+
+class ConversationPrefix:
+    """
+    Beginning of a conversation shared by `branches` chat simulations, a node of a conversation tree.
+    The first branch generates it with its own managers, the others wait for it instead of sending the same requests,
+    then every branch continues the conversation with a fork of the managers.
+    """
+
+    def __init__(self, fork_after_messages: int):
+        self.prefix_id = str(uuid4())
+        self.fork_after_messages = fork_after_messages   # counted like `chat_mode_max_messages`
+        self.managers = None
+        self.user_message = None
+        self.message_count = None
+        self._generation = None
+
+    async def fork(self, generate_prefix):
+        """
+        `generate_prefix()` returns the app manager, the synthetic user manager, the last message of the synthetic user
+        and the number of messages exchanged after the conversation was initialized.
+        """
+        if self.managers is None:
+            if self._generation is None:
+                self._generation = asyncio.ensure_future(generate_prefix())
+            try:
+                # a cancelled branch must not cancel the generation other branches wait for
+                app_manager, user_persona_manager, user_message, message_count = await asyncio.shield(self._generation)
+            except Exception:
+                self._generation = None   # the next branch tries again
+                raise
+            self.managers = (app_manager, user_persona_manager)
+            self.user_message = user_message
+            self.message_count = message_count
+        app_manager, user_persona_manager = self.managers
+        return app_manager.fork(), user_persona_manager.fork(), self.user_message, self.message_count
+
+
+def conversation_prefixes(size: int, fork_after_messages: int, branches: int) -> List[ConversationPrefix]:
+    """Prefix of every one of `size` simulations, every `branches` consecutive simulations share one"""
+    if branches < 1:
+        raise ValueError(f"Unexpected number of conversation branches: {branches}")
+    if fork_after_messages < 0:
+        raise ValueError(f"Unexpected conversation fork point: {fork_after_messages}")
+    prefixes = [ConversationPrefix(fork_after_messages) for _ in range((size + branches - 1) // branches)]
+    return [prefixes[sim_num // branches] for sim_num in range(size)]
@@ -0,0 +1,81 @@
+import math
+from typing import List, Optional
+
+import numpy as np
+
+from .entities.simulation import Simulation
+
+
+class EarlyStoppingDecision:
+    PASSED = "PASSED"   # mean accuracy is above the quality threshold with the configured confidence
+    FAILED = "FAILED"   # mean accuracy is below the quality threshold with the configured confidence
+
+
+class SequentialEarlyStopping:
+    """
+    Aggregates accuracy of simulations as they complete and settles the pass/fail decision
+    against the quality threshold as soon as the confidence interval of the mean accuracy
+    is entirely above or below it, so the remaining simulations don't have to run.
+    Every simulation contributes the mean accuracy of its evaluations.
+    The interval is checked after every simulation, so it has to hold at all of these looks at once:
+    accuracy is bounded in [0, 1] and the interval is a predictable plug-in empirical Bernstein
+    confidence sequence (Waudby-Smith & Ramdas, "Estimating means of bounded random variables by betting"),
+    which holds at every number of simulations with probability `confidence`.
+    Its width follows the observed variance of accuracy, so consistent simulations settle after a few dozen.
+    """
+    DEFAULT_CONFIDENCE = 0.95
+    DEFAULT_MIN_SIMULATIONS = 10
+    MAX_BET = 0.75  # truncation of the per-simulation weights, 1/2 or 3/4 are suggested
+
+    def __init__(self,
+                 quality_threshold: float,
+                 confidence: float = DEFAULT_CONFIDENCE,
+                 min_simulations: int = DEFAULT_MIN_SIMULATIONS,
+                 ):
+        if quality_threshold is None:
+            raise Exception("Early stopping requires `quality_threshold`")
+        if not 0 < confidence < 1:
+            raise ValueError(f"Unexpected early stopping confidence: {confidence}")
+        # quality threshold is configured in 0-100 like the scores, accuracy is 0-1
+        self.quality_threshold = quality_threshold / 100
+        self.confidence = confidence
+        self.min_simulations = max(min_simulations, 2)
+        self.accuracies: List[float] = []
+        self.decision: Optional[str] = None
+        self.confidence_interval = None
+
+    @property
+    def simulations_used(self) -> int:
+        return len(self.accuracies)
+
+    def add(self, simulation: Simulation) -> bool:
+        """Take a completed simulation into account, returns True when the decision is settled"""
+        if simulation is not None and simulation.evaluations:
+            self.accuracies.append(float(np.mean([evaluation.accuracy for evaluation in simulation.evaluations])))
+        if self.decision is None and self.simulations_used >= self.min_simulations:
+            self.confidence_interval = self._confidence_interval()
+            lower, upper = self.confidence_interval
+            if lower > self.quality_threshold:
+                self.decision = EarlyStoppingDecision.PASSED
+            elif upper < self.quality_threshold:
+                self.decision = EarlyStoppingDecision.FAILED
+        return self.decision is not None
+
+    def _confidence_interval(self):
+        accuracies = np.array(self.accuracies)
+        t = np.arange(1, len(accuracies) + 1)
+        log_alpha = math.log(2 / (1 - self.confidence))
+        # running mean and variance with a prior of one 0.5 observation, each weight uses only earlier simulations
+        means = (0.5 + np.cumsum(accuracies)) / (t + 1)
+        variances = (0.25 + np.cumsum((accuracies - means) ** 2)) / (t + 1)
+        previous_means = np.concatenate([[0.5], means[:-1]])
+        previous_variances = np.concatenate([[0.25], variances[:-1]])
+        bets = np.minimum(np.sqrt(2 * log_alpha / (previous_variances * t * np.log(1 + t))), self.MAX_BET)
+        psi = (-np.log(1 - bets) - bets) / 4
+        center = float(np.sum(bets * accuracies) / np.sum(bets))
+        radius = float((log_alpha + np.sum(4 * (accuracies - previous_means) ** 2 * psi)) / np.sum(bets))
+        lower, upper = max(center - radius, 0.0), min(center + radius, 1.0)
+        # the sequence holds at every look at once, so the intersection with the previous interval holds too
+        if self.confidence_interval is not None:
+            lower, upper = max(lower, self.confidence_interval[0]), min(upper, self.confidence_interval[1])
+        return lower, upper
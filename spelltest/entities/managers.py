@@ -12,6 +12,7 @@ class EvaluationResult:
     accuracy: float
     accuracy_deviation: float
     rationale: str
+    shots: int = None   # number of accuracy shots drawn for this metric
 
 
 @dataclass
@@ -32,3 +33,4 @@ class Message:
     author: MessageType
     text: str
     run_id: str = None
+    shared_run_id: str = None   # run which generated this message together with others, e.g. bulk user inputs
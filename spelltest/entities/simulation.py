@@ -29,4 +29,12 @@ class Simulation:
     evaluations: List[EvaluationResult]
     message_storage: Union[ChatSimulationMessageStorage, CompletionSimulationMessageStorage]
     granular_evaluation: bool = False
+    prefix_id: str or None = None   # conversation prefix shared with other chat simulations, see `chat_mode_fork`
+    failed_metrics: List[str] = None   # metrics whose evaluation failed, they are missing in `evaluations`
 
+
+
+@dataclass
+class SimulationComparison:
+    app_user_persona_id: int
+    simulations: List[Simulation]   # one per compared prompt, in order of prompts, all run on the same user input
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import List
 from .metric import Metric
-from .simulation import Simulation
+from .simulation import Simulation, SimulationComparison
 
 
 @dataclass
@@ -17,4 +17,42 @@ class SimulationJobResult:
     temperature: float
     reason: str
     reason_value: str
-    status: str
\ No newline at end of file
+    status: str
+    simulations_used: int = None   # fewer than planned when early stopping settled the result
+    early_stopping_decision: str = None                      # PASSED or FAILED, None if it was not settled
+    early_stopping_confidence_interval: List[float] = None   # of the mean accuracy at the last look, 0-1
+    early_stopping_confidence: float = None
+    failed_evaluations: int = 0   # metric evaluations left out of the simulations because they failed
+
+
+@dataclass
+class PairedAccuracyComparison:
+    baseline: str
+    variant: str
+    pairs: int
+    mean_delta: float            # mean of per-simulation accuracy deltas, variant minus baseline
+    delta_deviation: float
+    confidence_interval: List[float]
+    p_value: float               # paired sign-flip permutation test, the variant is the same as the baseline
+    wins: int
+    losses: int
+    ties: int
+    deltas: List[float]
+    confidence: float = None     # of the confidence interval
+
+
+@dataclass
+class ComparisonJobResult:
+    project_name: str
+    prompts: List[str]
+    prompt_version_ids: List[int]
+    comparisons: List[PairedAccuracyComparison]
+    simulations: List[SimulationComparison]
+    llm_name: str
+    size: int
+    chat_mode: bool
+    temperature: float
+    reason: str
+    reason_value: str
+    status: str
+    notes: List[str] = None   # caveats of the comparison, e.g. of the shared inputs in chat mode
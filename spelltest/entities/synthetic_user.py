@@ -1,10 +1,11 @@
+import json
 import os
 import urllib
 
 import requests as requests
 from dataclasses import dataclass, field
 from .metric import MetricDefinition
-from typing import List
+from typing import Any, List, Dict, Callable, Tuple
 
 IGNORE_DATA_COLLECTING = bool(os.environ.get("IGNORE_DATA_COLLECTING", "True"))
 SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "http://spellforge.ai/")
@@ -25,11 +26,23 @@ class SyntheticUser:
     metrics: List[MetricDefinition]
     db_id: int = field(default=None,
                        init=False)  # Using field to make it clear that db_id shouldn't be passed during initialization
+    # persona specific prompts (system prompts etc.) rendered once, see `rendered_prompt`
+    rendered_prompts: Dict[Tuple[str, str], str] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if not IGNORE_DATA_COLLECTING:
             self._synchronise_with_db()
 
+    def rendered_prompt(self, template: str, render: Callable[[], str], variables: Dict[str, Any] = None) -> str:
+        """
+        Prompt rendered from the `template` source with `variables` for this user,
+        `render` is called only the first time for the same template and variables
+        """
+        key = (template, json.dumps(variables or {}, sort_keys=True, default=str))
+        if key not in self.rendered_prompts:
+            self.rendered_prompts[key] = render()
+        return self.rendered_prompts[key]
+
     def _synchronise_with_db(self):
         headers = {"Authorization": f"Api-Key {SPELLFORGE_API_KEY}"}
         encoded_name = urllib.parse.quote(self.name)
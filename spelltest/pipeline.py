@@ -0,0 +1,111 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class PipelineStageStats:
+    workers: int
+    completed: int = 0
+    busy_seconds: float = 0.0       # sum of the durations of the stage tasks
+    elapsed_seconds: float = 0.0    # from the start of the run to the last completed task of the stage
+
+    @property
+    def throughput(self) -> float:
+        """Completed tasks per second"""
+        return self.completed / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+
+@dataclass
+class PipelineStats:
+    generation: PipelineStageStats
+    evaluation: PipelineStageStats
+    queue_size: int
+    queue_depths: List[int] = field(default_factory=list)   # sampled every time a transcript is queued
+    generation_wait_seconds: float = 0.0   # generation workers blocked on the full queue, evaluation is the bottleneck
+    evaluation_wait_seconds: float = 0.0   # evaluation workers waiting for transcripts, generation is the bottleneck
+
+    @property
+    def max_queue_depth(self) -> int:
+        return max(self.queue_depths, default=0)
+
+    @property
+    def mean_queue_depth(self) -> float:
+        return sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else 0.0
+
+
+async def run_two_stage_pipeline(task_factories, generation_concurrency, evaluation_concurrency, queue_size,
+                                 on_result=None):
+    """
+    Run the provided task factories as a two-stage pipeline.
+    `generation_concurrency` workers run the task factories (generation stage), every task returns a coroutine function
+    (evaluation stage) which is put into a queue of at most `queue_size` items and run by `evaluation_concurrency` workers.
+    Generation stops when the queue is full, so transcripts don't pile up when evaluation is slower.
+    Results keep the order of `task_factories`, `on_result` works like in `_run_tasks_in_window`:
+    once it returns True no new generation is started, generated transcripts are still evaluated.
+    Returns the results and the stats of the run.
+    """
+    results = [None] * len(task_factories)
+    generation_workers_count = min(max(generation_concurrency, 1), len(task_factories))
+    evaluation_workers_count = min(max(evaluation_concurrency, 1), len(task_factories))
+    stats = PipelineStats(
+        generation=PipelineStageStats(workers=generation_workers_count),
+        evaluation=PipelineStageStats(workers=evaluation_workers_count),
+        queue_size=max(queue_size, 1),
+    )
+    queue = asyncio.Queue(maxsize=max(queue_size, 1))
+    pending = iter(enumerate(task_factories))
+    started_at = time.monotonic()
+    stopped = False
+
+    async def generation_worker():
+        # all workers share one iterator, so every task factory is picked up exactly once
+        for index, task_factory in pending:
+            if stopped:
+                break
+            task_started_at = time.monotonic()
+            evaluate = await task_factory()
+            finished_at = time.monotonic()
+            stats.generation.completed += 1
+            stats.generation.busy_seconds += finished_at - task_started_at
+            stats.generation.elapsed_seconds = finished_at - started_at
+            await queue.put((index, evaluate))
+            stats.generation_wait_seconds += time.monotonic() - finished_at
+            stats.queue_depths.append(queue.qsize())
+
+    async def evaluation_worker():
+        nonlocal stopped
+        while True:
+            wait_started_at = time.monotonic()
+            item = await queue.get()
+            task_started_at = time.monotonic()
+            stats.evaluation_wait_seconds += task_started_at - wait_started_at
+            if item is None:
+                break
+            index, evaluate = item
+            results[index] = await evaluate()
+            finished_at = time.monotonic()
+            stats.evaluation.completed += 1
+            stats.evaluation.busy_seconds += finished_at - task_started_at
+            stats.evaluation.elapsed_seconds = finished_at - started_at
+            if on_result is not None and on_result(results[index]):
+                stopped = True
+
+    generation_workers = [asyncio.ensure_future(generation_worker()) for _ in range(generation_workers_count)]
+    evaluation_workers = [asyncio.ensure_future(evaluation_worker()) for _ in range(evaluation_workers_count)]
+
+    async def finish_evaluation():
+        await asyncio.gather(*generation_workers)
+        for _ in evaluation_workers:
+            await queue.put(None)   # every evaluation worker finishes after the transcripts queued before it
+
+    finishing = asyncio.ensure_future(finish_evaluation())
+    try:
+        # a failed evaluation worker must not leave generation workers blocked on the full queue
+        await asyncio.gather(finishing, *evaluation_workers)
+    except BaseException:
+        for worker_task in generation_workers + evaluation_workers + [finishing]:
+            worker_task.cancel()
+        raise
+    return results, stats
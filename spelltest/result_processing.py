@@ -9,8 +9,11 @@ import numpy as np
 from typing import List
 
 from .entities.metric import Metric
-from .entities.simulation import Simulation, ChatSimulationMessageStorage, CompletionSimulationMessageStorage
-from .entities.simulation_job_result import SimulationJobResult
+from .comparison import PairedComparison
+from .early_stopping import SequentialEarlyStopping
+from .entities.simulation import Simulation, SimulationComparison, ChatSimulationMessageStorage, \
+    CompletionSimulationMessageStorage
+from .entities.simulation_job_result import SimulationJobResult, ComparisonJobResult
 from .utils import enum_encoder
 
 SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "http://spellforge.ai/")
@@ -24,9 +27,75 @@ def process_simulation_result(
         chat_mode: bool,
         temperature: float,
         reason: str,
+        reason_value: str,
+        early_stopping: SequentialEarlyStopping = None,
+):
+    return ProcessSimulationResult(project_name, simulations, llm_name, size, chat_mode, temperature, reason, reason_value,
+                                   early_stopping=early_stopping).process()
+
+
+def process_comparison_result(
+        project_name: str,
+        prompts: List[str],
+        comparisons: List[SimulationComparison],
+        llm_name,
+        size: int,
+        chat_mode: bool,
+        temperature: float,
+        reason: str,
         reason_value: str
 ):
-    return ProcessSimulationResult(project_name, simulations, llm_name, size, chat_mode, temperature, reason, reason_value).process()
+    return ProcessComparisonResult(project_name, prompts, comparisons, llm_name, size, chat_mode, temperature, reason, reason_value).process()
+
+
+def serialize_message_storage(simulations: List[Simulation]):
+    for simulation in simulations:
+        if simulation.message_storage:
+            if isinstance(simulation.message_storage, ChatSimulationMessageStorage):
+                chat_history_dicts = []
+                for i, message in enumerate(simulation.message_storage.chat_history):
+                    message_dict = {
+                        "author": message.author.name,  # Convert MessageType enum to its name
+                        "text": message.text,
+                        "run_id": message.run_id,
+                    }
+                    chat_history_dicts.append(message_dict)
+                simulation.message_storage.chat_history = chat_history_dicts
+            elif isinstance(simulation.message_storage, CompletionSimulationMessageStorage):
+                simulation.message_storage.prompt = {
+                    "author": simulation.message_storage.prompt.author.name,
+                    "text": simulation.message_storage.prompt.text,
+                    "run_id": simulation.message_storage.prompt.run_id,
+                    "shared_run_id": simulation.message_storage.prompt.shared_run_id,
+                }
+                simulation.message_storage.completion = {
+                    "author": simulation.message_storage.completion.author.name,
+                    "text": simulation.message_storage.completion.text,
+                    "run_id": simulation.message_storage.completion.run_id
+                }
+
+
+def save_result(project_name: str, filename_prefix: str, data):
+    # Retrieve the ID from the dictionary
+    test_id = str(uuid.uuid4())
+
+    # Get the current time in a human-readable and file-system-friendly format
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+
+    # Construct the filename
+    filename = f"{filename_prefix}_{timestamp}_{test_id}.json"
+
+    folder_path = os.path.join(ProcessSimulationResult.RESULT_FOLDER_NAME, project_name)
+
+    # Check if the folder exists, if not, create it
+    os.makedirs(folder_path, exist_ok=True)
+
+    # Save the dictionary to a file in JSON format
+    file_path = os.path.join(folder_path, filename)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    print(f"Saved in {file_path} (project '{project_name}'), \n"
+          f"to get more details open the file within spelltest browser, command `spelltest --analyze`")
 
 
 class ProcessSimulationResult:
@@ -50,10 +119,12 @@ class ProcessSimulationResult:
                  temperature: float,
                  reason: str,
                  reason_value: str,
-                 status: str = "SUCCESS"
+                 status: str = "SUCCESS",
+                 early_stopping: SequentialEarlyStopping = None,
                  ):
         self.project_name = project_name
         self.simulations = simulations
+        self.early_stopping = early_stopping
         self.llm_name = llm_name
         self.size = size
         self.chat_mode = chat_mode
@@ -64,6 +135,10 @@ class ProcessSimulationResult:
         self.prompt_version_id = self.simulations[0].prompt_version_id
         self.app_user_persona_ids = list(set([simulation.app_user_persona_id for simulation in self.simulations]))
 
+    @property
+    def failed_evaluations(self) -> int:
+        return sum(len(simulation.failed_metrics or []) for simulation in self.simulations)
+
     def process(self):
         self.aggregated_metrics = self.calculate_aggregated_metrics()
         self.print_simulation_job_result()
@@ -120,34 +195,16 @@ class ProcessSimulationResult:
         for label, value in stats:
             print(f"{label.ljust(max_label_length)}: {value * 100:.2f} of 100"
                   if "Deviation" not in label else f"{label.ljust(max_label_length)}: {value * 100:.2f}")
+        if self.failed_evaluations:
+            # failed metrics are left out of the means above
+            print(f"{self.ANSI_COLORS['red']}⚠️  Failed metric evaluations: {self.failed_evaluations}, "
+                  f"not included in the accuracy{self.ANSI_COLORS['reset']}")
 
         # Individual Simulations
         print("\n" + "🔚" + "=" * 58 + "🔚")
 
     def save_simulation_job_result(self):
-        for simulation in self.simulations:
-            if simulation.message_storage:
-                if isinstance(simulation.message_storage, ChatSimulationMessageStorage):
-                    chat_history_dicts = []
-                    for i, message in enumerate(simulation.message_storage.chat_history):
-                        message_dict = {
-                            "author": message.author.name,  # Convert MessageType enum to its name
-                            "text": message.text,
-                            "run_id": message.run_id,
-                        }
-                        chat_history_dicts.append(message_dict)
-                    simulation.message_storage.chat_history = chat_history_dicts
-                elif isinstance(simulation.message_storage, CompletionSimulationMessageStorage):
-                    simulation.message_storage.prompt = {
-                        "author": simulation.message_storage.prompt.author.name,
-                        "text": simulation.message_storage.prompt.text,
-                        "run_id": simulation.message_storage.prompt.run_id
-                    }
-                    simulation.message_storage.completion = {
-                        "author": simulation.message_storage.completion.author.name,
-                        "text": simulation.message_storage.completion.text,
-                        "run_id": simulation.message_storage.completion.run_id
-                    }
+        serialize_message_storage(self.simulations)
         self.simulation_job_data = asdict(SimulationJobResult(
             project_name=self.project_name,
             aggregated_metrics=self.aggregated_metrics,
@@ -158,28 +215,90 @@ class ProcessSimulationResult:
             temperature=self.temperature,
             reason=self.reason,
             reason_value=self.reason_value,
-            status=self.status
+            status=self.status,
+            simulations_used=len(self.simulations),
+            early_stopping_decision=self.early_stopping.decision if self.early_stopping else None,
+            early_stopping_confidence_interval=list(self.early_stopping.confidence_interval)
+            if self.early_stopping and self.early_stopping.confidence_interval else None,
+            early_stopping_confidence=self.early_stopping.confidence if self.early_stopping else None,
+            failed_evaluations=self.failed_evaluations,
         ))
-        # Retrieve the ID from the dictionary
-        test_id = str(uuid.uuid4())
+        save_result(self.project_name, self.project_name, self.simulation_job_data)
 
-        # Get the current time in a human-readable and file-system-friendly format
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
 
-        # Construct the filename
-        filename = f"{self.project_name}_{timestamp}_{test_id}.json"
+class ProcessComparisonResult:
+    ANSI_COLORS = ProcessSimulationResult.ANSI_COLORS
+    CHAT_MODE_NOTE = ("In chat mode the shared first user message was generated in reply to the welcome message "
+                      "of the prompt whose simulation asked for it first (usually the baseline), "
+                      "the other prompts get it after their own welcome message.")
 
-        folder_path = os.path.join(self.RESULT_FOLDER_NAME, self.project_name)
-
-        # Check if the folder exists, if not, create it
-        os.makedirs(folder_path, exist_ok=True)
+    def __init__(self,
+                 project_name: str,
+                 prompts: List[str],
+                 comparisons: List[SimulationComparison],
+                 llm_name: str,
+                 size: int,
+                 chat_mode: bool,
+                 temperature: float,
+                 reason: str,
+                 reason_value: str,
+                 status: str = "SUCCESS"
+                 ):
+        self.project_name = project_name
+        self.prompts = prompts
+        self.comparisons = comparisons
+        self.llm_name = llm_name
+        self.size = size
+        self.chat_mode = chat_mode
+        self.temperature = temperature
+        self.reason = reason
+        self.reason_value = reason_value
+        self.status = status
+        self.prompt_version_ids = [simulation.prompt_version_id for simulation in comparisons[0].simulations] \
+            if comparisons else []
 
-        # Save the dictionary to a file in JSON format
-        file_path = os.path.join(folder_path, filename)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(self.simulation_job_data, f, ensure_ascii=False, indent=4)
-        print(f"Saved in {file_path} (project '{self.project_name}'), \n"
-              f"to get more details open the file within spelltest browser, command `spelltest --analyze`")
+    def process(self):
+        self.paired_comparisons = PairedComparison(self.prompts).compare(self.comparisons)
+        self.print_comparison_job_result()
+        self.save_comparison_job_result()
+        return self.comparison_job_data
 
+    def print_comparison_job_result(self):
+        print(f"{self.ANSI_COLORS['cyan']}📊 {'=' * 23} Comparison Results"
+              f"{'=' * 23} 📊{self.ANSI_COLORS['reset']}\n")
+        print(f"{self.ANSI_COLORS['yellow']}📈 Baseline: {self.prompts[0]}{self.ANSI_COLORS['reset']}")
+        for comparison in self.paired_comparisons:
+            lower, upper = comparison.confidence_interval
+            color = self.ANSI_COLORS["green"] if lower > 0 else self.ANSI_COLORS["red"] if upper < 0 else ""
+            print(f"{color}⚖️  {comparison.variant}: {comparison.mean_delta * 100:+.2f} of 100 "
+                  f"({comparison.confidence * 100:g}% CI [{lower * 100:+.2f}, {upper * 100:+.2f}], "
+                  f"p={comparison.p_value:.3f}, "
+                  f"{comparison.wins} wins, {comparison.losses} losses, {comparison.ties} ties "
+                  f"on {comparison.pairs} shared inputs){self.ANSI_COLORS['reset']}")
+        for note in self.notes:
+            print(f"{self.ANSI_COLORS['yellow']}ℹ️  {note}{self.ANSI_COLORS['reset']}")
+        print("\n" + "🔚" + "=" * 58 + "🔚")
 
+    @property
+    def notes(self) -> List[str]:
+        return [self.CHAT_MODE_NOTE] if self.chat_mode else []
 
+    def save_comparison_job_result(self):
+        for comparison in self.comparisons:
+            serialize_message_storage(comparison.simulations)
+        self.comparison_job_data = asdict(ComparisonJobResult(
+            project_name=self.project_name,
+            prompts=self.prompts,
+            prompt_version_ids=self.prompt_version_ids,
+            comparisons=self.paired_comparisons,
+            simulations=self.comparisons,
+            llm_name=self.llm_name,
+            size=self.size,
+            chat_mode=self.chat_mode,
+            temperature=self.temperature,
+            reason=self.reason,
+            reason_value=self.reason_value,
+            status=self.status,
+            notes=self.notes,
+        ))
+        save_result(self.project_name, f"{self.project_name}_compare", self.comparison_job_data)
@@ -1,5 +1,5 @@
 import os
-from typing import List, Union
+from typing import List, Union, Dict
 from uuid import uuid4
 
 from rich.console import Console
@@ -12,11 +12,12 @@ from .ai_managers.chat_manager import SyntheticUserChatManager, AIModelDefaultCh
 from .ai_managers.raw_completion_manager import AIModelDefaultCompletionManager, SyntheticUserCompletionManager
 from .ai_managers.tracing.cost_calculation_tracing import CostCalculationManager, CostCalculationTracer
 from .entities.general import Mode
-from .entities.simulation import Simulation, ReasonType
+from .entities.simulation import ReasonType
 from .entities.synthetic_user import SyntheticUser, SyntheticUserParams
-from .result_processing import process_simulation_result
-from .spelltest_execution import spelltest_async_together
-from .ai_managers.tracing.promtelligence_tracing import PromptelligenceClient
+from .result_processing import process_simulation_result, process_comparison_result
+from .utils import RollingHistory, extract_fields
+from .spelltest_execution import spelltest_async_together, MAX_CONCURRENCY_DEFAULT, MAX_LLM_CONCURRENCY_DEFAULT
+from .ai_managers.tracing.promtelligence_tracing import PromptelligenceClient, batch_prompt_registration
 
 DEFAULT_LLM = 'gpt-3.5-turbo'
 IGNORE_DATA_COLLECTING = bool(os.environ.get("IGNORE_DATA_COLLECTING", "True"))
@@ -41,6 +42,12 @@ def spelltest_run_simulation(
         temperature: float = 0.8,
         chat_mode: bool = False,
         chat_mode_max_messages: int = None,
+        chat_mode_history_window: int = RollingHistory.DEFAULT_WINDOW,
+        chat_mode_welcome_messages: int = None,
+        chat_mode_fork: Dict = None,
+        chat_mode_streaming_evaluation: Dict = None,
+        pipeline: Dict = None,
+        bulk_user_inputs: int = None,
         custom_ai_model_manager: Union[AIModelDefaultCompletionManagerBase, ChatManagerBase] = None,
         custom_user_persona_manager: Union[ChatManagerBase, SyntheticUserRawCompletionManagerBase] = None,
         custom_evaluation_manager: EvaluationManagerBase = None,
@@ -49,53 +56,104 @@ def spelltest_run_simulation(
         evaluation_llm_name_perfect: str = None,
         evaluation_llm_name_rationale: str = None,
         evaluation_llm_name_accuracy: str = None,
+        multi_metric_rationale: bool = False,
+        adaptive_accuracy: Dict = None,
+        quality_threshold: float = None,
+        early_stopping: Dict = None,
         reason: str = ReasonType.MANUAL,
         reason_value: str = str(uuid4()),
+        max_concurrency: int = MAX_CONCURRENCY_DEFAULT,
+        adaptive_concurrency: bool = False,
+        max_llm_concurrency: int = MAX_LLM_CONCURRENCY_DEFAULT,
+        rate_limits: Dict[str, Dict[str, float]] = None,
+        llm_cache: Dict = None,
+        user_input_corpus: Dict = None,
+        record: str = None,
+        replay: str = None,
+        compare_prompts: List[str] = None,
+        prompt_names: List[str] = None,
 ):
-    if prompt:
-        default_ai_manager_cls = AIModelDefaultChatManager if chat_mode else AIModelDefaultCompletionManager
-        app_manager = default_ai_manager_cls(
-            target_prompt=prompt,
+    if replay and not openai_api_key:
+        openai_api_key = "replay"   # responses are replayed from the file, OpenAI clients only require any key
+
+    def create_app_manager(target_prompt):
+        if chat_mode:
+            return AIModelDefaultChatManager(
+                target_prompt=target_prompt,
+                llm_name=llm_name,
+                openai_api_key=openai_api_key,
+                temperature=temperature,
+                history_window=chat_mode_history_window,
+                welcome_message_pool_size=chat_mode_welcome_messages,
+                role="AI",
+                opposite_role="Human"
+            )
+        return AIModelDefaultCompletionManager(
+            target_prompt=target_prompt,
             llm_name=llm_name,
             openai_api_key=openai_api_key,
             temperature=temperature,
             role="AI",
             opposite_role="Human"
         )
-    elif custom_ai_model_manager:
-        if not isinstance(custom_ai_model_manager, ChatManagerBase) and \
-                not isinstance(custom_ai_model_manager, AIModelDefaultCompletionManagerBase):
-            raise Exception("Since test_target is custom class, "
-                            "it is expected to be child of ChatManagerBase or AIModelDefaultCompletionManagerBase")
-        if users:
-            raise Exception("You can't pass users with custom AI model as test_target")
-        app_manager = custom_ai_model_manager
-    else:
-        raise Exception("There are 'prompt' or 'custom_ai_model_manager' parameters required to run simulation")
-    if not users:
-        if not isinstance(custom_user_persona_manager, ChatManagerBase) and not \
-                isinstance(custom_user_persona_manager, SyntheticUserRawCompletionManagerBase):
-            raise Exception("Since there is no users, "
-                            "`custom_user_persona_manager`is expected "
-                            "(based on ChatManagerBase or SyntheticUserRawCompletionManagerBase) ")
-        user_persona_managers = [custom_user_persona_manager]
-    else:
-        user_persona_managers = []
-        for user in users:
-            if chat_mode:
-                user_persona_manager = SyntheticUserChatManager(
-                    user=user,
-                    openai_api_key=openai_api_key,
-                )
-            else:
-                user_persona_manager = SyntheticUserCompletionManager(
-                    target_prompt=prompt,
-                    user=user,
-                    openai_api_key=openai_api_key,
-                )
-            user_persona_managers.append(user_persona_manager)
 
-    simulation_result: List[Simulation] = spelltest_async_together(
+    if compare_prompts:
+        if not prompt:
+            raise Exception("Prompt comparison requires the baseline 'prompt'")
+        prompt_names = prompt_names or [f"prompt_{i}" for i in range(len(compare_prompts) + 1)]
+        if len(prompt_names) != len(compare_prompts) + 1:
+            raise Exception("'prompt_names' are expected for the baseline 'prompt' and every one of 'compare_prompts'")
+        # every prompt is run on the user inputs generated for the baseline
+        baseline_variables = sorted(set(extract_fields(prompt)))
+        for prompt_name, compare_prompt in zip(prompt_names[1:], compare_prompts):
+            compare_variables = sorted(set(extract_fields(compare_prompt)))
+            if compare_variables != baseline_variables:
+                raise Exception(f"Compared prompt '{prompt_name}' takes input variables {compare_variables}, "
+                                f"the baseline '{prompt_names[0]}' takes {baseline_variables}: "
+                                f"compared prompts are run on the same user inputs and have to take the same variables")
+    # versions of the prompts created by the managers are registered in tracing with one request
+    with batch_prompt_registration():
+        if prompt:
+            app_manager = create_app_manager(prompt)
+        elif custom_ai_model_manager:
+            if not isinstance(custom_ai_model_manager, ChatManagerBase) and \
+                    not isinstance(custom_ai_model_manager, AIModelDefaultCompletionManagerBase):
+                raise Exception("Since test_target is custom class, "
+                                "it is expected to be child of ChatManagerBase or AIModelDefaultCompletionManagerBase")
+            if users:
+                raise Exception("You can't pass users with custom AI model as test_target")
+            app_manager = custom_ai_model_manager
+        else:
+            raise Exception("There are 'prompt' or 'custom_ai_model_manager' parameters required to run simulation")
+        if not users:
+            if not isinstance(custom_user_persona_manager, ChatManagerBase) and not \
+                    isinstance(custom_user_persona_manager, SyntheticUserRawCompletionManagerBase):
+                raise Exception("Since there is no users, "
+                                "`custom_user_persona_manager`is expected "
+                                "(based on ChatManagerBase or SyntheticUserRawCompletionManagerBase) ")
+            user_persona_managers = [custom_user_persona_manager]
+        else:
+            user_persona_managers = []
+            for user in users:
+                if chat_mode:
+                    user_persona_manager = SyntheticUserChatManager(
+                        user=user,
+                        openai_api_key=openai_api_key,
+                        history_window=chat_mode_history_window,
+                    )
+                else:
+                    user_persona_manager = SyntheticUserCompletionManager(
+                        target_prompt=prompt,
+                        user=user,
+                        openai_api_key=openai_api_key,
+                        bulk_user_inputs=bulk_user_inputs,
+                    )
+                user_persona_managers.append(user_persona_manager)
+        compare_app_managers = [create_app_manager(compare_prompt) for compare_prompt in compare_prompts] \
+            if compare_prompts else None
+
+    early_stopping_results = []
+    simulation_result = spelltest_async_together(
         target_prompt=prompt,
         app_manager=app_manager,
         user_persona_managers=user_persona_managers,
@@ -103,14 +161,43 @@ def spelltest_run_simulation(
         size=size,
         mode=Mode.CHAT if chat_mode else Mode.RAW_COMPLETION,
         chat_mode_max_messages=chat_mode_max_messages,
+        chat_mode_fork=chat_mode_fork,
+        chat_mode_streaming_evaluation=chat_mode_streaming_evaluation,
+        pipeline=pipeline,
         openai_api_key=openai_api_key,
         llm_name=llm_name,
         evaluation_llm_name=evaluation_llm_name,
         evaluation_llm_name_perfect=evaluation_llm_name_perfect,
         evaluation_llm_name_rationale=evaluation_llm_name_rationale,
         evaluation_llm_name_accuracy=evaluation_llm_name_accuracy,
+        multi_metric_rationale=multi_metric_rationale,
+        adaptive_accuracy=adaptive_accuracy,
+        quality_threshold=quality_threshold,
+        early_stopping=early_stopping,
         console=console,
+        max_concurrency=max_concurrency,
+        adaptive_concurrency=adaptive_concurrency,
+        max_llm_concurrency=max_llm_concurrency,
+        rate_limits=rate_limits,
+        llm_cache=llm_cache,
+        user_input_corpus=user_input_corpus,
+        record=record,
+        replay=replay,
+        compare_app_managers=compare_app_managers,
+        on_early_stopping=early_stopping_results.append,
     )
+    if compare_prompts:
+        return process_comparison_result(
+            project_name=project_name,
+            prompts=prompt_names,
+            comparisons=simulation_result,
+            llm_name=llm_name,
+            size=size,
+            chat_mode=chat_mode,
+            temperature=temperature,
+            reason=reason,
+            reason_value=reason_value
+        )
     return process_simulation_result(
         project_name=project_name,
         simulations=simulation_result,
@@ -119,5 +206,6 @@ def spelltest_run_simulation(
         chat_mode=chat_mode,
         temperature=temperature,
         reason=reason,
-        reason_value=reason_value
+        reason_value=reason_value,
+        early_stopping=early_stopping_results[0] if early_stopping_results else None,
     )
\ No newline at end of file
@@ -1,4 +1,4 @@
-import copy
+import functools
 import os
 import asyncio
 import json
@@ -8,12 +8,24 @@ from typing import List
 from rich.progress import Progress, TextColumn, BarColumn
 from .ai_managers.chat_manager import ConversationState
 from .ai_managers.evaluation_manager import EvaluationManager
+from .ai_managers.tracing import promtelligence_tracing
 from .ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
+from .ai_managers.utils.concurrency import AdaptiveConcurrencyController, set_concurrency_controller
+from .ai_managers.utils.rate_limit import ModelRateLimiter, set_rate_limiter
+from .ai_managers.utils.llm_cache import LLMResponseCache, set_llm_cache
+from .ai_managers.utils.cassette import LLMCassette, CassetteMode, set_cassette
+from .ai_managers.utils.input_corpus import UserInputCorpus, set_input_corpus
+from .conversation_tree import conversation_prefixes
+from .early_stopping import SequentialEarlyStopping
+from .pipeline import run_two_stage_pipeline
 from .entities.general import Mode
 from .entities.managers import EvaluationResult
-from .entities.simulation import Simulation, ChatSimulationMessageStorage, CompletionSimulationMessageStorage
+from .entities.simulation import Simulation, SimulationComparison, ChatSimulationMessageStorage, \
+    CompletionSimulationMessageStorage
 
 CHAT_MAX_MESSAGES_DEFAULT = 6
+MAX_CONCURRENCY_DEFAULT = 10
+MAX_LLM_CONCURRENCY_DEFAULT = AdaptiveConcurrencyController.DEFAULT_MAX_CONCURRENCY
 SPELLFORGE_HOST = os.environ.get("SPELLFORGE_HOST", "http://spellforge.ai/")
 SPELLFORGE_API_KEY = os.environ.get("SPELLFORGE_API_KEY")
 
@@ -32,7 +44,42 @@ def spelltest_async_together(
     evaluation_llm_name_rationale,
     evaluation_llm_name_accuracy,
     console,
-) -> List[Simulation]:
+    multi_metric_rationale=False,
+    adaptive_accuracy=None,
+    quality_threshold=None,
+    early_stopping=None,
+    chat_mode_fork=None,
+    chat_mode_streaming_evaluation=None,
+    pipeline=None,
+    max_concurrency=MAX_CONCURRENCY_DEFAULT,
+    adaptive_concurrency=False,
+    max_llm_concurrency=MAX_LLM_CONCURRENCY_DEFAULT,
+    rate_limits=None,
+    llm_cache=None,
+    user_input_corpus=None,
+    record=None,
+    replay=None,
+    compare_app_managers=None,
+    on_early_stopping=None,
+) -> List[Simulation] or List[SimulationComparison]:
+    """
+    Runs the simulations, with `compare_app_managers` every simulation is run with `app_manager`
+    and each of them on the same user input, and the simulations are returned as comparisons.
+    With `early_stopping`, `on_early_stopping` is called with the settled `SequentialEarlyStopping` after the run.
+    """
+    if record and replay:
+        raise Exception("You can't record and replay a run at the same time")
+    if compare_app_managers:
+        if early_stopping is not None:
+            raise Exception("Early stopping settles one prompt, it can't be used when prompts are compared")
+        if chat_mode_fork is not None:
+            raise Exception("Forked conversations don't start from the same user input, "
+                            "they can't be used when prompts are compared")
+    if pipeline is not None and chat_mode_streaming_evaluation is not None:
+        raise Exception("Streaming evaluation already runs during generation, it can't be used with `pipeline`")
+    pipeline_stats = []
+    sequential_early_stopping = SequentialEarlyStopping(quality_threshold, **early_stopping) \
+        if early_stopping is not None else None
     progress = Progress(TextColumn("[progress.description]{task.description}"),
         BarColumn(),
         "[progress.percentage]{task.percentage:>3.0f}%",
@@ -40,36 +87,138 @@ def spelltest_async_together(
         TextColumn("[progress.completed]{task.completed} of {task.total}"),
         transient=True,)
     cost_calculation_manager = CostCalculationManager(console=console)
+    concurrency_controller = AdaptiveConcurrencyController(
+        initial_concurrency=max_llm_concurrency,
+        max_concurrency=max(max_llm_concurrency, 1),
+    ) if adaptive_concurrency else None
+    set_concurrency_controller(concurrency_controller)
+    set_rate_limiter(ModelRateLimiter(rate_limits) if rate_limits else None)
+    llm_response_cache = LLMResponseCache(**llm_cache) if llm_cache is not None else None
+    set_llm_cache(llm_response_cache)
+    input_corpus = UserInputCorpus(**user_input_corpus) if user_input_corpus is not None else None
+    if compare_app_managers:
+        # compared prompts are fed with the same inputs, a corpus pairs them even if none is configured
+        input_corpus = input_corpus or UserInputCorpus(path=None)
+    set_input_corpus(input_corpus)
+    if record or replay:
+        cassette = LLMCassette(record or replay, CassetteMode.RECORD if record else CassetteMode.REPLAY)
+    else:
+        cassette = None
+    set_cassette(cassette)
     with cost_calculation_manager.live:
         with progress:
             console.print("🚀 Starting simulations!", style="bold red")
-            simulations = _spelltest_async_together(
-                target_prompt,
-                app_manager,
-                user_persona_managers,
-                evaluation_manager,
-                size,
-                mode,
-                chat_mode_max_messages,
-                openai_api_key,
-                llm_name,
-                evaluation_llm_name,
-                evaluation_llm_name_perfect,
-                evaluation_llm_name_rationale,
-                evaluation_llm_name_accuracy,
-                progress
-            )
+            try:
+                simulations = _spelltest_async_together(
+                    target_prompt,
+                    app_manager,
+                    user_persona_managers,
+                    evaluation_manager,
+                    size,
+                    mode,
+                    chat_mode_max_messages,
+                    openai_api_key,
+                    llm_name,
+                    evaluation_llm_name,
+                    evaluation_llm_name_perfect,
+                    evaluation_llm_name_rationale,
+                    evaluation_llm_name_accuracy,
+                    progress,
+                    multi_metric_rationale=multi_metric_rationale,
+                    adaptive_accuracy=adaptive_accuracy,
+                    early_stopping=sequential_early_stopping,
+                    chat_mode_fork=chat_mode_fork,
+                    chat_mode_streaming_evaluation=chat_mode_streaming_evaluation,
+                    pipeline=pipeline,
+                    on_pipeline_stats=pipeline_stats.append,
+                    max_concurrency=max_concurrency,
+                    compare_app_managers=compare_app_managers,
+                )
+            finally:
+                set_concurrency_controller(None)
+                set_rate_limiter(None)
+                set_llm_cache(None)
+                if llm_response_cache:
+                    llm_response_cache.close()
+                set_input_corpus(None)
+                if input_corpus:
+                    input_corpus.close()
+                set_cassette(None)
+                if cassette:
+                    cassette.close()
             time.sleep(1)  # wait for 1 second
             console.clear()
             console.print(f"🏁 Simulations finished! You spent ${cost_calculation_manager.cost_usd}", style="bold green")
+            if concurrency_controller:
+                console.print(f"⚙️  LLM concurrency settled at {concurrency_controller.concurrency} in-flight calls "
+                              f"(peak {concurrency_controller.peak_concurrency}, "
+                              f"{concurrency_controller.rate_limit_errors} rate limit errors)", style="bold")
+            for stats in pipeline_stats:
+                console.print(f"🏭 Pipeline: generation {stats.generation.completed} transcripts "
+                              f"({stats.generation.throughput:.2f}/s, {stats.generation.workers} workers), "
+                              f"evaluation {stats.evaluation.completed} simulations "
+                              f"({stats.evaluation.throughput:.2f}/s, {stats.evaluation.workers} workers), "
+                              f"queue depth max {stats.max_queue_depth} of {stats.queue_size} "
+                              f"(mean {stats.mean_queue_depth:.1f}), "
+                              f"generation waited {stats.generation_wait_seconds:.1f}s for evaluation, "
+                              f"evaluation waited {stats.evaluation_wait_seconds:.1f}s for generation", style="bold")
+            if sequential_early_stopping:
+                if sequential_early_stopping.decision:
+                    lower, upper = sequential_early_stopping.confidence_interval
+                    console.print(f"⏹️  Early stopping: {sequential_early_stopping.decision} "
+                                  f"(mean accuracy in [{lower * 100:.1f}, {upper * 100:.1f}] "
+                                  f"with {sequential_early_stopping.confidence:.0%} confidence), "
+                                  f"used {len(simulations)} of {size * len(user_persona_managers)} simulations",
+                                  style="bold")
+                else:
+                    console.print(f"⏹️  Early stopping: the quality threshold was not settled, "
+                                  f"all {len(simulations)} simulations were used", style="bold")
+                if on_early_stopping is not None:
+                    on_early_stopping(sequential_early_stopping)
+            if input_corpus:
+                console.print(f"📚 User input corpus: {input_corpus.replayed} inputs replayed, "
+                              f"{input_corpus.generated} generated", style="bold")
+            if llm_response_cache:
+                console.print(f"💾 LLM cache: {llm_response_cache.hits} hits, {llm_response_cache.misses} misses",
+                              style="bold")
+            tracing_client = promtelligence_tracing.client
+            if tracing_client is not None and not tracing_client.ignore_tracing and tracing_client.exporter:
+                tracing_client.flush(tracing_client.EXIT_DRAIN_TIMEOUT_SECONDS)
+                usage_log_stats = tracing_client.usage_log_stats()
+                lost = usage_log_stats["failed"] + usage_log_stats["dropped"]
+                console.print(f"📤 Usage logs: {usage_log_stats['exported']} exported, "
+                              f"{usage_log_stats['failed']} failed, {usage_log_stats['dropped']} dropped, "
+                              f"{usage_log_stats['spilled']} spilled", style="bold red" if lost else "bold")
             return simulations
 
-async def _run_tasks_in_chunks(tasks, chunk_size):
-    """Run the provided tasks in chunks and collect their results."""
-    results = []
-    for i in range(0, len(tasks), chunk_size):
-        chunk = tasks[i:i + chunk_size]
-        results.extend(await asyncio.gather(*chunk))  # gather and collect results from the current chunk
+async def _run_tasks_in_window(task_factories, max_concurrency, on_result=None):
+    """
+    Run the provided task factories with at most `max_concurrency` of them in flight.
+    A new task is started as soon as any running one finishes, results keep the order of `task_factories`.
+    `on_result(result)` is called for every finished task, once it returns True no new task is started
+    (running ones still finish) and results of the tasks which never started are None.
+    """
+    results = [None] * len(task_factories)
+    pending = iter(enumerate(task_factories))
+    stopped = False
+
+    async def worker():
+        nonlocal stopped
+        # all workers share one iterator, so every task factory is picked up exactly once
+        for index, task_factory in pending:
+            if stopped:
+                break
+            results[index] = await task_factory()
+            if on_result is not None and on_result(results[index]):
+                stopped = True
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(max(max_concurrency, 1), len(task_factories)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker_task in workers:
+            worker_task.cancel()
+        raise
     return results
 
 def _spelltest_async_together(
@@ -87,34 +236,98 @@ def _spelltest_async_together(
         evaluation_llm_name_rationale,
         evaluation_llm_name_accuracy,
         progress,
-        max_concurrent_tasks=10
+        multi_metric_rationale=False,
+        adaptive_accuracy=None,
+        early_stopping=None,
+        chat_mode_fork=None,
+        chat_mode_streaming_evaluation=None,
+        pipeline=None,
+        on_pipeline_stats=None,
+        max_concurrency=MAX_CONCURRENCY_DEFAULT,
+        compare_app_managers=None,
 ):
     evaluation_llm_name = evaluation_llm_name if evaluation_llm_name else llm_name
+    if evaluation_manager:
+        evaluation_managers = [evaluation_manager] * len(user_persona_managers)
+    else:
+        # evaluation prompts depend on the persona, every persona gets its own manager (and chains)
+        evaluation_managers = [
+            EvaluationManager(
+                metric_definitions=user_persona_manager.metrics,
+                openai_api_key=openai_api_key,
+                synthetic_user_persona_manager=user_persona_manager,
+                llm_name_default=evaluation_llm_name,
+                llm_name_perfect=evaluation_llm_name_perfect if evaluation_llm_name_perfect else evaluation_llm_name,
+                llm_name_rationale=evaluation_llm_name_rationale if evaluation_llm_name_rationale else evaluation_llm_name,
+                llm_name_accuracy=evaluation_llm_name_accuracy if evaluation_llm_name_accuracy else evaluation_llm_name,
+                multi_metric_rationale=multi_metric_rationale,
+                adaptive_accuracy=adaptive_accuracy,
+            )
+            for user_persona_manager in user_persona_managers
+        ]
+    if mode is Mode.CHAT and chat_mode_fork is not None:
+        # every persona gets its own conversation trees
+        persona_conversation_prefixes = [
+            conversation_prefixes(size, chat_mode_fork["fork_after_messages"], chat_mode_fork["branches"])
+            for _ in user_persona_managers
+        ]
+    else:
+        persona_conversation_prefixes = [[None] * size for _ in user_persona_managers]
+    # compared prompts run one after another on every simulation, their simulations are grouped by position
+    variant_app_managers = [app_manager] + list(compare_app_managers or [])
     tasks = []
     for sim_num in range(size):
-        for user_persona_manager in user_persona_managers:
-            if not evaluation_manager:
-                evaluation_manager = EvaluationManager(
-                    metric_definitions=user_persona_manager.metrics,
-                    openai_api_key=openai_api_key,
-                    synthetic_user_persona_manager=user_persona_manager,
-                    llm_name_default=evaluation_llm_name,
-                    llm_name_perfect=evaluation_llm_name_perfect if evaluation_llm_name_perfect else evaluation_llm_name,
-                    llm_name_rationale=evaluation_llm_name_rationale if evaluation_llm_name_rationale else evaluation_llm_name,
-                    llm_name_accuracy=evaluation_llm_name_accuracy if evaluation_llm_name_accuracy else evaluation_llm_name,
-                )
-            console_render_task_id = progress.add_task(f"[cyan]Simulating({sim_num})...", total=3)
-            tasks.append(_asimulate(app_manager,
-                                    user_persona_manager,
-                                    evaluation_manager,
-                                    mode,
-                                    chat_mode_max_messages,
-                                    progress,
-                                    console_render_task_id,
-                                    sim_num
-                                    ))
+        for user_persona_manager, persona_evaluation_manager, prefixes in zip(
+                user_persona_managers, evaluation_managers, persona_conversation_prefixes):
+            for variant_app_manager in variant_app_managers:
+                console_render_task_id = progress.add_task(f"[cyan]Simulating({sim_num})...", total=3)
+                # in pipeline mode a task generates the transcript only and returns its evaluation stage
+                tasks.append(functools.partial(_agenerate if pipeline is not None else _asimulate,
+                                               variant_app_manager,
+                                               user_persona_manager,
+                                               persona_evaluation_manager,
+                                               mode,
+                                               chat_mode_max_messages,
+                                               progress,
+                                               console_render_task_id,
+                                               sim_num,
+                                               conversation_prefix=prefixes[sim_num],
+                                               streaming_evaluation=chat_mode_streaming_evaluation,
+                                               ))
     loop = asyncio.get_event_loop()
-    return loop.run_until_complete(_run_tasks_in_chunks(tasks, max_concurrent_tasks))
+    if pipeline is not None:
+        simulations, pipeline_stats = loop.run_until_complete(run_two_stage_pipeline(
+            tasks,
+            generation_concurrency=pipeline.get("generation_concurrency", max_concurrency),
+            evaluation_concurrency=pipeline.get("evaluation_concurrency", max_concurrency),
+            queue_size=pipeline.get("queue_size", pipeline.get("evaluation_concurrency", max_concurrency)),
+            on_result=early_stopping.add if early_stopping else None,
+        ))
+        if on_pipeline_stats is not None:
+            on_pipeline_stats(pipeline_stats)
+    else:
+        simulations = loop.run_until_complete(_run_tasks_in_window(
+            tasks,
+            max_concurrency,
+            on_result=early_stopping.add if early_stopping else None,
+        ))
+    if compare_app_managers:
+        return _group_comparisons(simulations, len(variant_app_managers))
+    # simulations cancelled by early stopping never ran
+    return [simulation for simulation in simulations if simulation is not None]
+
+def _group_comparisons(simulations, variants) -> List[SimulationComparison]:
+    """Simulations of the compared prompts on the same user input, in the order they were scheduled"""
+    comparisons = []
+    for start in range(0, len(simulations), variants):
+        compared_simulations = simulations[start:start + variants]
+        if any(simulation is None for simulation in compared_simulations):
+            continue
+        comparisons.append(SimulationComparison(
+            app_user_persona_id=compared_simulations[0].app_user_persona_id,
+            simulations=compared_simulations,
+        ))
+    return comparisons
 
 async def _asimulate(
         app_manager,
@@ -124,77 +337,224 @@ async def _asimulate(
         chat_mode_max_messages,
         progress,
         console_render_task_id,
-        sim_num
+        sim_num,
+        conversation_prefix=None,
+        streaming_evaluation=None,
 ):
-    evaluation_manager.disable_cost_tracker_layer()     # TODO: rewrite this
-    evaluation_manager = copy.deepcopy(evaluation_manager)
-    user_persona_manager = copy.deepcopy(user_persona_manager)
-    app_manager = copy.deepcopy(app_manager)
+    evaluate = await _agenerate(
+        app_manager,
+        user_persona_manager,
+        evaluation_manager,
+        mode,
+        chat_mode_max_messages,
+        progress,
+        console_render_task_id,
+        sim_num,
+        conversation_prefix=conversation_prefix,
+        streaming_evaluation=streaming_evaluation,
+    )
+    return await evaluate()
+
+async def _agenerate(
+        app_manager,
+        user_persona_manager,
+        evaluation_manager,
+        mode,
+        chat_mode_max_messages,
+        progress,
+        console_render_task_id,
+        sim_num,
+        conversation_prefix=None,
+        streaming_evaluation=None,
+):
+    """
+    Generation stage of a simulation, returns its evaluation stage:
+    a coroutine function which evaluates the generated transcript and returns the simulation.
+    """
+    # managers passed in are prototypes, every simulation gets its own state and shares chains and clients
+    evaluation_manager = evaluation_manager.spawn()
+    # the n-th simulation of the persona gets the n-th input of the corpus, compared prompts of it get the same one
+    user_persona_manager = user_persona_manager.spawn(input_corpus_slot=sim_num)
+    app_manager = app_manager.spawn()
     if mode is Mode.CHAT:
         progress.update(console_render_task_id, advance=1, description=f" Simulation {sim_num}, Step 2: [bold]Generating Chat[/bold] ⏳ ")
-        chat_history = await _generate_chat(app_manager, user_persona_manager, chat_mode_max_messages)
-        progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, Step 3: [bold]Evaluation[/bold] ⏳ ")
-        evaluation_manager.initialize_evaluation()
-        evaluations: List[EvaluationResult] = await evaluation_manager.evaluate_chat(
-            chat_history,
-            user_persona_manager
-        )
-        progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, [bold]Simulation completed[/bold] ✅ ")
-        return Simulation(
-            prompt_version_id=app_manager.target_prompt.promptelligence_params.db_version_id,
-            app_user_persona_id=user_persona_manager.user.db_id,
-            run_ids=[message.run_id for message in chat_history if message.run_id is not None],
-            length_complexity=0.0,   # TODO
-            chat_id=user_persona_manager.chat_id,
-            evaluations=evaluations,
-            granular_evaluation=False,
-            message_storage=ChatSimulationMessageStorage(
-                chat_history=chat_history,
-                perfect_chat_history=evaluation_manager.perfect_chat_history
-                if hasattr(evaluation_manager, "perfect_chat_history") else None,
+        evaluation_task = None
+        if streaming_evaluation is not None:
+            # messages are evaluated while the rest of the chat is being generated
+            evaluation_manager.initialize_evaluation()
+            message_queue = asyncio.Queue()
+            evaluation_task = asyncio.ensure_future(
+                evaluation_manager.evaluate_chat_stream(message_queue, user_persona_manager, **streaming_evaluation)
             )
-        )
+            try:
+                app_manager, user_persona_manager, chat_history = await _generate_chat(
+                    app_manager,
+                    user_persona_manager,
+                    chat_mode_max_messages,
+                    conversation_prefix=conversation_prefix,
+                    message_queue=message_queue,
+                )
+            except BaseException:
+                evaluation_task.cancel()
+                raise
+            message_queue.put_nowait(None)
+        else:
+            app_manager, user_persona_manager, chat_history = await _generate_chat(
+                app_manager,
+                user_persona_manager,
+                chat_mode_max_messages,
+                conversation_prefix=conversation_prefix,
+            )
+        return functools.partial(_aevaluate_chat,
+                                 app_manager,
+                                 user_persona_manager,
+                                 evaluation_manager,
+                                 chat_history,
+                                 progress,
+                                 console_render_task_id,
+                                 sim_num,
+                                 conversation_prefix=conversation_prefix,
+                                 evaluation_task=evaluation_task,
+                                 )
     elif mode is Mode.RAW_COMPLETION:
         progress.update(console_render_task_id, advance=0, description=f" Simulation {sim_num}, Step 2: [bold]Generating Completion[/bold] ⏳ ")
         prompt, completion = await _generate_raw_completion(app_manager, user_persona_manager)
-        progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, Step 3: [bold]Evaluation[/bold] ⏳ ")
+        return functools.partial(_aevaluate_raw_completion,
+                                 app_manager,
+                                 user_persona_manager,
+                                 evaluation_manager,
+                                 prompt,
+                                 completion,
+                                 progress,
+                                 console_render_task_id,
+                                 sim_num,
+                                 )
+    else:
+        raise Exception(f"Unexpected mode: {mode}")
+
+async def _aevaluate_chat(
+        app_manager,
+        user_persona_manager,
+        evaluation_manager,
+        chat_history,
+        progress,
+        console_render_task_id,
+        sim_num,
+        conversation_prefix=None,
+        evaluation_task=None,
+):
+    progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, Step 3: [bold]Evaluation[/bold] ⏳ ")
+    if evaluation_task is None:
         evaluation_manager.initialize_evaluation()
-        evaluations: List[EvaluationResult] = await evaluation_manager.evaluate_raw_completion(
-            prompt,
-            completion,
-            user_persona_manager)
-        progress.update(console_render_task_id, advance=2, description=f"Simulation {sim_num}, [bold]Simulatoin completed[/bold] ✅ ")
-        return Simulation(
-            prompt_version_id=app_manager.prompt_version_id,
-            app_user_persona_id=user_persona_manager.user.db_id,
-            run_ids=[prompt.run_id, completion.run_id],
-            length_complexity=0.0,  # TODO
-            chat_id=None,
-            evaluations=evaluations,
-            granular_evaluation=False,
-            message_storage=CompletionSimulationMessageStorage(
-                prompt=prompt,
-                completion=completion,
-                perfect_completion=evaluation_manager.perfect_completion
-                if hasattr(evaluation_manager, "perfect_completion") else None,
-            )
+        evaluations: List[EvaluationResult] = await evaluation_manager.evaluate_chat(
+            chat_history,
+            user_persona_manager
         )
     else:
-        raise Exception(f"Unexpected mode: {mode}")
+        # streaming evaluation started during generation
+        evaluations: List[EvaluationResult] = await evaluation_task
+    progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, [bold]Simulation completed[/bold] ✅ ")
+    return Simulation(
+        prompt_version_id=app_manager.target_prompt.promptelligence_params.db_version_id,
+        app_user_persona_id=user_persona_manager.user.db_id,
+        run_ids=[message.run_id for message in chat_history if message.run_id is not None],
+        length_complexity=0.0,   # TODO
+        chat_id=user_persona_manager.chat_id,
+        evaluations=evaluations,
+        failed_metrics=getattr(evaluation_manager, "failed_metrics", None),
+        granular_evaluation=False,
+        prefix_id=conversation_prefix.prefix_id if conversation_prefix else None,
+        message_storage=ChatSimulationMessageStorage(
+            chat_history=chat_history,
+            perfect_chat_history=evaluation_manager.perfect_chat_history
+            if hasattr(evaluation_manager, "perfect_chat_history") else None,
+        )
+    )
 
+async def _aevaluate_raw_completion(
+        app_manager,
+        user_persona_manager,
+        evaluation_manager,
+        prompt,
+        completion,
+        progress,
+        console_render_task_id,
+        sim_num,
+):
+    progress.update(console_render_task_id, advance=1, description=f"Simulation {sim_num}, Step 3: [bold]Evaluation[/bold] ⏳ ")
+    evaluation_manager.initialize_evaluation()
+    evaluations: List[EvaluationResult] = await evaluation_manager.evaluate_raw_completion(
+        prompt,
+        completion,
+        user_persona_manager)
+    progress.update(console_render_task_id, advance=2, description=f"Simulation {sim_num}, [bold]Simulatoin completed[/bold] ✅ ")
+    return Simulation(
+        prompt_version_id=app_manager.prompt_version_id,
+        app_user_persona_id=user_persona_manager.user.db_id,
+        # inputs generated in bulk share one run, only one of them has it as its own
+        run_ids=[message.run_id for message in (prompt, completion) if message.run_id is not None],
+        length_complexity=0.0,  # TODO
+        chat_id=None,
+        evaluations=evaluations,
+        failed_metrics=getattr(evaluation_manager, "failed_metrics", None),
+        granular_evaluation=False,
+        message_storage=CompletionSimulationMessageStorage(
+            prompt=prompt,
+            completion=completion,
+            perfect_completion=evaluation_manager.perfect_completion
+            if hasattr(evaluation_manager, "perfect_completion") else None,
+        )
+    )
 
-async def _generate_chat(app_chat_manager, user_persona_manager, max_messages):
-    app_message = await app_chat_manager.initialize_conversation()
-    user_message = await user_persona_manager.initialize_conversation(app_message)
-    message_count = 0
+
+async def _generate_chat(app_chat_manager, user_persona_manager, max_messages, conversation_prefix=None,
+                         message_queue=None):
+    """
+    Returns the managers which generated the conversation and the conversation.
+    With `conversation_prefix` the conversation continues a fork of the shared prefix instead of starting from scratch.
+    With `message_queue` every message is put into the queue as soon as its exchange is over.
+    """
     if not max_messages:
         max_messages = CHAT_MAX_MESSAGES_DEFAULT
+    published_messages = 0
+
+    def publish_messages():
+        nonlocal published_messages
+        if message_queue is not None:
+            for message in user_persona_manager.chat_history[published_messages:]:
+                message_queue.put_nowait(message)
+            published_messages = len(user_persona_manager.chat_history)
+
+    if conversation_prefix is None:
+        user_message = await _start_chat(app_chat_manager, user_persona_manager)
+        message_count = 0
+    else:
+        async def generate_prefix():
+            prefix_user_message = await _start_chat(app_chat_manager, user_persona_manager)
+            prefix_messages = min(conversation_prefix.fork_after_messages, max_messages)
+            return (app_chat_manager, user_persona_manager) + await _exchange_messages(
+                app_chat_manager, user_persona_manager, prefix_user_message, 0, prefix_messages)
+        app_chat_manager, user_persona_manager, user_message, message_count = \
+            await conversation_prefix.fork(generate_prefix)
+    publish_messages()
+    await _exchange_messages(app_chat_manager, user_persona_manager, user_message, message_count, max_messages,
+                             on_exchange=publish_messages)
+    return app_chat_manager, user_persona_manager, user_persona_manager.chat_history  # TODO: make local history implementation in order to not count on custom implementations
+
+async def _start_chat(app_chat_manager, user_persona_manager):
+    app_message = await app_chat_manager.initialize_conversation()
+    return await user_persona_manager.initialize_conversation(app_message)
+
+async def _exchange_messages(app_chat_manager, user_persona_manager, user_message, message_count, max_messages,
+                             on_exchange=None):
     # Continuously call "next_message" function between two sides until UserPersonaManager decides that conversation is over
     while user_persona_manager.conversation_state() is not ConversationState.FINISHED and message_count < max_messages:
         app_message = await app_chat_manager.next_message(user_message)
         user_message = await user_persona_manager.next_message(app_message)
         message_count+=2
-    return user_persona_manager.chat_history  # TODO: make local history implementation in order to not count on custom implementations
+        if on_exchange is not None:
+            on_exchange()
+    return user_message, message_count
 
 async def _generate_raw_completion(app_completion_manager, user_persona_manager):
     user_input_message = await user_persona_manager.generate_user_input()
@@ -0,0 +1,251 @@
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qsl
+
+
+class TracingServerStore:
+    """Records of every resource of the tracing API kept as JSON in one SQLite table"""
+
+    def __init__(self, path: str = ":memory:"):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, resource TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS records_resource ON records (resource, id)")
+        self._connection.commit()
+
+    def create(self, resource: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        return self.create_many(resource, [data])[0]
+
+    def create_many(self, resource: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with self._lock:
+            created = []
+            for data in items:
+                cursor = self._connection.execute(
+                    "INSERT INTO records (resource, data) VALUES (?, ?)", (resource, json.dumps(data))
+                )
+                created.append({**data, "id": cursor.lastrowid})
+            self._connection.commit()
+            return created
+
+    def filter(self, resource: str, filters: Dict[str, str] = None, latest: bool = False) -> List[Dict[str, Any]]:
+        """Records whose fields equal the filters (compared as text), `latest` returns the newest one only"""
+        query = "SELECT id, data FROM records WHERE resource = ?"
+        params = [resource]
+        for key, value in (filters or {}).items():
+            query += " AND CAST(json_extract(data, '$.' || ?) AS TEXT) = ?"
+            params += [key, value]
+        query += " ORDER BY id DESC LIMIT 1" if latest else " ORDER BY id"
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [{**json.loads(data), "id": record_id} for record_id, data in rows]
+
+    def get(self, resource: str, record_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM records WHERE resource = ? AND id = ?", (resource, record_id)
+            ).fetchone()
+        return {**json.loads(row[0]), "id": record_id} if row else None
+
+    def update(self, resource: str, record_id: int, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        record = self.get(resource, record_id)
+        if record is None:
+            return None
+        record.update(changes)
+        record["id"] = record_id
+        with self._lock:
+            self._connection.execute("UPDATE records SET data = ? WHERE id = ?", (json.dumps(record), record_id))
+            self._connection.commit()
+        return record
+
+    def delete(self, resource: str, record_id: int) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM records WHERE resource = ? AND id = ?", (resource, record_id)
+            )
+            self._connection.commit()
+        return cursor.rowcount > 0
+
+    def count(self, resource: str) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM records WHERE resource = ?", (resource,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class TracingServer:
+    """
+    Local stand-in for the tracing backend (projects, prompts and their versions, usage logs,
+    app user personas and metric definitions), for load tests and offline development.
+    Every request waits `latency_seconds` (plus up to `latency_jitter_seconds`) and fails with 503
+    with probability `error_rate`, so the tracing path can be tested against a slow or failing backend.
+    """
+    RESOURCES = [
+        "projects",
+        "prompts",
+        "prompt-versions",
+        "prompt-version-usage-logs",
+        "llm-usage-logs",
+        "app-user-personas",
+        "metric-definitions",
+    ]
+    DEFAULT_DB_PATH = os.path.join(".spelltest_cache", "tracing_server.sqlite")
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8000,
+                 db_path: str = DEFAULT_DB_PATH,
+                 latency_seconds: float = 0.0,
+                 latency_jitter_seconds: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: int = None,
+                 verbose: bool = False,
+                 ):
+        if not 0 <= error_rate <= 1:
+            raise ValueError(f"Unexpected tracing server error rate: {error_rate}")
+        self.store = TracingServerStore(db_path)
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.requests = 0
+        self.injected_errors = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._http_server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._http_server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self):
+        self._http_server.serve_forever()
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="spelltest-tracing-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.store.close()
+
+    def _inject(self) -> bool:
+        """Wait for the injected latency, returns True if the request has to fail"""
+        with self._random_lock:
+            self.requests += 1
+            delay = self.latency_seconds + self._random.uniform(0, self.latency_jitter_seconds)
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.injected_errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: Any) -> Tuple[int, Any]:
+        """Response status and JSON body of an API request"""
+        match = re.fullmatch(r"/api/([a-z-]+)/(?:(\d+|latest|bulk)/)?(?:(latest)/)?", path)
+        if not match or match.group(1) not in self.RESOURCES:
+            return 404, {"detail": "Not found."}
+        resource, item, sub_item = match.groups()
+        if item is None:
+            if method == "GET":
+                return 200, self.store.filter(resource, query)
+            if method == "POST":
+                if not isinstance(body, dict):
+                    return 400, {"detail": "A JSON object is expected."}
+                return 201, self.store.create(resource, body)
+        elif item == "bulk":
+            if method == "POST":
+                if not isinstance(body, list):
+                    return 400, {"detail": "A JSON list is expected."}
+                return 201, self.store.create_many(resource, body)
+        elif resource == "prompt-versions" and item == "latest":
+            if method == "GET":
+                # latest version of every prompt of the project
+                versions = []
+                for prompt in self.store.filter("prompts", {"project_id": query.get("project_id", "")}):
+                    versions += self.store.filter(resource, {"prompt_id": str(prompt["id"])}, latest=True)
+                return 200, versions
+        elif resource == "prompt-versions" and sub_item == "latest":
+            if method == "GET":
+                versions = self.store.filter(resource, {"prompt_id": item}, latest=True)
+                return (200, versions[0]) if versions else (404, {"detail": "Not found."})
+        elif item.isdigit() and sub_item is None:
+            if method == "GET":
+                record = self.store.get(resource, int(item))
+                return (200, record) if record else (404, {"detail": "Not found."})
+            if method == "PATCH":
+                if body is not None and not isinstance(body, dict):
+                    return 400, {"detail": "A JSON object is expected."}
+                record = self.store.update(resource, int(item), body or {})
+                return (200, record) if record else (404, {"detail": "Not found."})
+            if method == "DELETE":
+                return (204, None) if self.store.delete(resource, int(item)) else (404, {"detail": "Not found."})
+        else:
+            return 404, {"detail": "Not found."}
+        return 405, {"detail": f"Method \"{method}\" not allowed."}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def do_PATCH(self):
+                self._respond("PATCH")
+
+            def do_DELETE(self):
+                self._respond("DELETE")
+
+            def _respond(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                if server._inject():
+                    status, body = 503, {"detail": "Injected error."}
+                else:
+                    try:
+                        status, body = server.handle(
+                            method, url.path, dict(parse_qsl(url.query)), json.loads(raw_body) if raw_body else None
+                        )
+                    except ValueError:
+                        status, body = 400, {"detail": "Malformed JSON."}
+                payload = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                if server.verbose:
+                    super().log_message(format, *args)
+
+        return Handler
@@ -1,12 +1,20 @@
+import functools
 import math
 import string
+from collections import deque
 from enum import Enum
 from pathlib import Path
 
+import jinja2
+
 from spelltest.entities.managers import MessageType
+from spelltest.entities.synthetic_user import SyntheticUser
 
 THIS_DIRECTORY = Path(__file__).parent.absolute()
 TEMPLATE_DIRECTORY = THIS_DIRECTORY / "prompts"
+JINJA2_TEMPLATE_CACHE_SIZE = 256
+
+_loaded_prompts = {}   # path -> (mtime, text), see `load_prompt`
 
 
 def calculate_accuracy(quality_evaluations):
@@ -23,8 +31,33 @@ def calculate_deviation_factor(quality_evaluations):
 
 
 def load_prompt(template):
+    """Text of the prompt file, read from disk only when the file is new or changed since the last call"""
     file_destination = TEMPLATE_DIRECTORY / template
-    return file_destination.read_text()
+    mtime = file_destination.stat().st_mtime_ns
+    loaded_prompt = _loaded_prompts.get(file_destination)
+    if loaded_prompt is None or loaded_prompt[0] != mtime:
+        loaded_prompt = (mtime, file_destination.read_text())
+        _loaded_prompts[file_destination] = loaded_prompt
+    return loaded_prompt[1]
+
+
+@functools.lru_cache(maxsize=JINJA2_TEMPLATE_CACHE_SIZE)
+def compile_jinja2_template(source):
+    """Compiled template, shared by every prompt with the same source (changed prompt files get a new entry)"""
+    return jinja2.Template(source)
+
+
+def render_jinja2_template(source, **kwargs):
+    return compile_jinja2_template(source).render(**kwargs)
+
+
+def render_persona_prompt(user, pre_prompt, **kwargs):
+    """Text of the persona specific `pre_prompt`, rendered once per `SyntheticUser` and input variables"""
+    def render():
+        return pre_prompt.format_prompt(**kwargs).text
+    if isinstance(user, SyntheticUser):
+        return user.rendered_prompt(pre_prompt.template, render, kwargs)
+    return render()
 
 
 def extract_fields(s):
@@ -32,20 +65,49 @@ def extract_fields(s):
     return [field_name for _, field_name, _, _ in formatter.parse(s) if field_name]
 
 
-def prep_history(chat_history):
-    history_strings_list = []
-    for message in chat_history:
-        if type(message.author) is MessageType.ASSISTANT:
-            history_strings_list.append(
-                f"> AI:\n {message.text}"
-            )
-        elif type(message.author) is MessageType.USER:
-            history_strings_list.append(
-                f">> Human:\n {message.text}"
-            )
-    if len(history_strings_list) > 3:
-        history_strings_list = history_strings_list[-3:]
-    return "\n".join(history_strings_list)
+class RollingHistory:
+    """
+    Last `window` messages of a conversation, formatted for chat prompts once, when they are appended.
+    Managers append every message, so rendering the history doesn't walk the whole conversation.
+    """
+    DEFAULT_WINDOW = 6
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        if window < 0:
+            raise ValueError(f"Unexpected history window: {window}")
+        self.window = window
+        self.turns = deque(maxlen=window)
+
+    @staticmethod
+    def format_message(message):
+        if message.author is MessageType.ASSISTANT:
+            return f"> AI:\n {message.text}"
+        if message.author is MessageType.USER:
+            return f">> Human:\n {message.text}"
+        return None   # system messages are not a part of the conversation
+
+    def append(self, message):
+        turn = self.format_message(message)
+        if turn is not None and self.window:
+            self.turns.append(turn)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def text(self) -> str:
+        return "\n".join(self.turns)
+
+    def copy(self) -> "RollingHistory":
+        history = RollingHistory(self.window)
+        history.turns.extend(self.turns)
+        return history
+
+
+def prep_history(chat_history, window=RollingHistory.DEFAULT_WINDOW):
+    history = RollingHistory(window)
+    history.extend(chat_history)
+    return history.text()
 
 # Define a custom encoder function to handle enums
 def enum_encoder(obj):
@@ -4,18 +4,20 @@ import os
 import yaml
 from spelltest.entities.metric import MetricDefinition
 from spelltest.spelltest import spelltest_run_simulation, SyntheticUser, SyntheticUserParams  # update module name
+from spelltest.spelltest_execution import MAX_CONCURRENCY_DEFAULT, MAX_LLM_CONCURRENCY_DEFAULT
+from spelltest.utils import RollingHistory
 
 def parse_config(filename: str = ".spellforge.yaml"):
     with open(filename, 'r') as file:
         return yaml.load(file, Loader=yaml.FullLoader)
-def run_yaml_tests(yaml_config_file=None):
+def run_yaml_tests(yaml_config_file=None, record=None, replay=None):
     if yaml_config_file:
         config = parse_config(yaml_config_file)
     else:
         config = parse_config()
-    return run_from_config(config)
+    return run_from_config(config, record=record, replay=replay)
 
-def run_from_config(config, prompt_text=None):
+def run_from_config(config, prompt_text=None, record=None, replay=None):
     defined_metrics = {
         name: MetricDefinition(name=name, definition=metric["definition"])
         for name, metric in config["metrics"].items()
@@ -27,6 +29,13 @@ def run_from_config(config, prompt_text=None):
             with open(prompt_file, 'r') as file:
                 prompt_text = file.read()
 
+        # prompts compared with the simulation prompt (the baseline) on the same user inputs
+        compare_prompt_names = simulation_config.get("compare", [])
+        compare_prompts = []
+        for compare_prompt_name in compare_prompt_names:
+            with open(config["prompts"][compare_prompt_name]["file"], 'r') as file:
+                compare_prompts.append(file.read())
+
         user_names = simulation_config["users"]
         if user_names == "__all__":
             user_names = config["users"].keys()
@@ -65,6 +74,28 @@ def run_from_config(config, prompt_text=None):
             temperature=simulation_config["temperature"],
             size=simulation_config["size"],
             chat_mode=simulation_config["chat_mode"],
+            chat_mode_history_window=simulation_config.get("chat_mode_history_window", RollingHistory.DEFAULT_WINDOW),
+            chat_mode_welcome_messages=simulation_config.get("chat_mode_welcome_messages"),
+            chat_mode_fork=simulation_config.get("chat_mode_fork"),
+            chat_mode_streaming_evaluation=simulation_config.get("chat_mode_streaming_evaluation"),
+            pipeline=simulation_config.get("pipeline"),
+            bulk_user_inputs=simulation_config.get("bulk_user_inputs"),
+            multi_metric_rationale=simulation_config.get("multi_metric_rationale", False),
+            adaptive_accuracy=simulation_config.get("adaptive_accuracy"),
+            quality_threshold=simulation_config.get("quality_threshold"),
+            early_stopping=simulation_config.get("early_stopping"),
+            max_concurrency=simulation_config.get("max_concurrency", MAX_CONCURRENCY_DEFAULT),
+            adaptive_concurrency=simulation_config.get("adaptive_concurrency", False),
+            max_llm_concurrency=simulation_config.get("max_llm_concurrency", MAX_LLM_CONCURRENCY_DEFAULT),
+            # an empty `rate_limits:` key is parsed as None
+            rate_limits={**(config.get("rate_limits") or {}), **(simulation_config.get("rate_limits") or {})},
+            llm_cache=simulation_config.get("llm_cache", config.get("llm_cache")),
+            user_input_corpus=simulation_config.get("user_input_corpus", config.get("user_input_corpus")),
+            compare_prompts=compare_prompts or None,
+            prompt_names=[simulation_config.get("prompt", "prompt")] + list(compare_prompt_names)
+            if compare_prompts else None,
+            record=record,
+            replay=replay,
             openai_api_key=os.environ.get("OPENAI_API_KEY"),  # or your way of fetching API key
             # ... any other config parameters
         )
\ No newline at end of file
@@ -0,0 +1,147 @@
+import asyncio
+import pytest
+from rich.console import Console
+from langchain import PromptTemplate
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.utils.cassette import LLMCassette, CassetteMode, CassetteMissError, set_cassette
+from spelltest.ai_managers.utils.chain import CustomLLMChain
+from spelltest.ai_managers.chat_manager import AIModelDefaultChatManager, SyntheticUserChatManager
+from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient
+from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
+from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
+
+tracing = PromptelligenceClient(ignore=True)
+cost_calculation_manager = CostCalculationManager(console=Console())
+
+
+class StaticFakeListLLM(FakeListLLM):
+    """Fake LLM which params do not depend on responses"""
+
+    @property
+    def _identifying_params(self):
+        return {}
+
+
+class FailingFakeListLLM(StaticFakeListLLM):
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        raise Exception("Replay must not call LLM")
+
+
+class CountingHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.prompts = []
+        self.completions = []
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.prompts.extend(prompts)
+
+    def on_llm_end(self, response, **kwargs):
+        self.completions.extend(generation.text for generations in response.generations for generation in generations)
+
+
+def _chain(llm):
+    return CustomLLMChain(llm=llm, prompt=PromptTemplate(template="Say {input}", input_variables=["input"]))
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "run.cassette.jsonl")
+    recording_cassette = LLMCassette(path, CassetteMode.RECORD)
+    set_cassette(recording_cassette)
+    recording_handler = CountingHandler()
+    try:
+        chain = _chain(StaticFakeListLLM(responses=["first", "second"]))
+        recorded = [await chain.arun(input="hello", callbacks=[recording_handler]) for _ in range(2)]
+    finally:
+        set_cassette(None)
+        recording_cassette.close()
+
+    set_cassette(LLMCassette(path, CassetteMode.REPLAY))
+    replaying_handler = CountingHandler()
+    try:
+        chain = _chain(FailingFakeListLLM(responses=["never"]))
+        replayed = [await chain.arun(input="hello", callbacks=[replaying_handler]) for _ in range(2)]
+        with pytest.raises(CassetteMissError):
+            await chain.arun(input="hello")
+        with pytest.raises(CassetteMissError):
+            await chain.arun(input="bye")
+    finally:
+        set_cassette(None)
+
+    assert [response["text"] for response in replayed] == ["first", "second"]
+    assert [response["__run"].run_id for response in replayed] == [response["__run"].run_id for response in recorded]
+    assert replaying_handler.prompts == recording_handler.prompts == ["Say hello", "Say hello"]
+    assert replaying_handler.completions == recording_handler.completions == ["first", "second"]
+
+
+@pytest.mark.asyncio
+async def test_record_replaces_previous_recording(tmp_path):
+    path = str(tmp_path / "run.cassette.jsonl")
+    for response in ["old", "new"]:
+        recording_cassette = LLMCassette(path, CassetteMode.RECORD)
+        set_cassette(recording_cassette)
+        try:
+            await _chain(StaticFakeListLLM(responses=[response])).arun(input="hello")
+        finally:
+            set_cassette(None)
+            recording_cassette.close()
+
+    set_cassette(LLMCassette(path, CassetteMode.REPLAY))
+    try:
+        replayed = await _chain(FailingFakeListLLM(responses=["never"])).arun(input="hello")
+    finally:
+        set_cassette(None)
+    assert replayed["text"] == "new"
+
+
+def test_cassette_unexpected_mode(tmp_path):
+    with pytest.raises(ValueError):
+        LLMCassette(str(tmp_path / "run.cassette.jsonl"), "rewind")
+
+
+async def _start_conversations(app_llm, user_llm, conversations):
+    app_prototype = AIModelDefaultChatManager("test prompt", "gpt-3.5-turbo", "test_key", welcome_message_pool_size=2,
+                                              role="AI", opposite_role="Human")
+    app_prototype.chain = CustomLLMChain(llm=app_llm, prompt=app_prototype.system_prompt)
+    user = SyntheticUser(
+        name="name",
+        params=SyntheticUserParams(temperature=0.7, llm_name="some_llm", description="test user",
+                                   expectation="hello", user_knowledge_about_app="app knowledge"),
+        metrics=[MetricDefinition(name="metric1", definition="definition1")],
+    )
+    user_prototype = SyntheticUserChatManager(user, "test_key")
+    user_prototype.chain = CustomLLMChain(llm=user_llm, prompt=user_prototype.system_prompt)
+
+    async def conversation():
+        app_manager, user_manager = app_prototype.spawn(), user_prototype.spawn()
+        welcome_message = await app_manager.initialize_conversation()
+        user_message = await user_manager.initialize_conversation(welcome_message)
+        return welcome_message.text, user_message.text
+
+    return await asyncio.gather(*[conversation() for _ in range(conversations)])
+
+
+@pytest.mark.asyncio
+async def test_replay_with_welcome_message_pool_smaller_than_conversations(tmp_path):
+    path = str(tmp_path / "run.cassette.jsonl")
+    recording_cassette = LLMCassette(path, CassetteMode.RECORD)
+    set_cassette(recording_cassette)
+    try:
+        recorded = await _start_conversations(StaticFakeListLLM(responses=["hello", "hi"]),
+                                              StaticFakeListLLM(responses=["a", "b", "c", "d", "e"]),
+                                              conversations=5)
+    finally:
+        set_cassette(None)
+        recording_cassette.close()
+
+    set_cassette(LLMCassette(path, CassetteMode.REPLAY))
+    try:
+        replayed = await _start_conversations(FailingFakeListLLM(responses=["never"]),
+                                              FailingFakeListLLM(responses=["never"]),
+                                              conversations=5)
+    finally:
+        set_cassette(None)
+
+    assert sorted(welcome for welcome, _ in recorded) == ["hello", "hello", "hello", "hi", "hi"]
+    assert sorted(replayed) == sorted(recorded)
@@ -1,14 +1,19 @@
+import asyncio
 import os
 import pytest
+from rich.console import Console
 from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
 from spelltest.entities.managers import Message, MessageType
 from spelltest.ai_managers.chat_manager import SyntheticUserChatManager, AIModelDefaultChatManager, \
-    CustomConversationChain
+    CustomConversationChain, CustomLLMChain
 from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient
+from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.llms.fake import FakeListLLM
 
 IGNORE_DATA_COLLECTING = bool(os.environ.get("IGNORE_DATA_COLLECTING", "True"))
 tracing = PromptelligenceClient(ignore=IGNORE_DATA_COLLECTING)
+cost_calculation_manager = CostCalculationManager(console=Console())
 
 # TODO: test that we control number of messages
 
@@ -108,4 +113,78 @@ async def test_next_message_default_chat_manager():
     app_response = await manager.next_message(user_message)
 
     assert app_response.author == MessageType.ASSISTANT
-    assert app_response.text in responses
\ No newline at end of file
+    assert app_response.text in responses
+
+@pytest.mark.asyncio
+async def test_spawn_shares_chain_and_isolates_state():
+    user_params = SyntheticUserParams(
+        temperature=0.7,
+        llm_name="some_llm",
+        description="test user",
+        expectation="hello",
+        user_knowledge_about_app="app knowledge"
+    )
+    user = SyntheticUser(name="name", params=user_params, metrics=[MetricDefinition(name="metric1", definition="definition1")])
+    prototype = SyntheticUserChatManager(user, "test_key")
+    llm = FakeListLLM(responses=["Bla bla bla"], model_name=user.params.llm_name)
+    prototype.chain = CustomConversationChain(llm=llm, prompt=prototype.system_prompt)
+
+    first, second = prototype.spawn(), prototype.spawn()
+    await first.initialize_conversation(Message(author=MessageType.ASSISTANT, text="Hi!"))
+
+    assert first.chain is second.chain is prototype.chain
+    assert len(first.chat_history) == 2
+    assert second.chat_history == prototype.chat_history == []
+    assert len({first.chat_id, second.chat_id, prototype.chat_id}) == 3
+
+
+def test_spawn_default_chat_manager_gets_own_history():
+    prototype = AIModelDefaultChatManager("test prompt", "gpt-3.5-turbo", "test_key", history_window=4,
+                                          role="AI", opposite_role="Human")
+    manager = prototype.spawn()
+
+    assert manager.chain is prototype.chain
+    assert manager.history is not prototype.history
+    assert manager.history.window == 4
+
+
+class _PromptRecorder(BaseCallbackHandler):
+    def __init__(self):
+        self.prompts = []
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.prompts += prompts
+
+
+@pytest.mark.asyncio
+async def test_default_chat_manager_sends_rolling_history():
+    manager = AIModelDefaultChatManager("test prompt", "gpt-3.5-turbo", "test_key", history_window=2,
+                                        role="AI", opposite_role="Human")
+    recorder = _PromptRecorder()
+    manager.chain = CustomLLMChain(llm=FakeListLLM(responses=["welcome", "first", "second"], callbacks=[recorder]),
+                                   prompt=manager.system_prompt)
+    await manager.initialize_conversation()
+    await manager.next_message(Message(author=MessageType.USER, text="one"))
+    await manager.next_message(Message(author=MessageType.USER, text="two"))
+
+    assert recorder.prompts == [
+        manager.system_prompt.format(history="", input=manager.USER_PSEUDO_REQUEST_FOR_APP_WELCOME_MESSAGE),
+        manager.system_prompt.format(history="> AI:\n welcome", input="one"),
+        manager.system_prompt.format(history=">> Human:\n one\n> AI:\n first", input="two"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_welcome_message_pool_is_generated_once():
+    prototype = AIModelDefaultChatManager("test prompt", "gpt-3.5-turbo", "test_key", welcome_message_pool_size=2,
+                                          role="AI", opposite_role="Human")
+    llm = FakeListLLM(responses=["hello", "hi"])
+    prototype.chain = CustomLLMChain(llm=llm, prompt=prototype.system_prompt)
+
+    managers = [prototype.spawn() for _ in range(5)]
+    welcome_messages = await asyncio.gather(*[manager.initialize_conversation() for manager in managers])
+
+    assert llm.i == 2
+    assert {message.text for message in welcome_messages} <= {"hello", "hi"}
+    assert all(manager.chat_history[-1] is message for manager, message in zip(managers, welcome_messages))
+    assert len({id(message) for message in welcome_messages}) == 5
@@ -0,0 +1,113 @@
+import asyncio
+import json
+from unittest.mock import Mock
+import pytest
+from rich.console import Console
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
+from spelltest.ai_managers.raw_completion_manager import SyntheticUserCompletionManager, CustomLLMChain
+from spelltest.ai_managers.utils.input_corpus import UserInputCorpus, set_input_corpus
+from spelltest.comparison import PairedComparison
+from spelltest.entities.simulation import SimulationComparison
+from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
+from spelltest.result_processing import ProcessComparisonResult
+from spelltest.spelltest import spelltest_run_simulation
+from spelltest.spelltest_execution import _group_comparisons
+
+cost_calculation_manager = CostCalculationManager(console=Console())
+
+
+def _simulation(*accuracies):
+    return Mock(evaluations=[Mock(accuracy=accuracy) for accuracy in accuracies], app_user_persona_id=1)
+
+
+def _comparisons(baseline_accuracies, variant_accuracies):
+    return [
+        SimulationComparison(app_user_persona_id=1, simulations=[_simulation(baseline), _simulation(variant)])
+        for baseline, variant in zip(baseline_accuracies, variant_accuracies)
+    ]
+
+
+def test_paired_comparison_detects_consistent_improvement():
+    # inputs differ a lot in difficulty, the variant is a bit better on every one of them
+    baseline = [0.3, 0.9, 0.5, 0.7, 0.4, 0.8, 0.6, 0.35, 0.85, 0.55]
+    comparison, = PairedComparison(["baseline", "variant"]).compare(
+        _comparisons(baseline, [accuracy + 0.05 for accuracy in baseline])
+    )
+    assert comparison.pairs == 10
+    assert comparison.mean_delta == pytest.approx(0.05)
+    assert comparison.confidence_interval[0] > 0
+    assert comparison.p_value < 0.01
+    assert (comparison.wins, comparison.losses, comparison.ties) == (10, 0, 0)
+
+
+def test_paired_comparison_of_equal_prompts_is_not_significant():
+    baseline = [0.6, 0.8, 0.7, 0.9, 0.5, 0.75]
+    comparison, = PairedComparison(["baseline", "variant"]).compare(
+        _comparisons(baseline, [0.65, 0.75, 0.7, 0.95, 0.45, 0.75])
+    )
+    assert comparison.confidence_interval[0] < 0 < comparison.confidence_interval[1]
+    assert comparison.p_value > 0.5
+    assert (comparison.wins, comparison.losses, comparison.ties) == (2, 2, 2)
+
+
+def test_paired_comparison_skips_pairs_without_evaluations():
+    comparisons = _comparisons([0.5, 0.6], [0.7, 0.8])
+    comparisons[1].simulations[1] = _simulation()
+    comparison, = PairedComparison(["baseline", "variant"]).compare(comparisons)
+    assert comparison.pairs == 1
+    assert comparison.deltas == [pytest.approx(0.2)]
+
+
+def test_comparison_result_reports_confidence_it_used(capsys):
+    comparisons = _comparisons([0.5, 0.6, 0.7], [0.6, 0.7, 0.8])
+    result = ProcessComparisonResult(project_name="project", prompts=["baseline", "variant"], comparisons=comparisons,
+                                     llm_name="llm", size=3, chat_mode=False, temperature=0.8,
+                                     reason="MANUAL", reason_value="value")
+    result.paired_comparisons = PairedComparison(result.prompts, confidence=0.9).compare(comparisons)
+    result.print_comparison_job_result()
+    assert result.paired_comparisons[0].confidence == 0.9
+    assert "(90% CI [" in capsys.readouterr().out
+
+
+def test_compared_prompts_require_input_variables_of_baseline():
+    with pytest.raises(Exception, match="'variant' takes input variables \\['name'\\]"):
+        spelltest_run_simulation(
+            prompt="Greet {user} politely",
+            compare_prompts=["Greet {name} politely"],
+            prompt_names=["baseline", "variant"],
+            users=[Mock()],
+            openai_api_key="test_key",
+        )
+
+
+def test_group_comparisons_drops_incomplete_groups():
+    simulations = [_simulation(0.1), _simulation(0.2), None, _simulation(0.4), _simulation(0.5), _simulation(0.6)]
+    comparisons = _group_comparisons(simulations, 2)
+    assert [comparison.simulations for comparison in comparisons] == [simulations[:2], simulations[4:]]
+
+
+@pytest.mark.asyncio
+async def test_compared_prompts_share_user_inputs():
+    user_params = SyntheticUserParams(
+        temperature=0.7,
+        llm_name="some_llm",
+        description="test user",
+        expectation="hello",
+        user_knowledge_about_app="app knowledge"
+    )
+    user = SyntheticUser(name="name", params=user_params, metrics=[MetricDefinition(name="metric1", definition="definition1")])
+    manager = SyntheticUserCompletionManager(user, "My name is {name}", "test_key")
+    llm = FakeListLLM(responses=[json.dumps({"name": "Ann"}), json.dumps({"name": "Bob"})])
+    manager.chain = CustomLLMChain(llm=llm, prompt=manager.system_prompt)
+    set_input_corpus(UserInputCorpus(path=None))
+    try:
+        # simulations of both prompts get the slot of their simulation, whatever order they are spawned in
+        spawned = [manager.spawn(input_corpus_slot=slot) for slot in [0, 1, 1, 0]]
+        inputs = await asyncio.gather(*[spawned_manager.generate_user_input() for spawned_manager in spawned])
+    finally:
+        set_input_corpus(None)
+    texts = [json.loads(user_input.text)["name"] for user_input in inputs]
+    assert texts[0] == texts[3] and texts[1] == texts[2]
+    assert texts[0] != texts[1]
+    assert llm.i == 2
@@ -1,15 +1,19 @@
+import asyncio
 import json
 import os
 
 import pytest
+from rich.console import Console
 from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
 from spelltest.entities.managers import Message, MessageType
 from spelltest.ai_managers.raw_completion_manager import SyntheticUserCompletionManager, AIModelDefaultCompletionManager, CustomLLMChain
 from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient
+from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
 from langchain.llms.fake import FakeListLLM
 
 IGNORE_DATA_COLLECTING = bool(os.environ.get("IGNORE_DATA_COLLECTING", "True"))
 tracing = PromptelligenceClient(ignore=IGNORE_DATA_COLLECTING)
+cost_calculation_manager = CostCalculationManager(console=Console())
 
 # TODO: test that we control number of messages
 
@@ -74,4 +78,53 @@ async def test_initialize_completion_ai_model_manager():
     app_response_message = await ai_model_manager.generate_completion(input_variables)
 
     assert app_response_message.author == MessageType.ASSISTANT
-    assert app_response_message.text in responses
\ No newline at end of file
+    assert app_response_message.text in responses
+
+@pytest.mark.asyncio
+async def test_spawned_ai_model_manager_does_not_change_target_prompt():
+    prototype = AIModelDefaultCompletionManager("test prompt", "gpt-3.5-turbo", "test_key")
+    llm = FakeListLLM(responses=["Bla bla bla"] * 2)
+    prototype.chain = CustomLLMChain(llm=llm, prompt=prototype.system_prompt)
+    for user_input in ["first", "second"]:
+        manager = prototype.spawn()
+        assert manager.chain is prototype.chain
+        await manager.generate_completion({"USER_INPUT": user_input})
+
+    assert prototype.target_prompt.template == "test prompt"
+    assert llm.i == 2
+
+
+@pytest.mark.asyncio
+async def test_bulk_user_inputs_refill_invalid_elements():
+    user_params = SyntheticUserParams(
+        temperature=0.7,
+        llm_name="some_llm",
+        description="test user",
+        expectation="hello",
+        user_knowledge_about_app="app knowledge"
+    )
+    user = SyntheticUser(name="name", params=user_params, metrics=[MetricDefinition(name="metric1", definition="definition1")])
+    prototype = SyntheticUserCompletionManager(user, "My name is {name}", "test_key", bulk_user_inputs=4)
+    bulk_llm = FakeListLLM(responses=[
+        "```json\n" + json.dumps([{"name": "Ann"}, {"name": "Bob"}, {"name": "Ann"}, {"surname": "Lee"}]) + "\n```",
+        json.dumps([{"name": "Eve"}, {"name": "Kim"}, {"name": "Max"}, {"name": "Tom"}]),
+    ])
+    prototype.bulk_chain = CustomLLMChain(llm=bulk_llm, prompt=prototype.bulk_system_prompt)
+    single_llm = FakeListLLM(responses=[json.dumps({"name": "Joe"}), json.dumps({"name": "Sam"})])
+    prototype.chain = CustomLLMChain(llm=single_llm, prompt=prototype.system_prompt)
+
+    messages = await asyncio.gather(*[prototype.spawn().generate_user_input() for _ in range(5)])
+
+    assert bulk_llm.i == 2
+    assert single_llm.i == 2   # the repeated and the invalid element are generated one by one
+    names = [json.loads(message.text)["name"] for message in messages]
+    assert names[:2] == ["Ann", "Bob"]
+    assert set(names[2:4]) == {"Joe", "Sam"}
+    assert names[4] == "Eve"
+    assert len(prototype.user_input_pool.inputs) == 3
+    # the bulk run is shared by its inputs and counted once
+    assert messages[0].run_id is not None and messages[1].run_id is None
+    assert messages[0].shared_run_id == messages[1].shared_run_id == messages[0].run_id
+    assert messages[4].shared_run_id not in (None, messages[0].run_id)
+    run_ids = [message.run_id for message in messages if message.run_id is not None]
+    assert len(run_ids) == len(set(run_ids)) == 4
@@ -0,0 +1,84 @@
+import asyncio
+import time
+import openai
+import pytest
+from langchain.llms.fake import FakeListLLM
+from langchain import PromptTemplate
+from spelltest.ai_managers.utils.chain import CustomLLMChain
+from spelltest.ai_managers.utils.concurrency import AdaptiveConcurrencyController, get_retry_after, \
+    set_concurrency_controller
+
+
+def test_controller_grows_on_success():
+    controller = AdaptiveConcurrencyController(initial_concurrency=2, max_concurrency=4)
+    for _ in range(20):
+        controller.on_success()
+    assert controller.concurrency == 4
+
+
+def test_controller_cuts_on_rate_limit_once_per_cooldown():
+    controller = AdaptiveConcurrencyController(initial_concurrency=8, max_concurrency=16)
+    controller.on_rate_limit()
+    controller.on_rate_limit()
+    assert controller.concurrency == 4
+    assert controller.rate_limit_errors == 2
+
+
+def test_retry_after():
+    error = openai.error.RateLimitError("limit", headers={"retry-after": "2"})
+    assert get_retry_after(error) == 2.0
+    assert get_retry_after(openai.error.RateLimitError("limit")) is None
+
+
+@pytest.mark.asyncio
+async def test_controller_limits_in_flight_calls():
+    controller = AdaptiveConcurrencyController(initial_concurrency=2, max_concurrency=2)
+    max_in_flight = []
+
+    async def call():
+        async with controller.slot():
+            max_in_flight.append(controller.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[call() for _ in range(10)])
+    assert max(max_in_flight) == 2
+    assert controller.in_flight == 0
+    assert controller.peak_concurrency == 2
+
+
+@pytest.mark.asyncio
+async def test_controller_pauses_on_retry_after():
+    controller = AdaptiveConcurrencyController(initial_concurrency=2)
+    controller.on_rate_limit(retry_after=0.2)
+    start = time.monotonic()
+    await controller.acquire()
+    assert time.monotonic() - start >= 0.15
+    controller.release()
+
+
+class RateLimitedFakeListLLM(FakeListLLM):
+    errors_left: int = 1
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        if self.errors_left:
+            self.errors_left -= 1
+            raise openai.error.RateLimitError("limit", headers={"retry-after": "0.01"})
+        return await super()._acall(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_chain_reports_rate_limit_to_controller():
+    controller = AdaptiveConcurrencyController(initial_concurrency=4)
+    set_concurrency_controller(controller)
+    try:
+        chain = CustomLLMChain(
+            llm=RateLimitedFakeListLLM(responses=["ok"]),
+            prompt=PromptTemplate(template="{input}", input_variables=["input"]),
+        )
+        response = await chain.arun(input="hello")
+    finally:
+        set_concurrency_controller(None)
+    assert response["text"] == "ok"
+    assert controller.rate_limit_errors == 1
+    assert controller.successes == 1
+    assert controller.concurrency == 2
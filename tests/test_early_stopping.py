@@ -0,0 +1,66 @@
+from unittest.mock import Mock
+import numpy as np
+import pytest
+from spelltest.early_stopping import SequentialEarlyStopping, EarlyStoppingDecision
+
+
+def _simulation(*accuracies):
+    return Mock(evaluations=[Mock(accuracy=accuracy) for accuracy in accuracies])
+
+
+def test_early_stopping_passes_when_clearly_above_threshold():
+    early_stopping = SequentialEarlyStopping(quality_threshold=30, min_simulations=10)
+    for _ in range(9):
+        assert not early_stopping.add(_simulation(1.0, 0.95))
+    assert early_stopping.add(_simulation(1.0))
+    assert early_stopping.decision == EarlyStoppingDecision.PASSED
+    assert early_stopping.simulations_used == 10
+
+
+def test_early_stopping_fails_when_clearly_below_threshold():
+    early_stopping = SequentialEarlyStopping(quality_threshold=90)
+    for _ in range(10):
+        early_stopping.add(_simulation(0.0))
+    assert early_stopping.decision == EarlyStoppingDecision.FAILED
+
+
+def test_early_stopping_keeps_running_when_unsettled():
+    early_stopping = SequentialEarlyStopping(quality_threshold=80)
+    for accuracy in [0.6, 1.0, 0.7, 0.95, 0.8] * 4:
+        assert not early_stopping.add(_simulation(accuracy))
+    assert early_stopping.decision is None
+
+
+def test_early_stopping_rarely_decides_when_accuracy_is_at_threshold():
+    # the bound holds at every look, so checking after every simulation keeps the error rate under 1 - confidence
+    random = np.random.default_rng(0)
+    simulations = [_simulation(0.0), _simulation(1.0)]
+    wrong_decisions = 0
+    for _ in range(200):
+        early_stopping = SequentialEarlyStopping(quality_threshold=50)
+        for accuracy in random.integers(0, 2, size=200):
+            if early_stopping.add(simulations[accuracy]):
+                wrong_decisions += 1
+                break
+    assert wrong_decisions / 200 <= 0.05
+
+
+@pytest.mark.parametrize("mean, quality_threshold, decision, max_simulations", [
+    (0.9, 70, EarlyStoppingDecision.PASSED, 40),
+    (0.85, 70, EarlyStoppingDecision.PASSED, 60),
+    (0.3, 70, EarlyStoppingDecision.FAILED, 20),
+])
+def test_early_stopping_settles_clear_runs_at_realistic_size(mean, quality_threshold, decision, max_simulations):
+    # accuracies of a consistent prompt vary by a few points, a decision shouldn't need hundreds of simulations
+    random = np.random.default_rng(0)
+    early_stopping = SequentialEarlyStopping(quality_threshold=quality_threshold)
+    for accuracy in np.clip(random.normal(mean, 0.1, size=max_simulations), 0, 1):
+        if early_stopping.add(_simulation(accuracy)):
+            break
+    assert early_stopping.decision == decision
+    assert early_stopping.simulations_used <= max_simulations
+
+
+def test_early_stopping_requires_threshold():
+    with pytest.raises(Exception):
+        SequentialEarlyStopping(quality_threshold=None)
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import uuid
 from typing import List
@@ -9,7 +10,9 @@ from spelltest.ai_managers.evaluation_manager import EvaluationManager, Message,
 from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient
 from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
 from spelltest.ai_managers.raw_completion_manager import CustomLLMChain
+from spelltest.ai_managers.utils.chain import CustomSamplingLLMChain
 from langchain.llms.fake import FakeListLLM
+from langchain.schema import LLMResult, Generation
 
 IGNORE_DATA_COLLECTING = bool(os.environ.get("IGNORE_DATA_COLLECTING", "True"))
 console = Console()
@@ -59,6 +62,46 @@ async def test_accuracy_value_error(setup_manager):
     assert deviation == 0.0
 
 
+class SamplingFakeListLLM(FakeListLLM):
+    """Returns `n` responses per request"""
+    n: int = 5
+    requests: int = 0
+
+    async def _agenerate(self, prompts, stop=None, run_manager=None, **kwargs) -> LLMResult:
+        self.requests += 1
+        return LLMResult(generations=[[Generation(text=response) for response in self.responses[:self.n]]
+                                      for _ in prompts])
+
+
+class PromptRecordingFakeListLLM(FakeListLLM):
+    prompts: List[str] = []
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        self.prompts.append(prompt)
+        return self._call(prompt, stop=stop, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_accuracy_shots_in_one_request(setup_manager):
+    llm = SamplingFakeListLLM(responses=["80.0", "90.0", "ERROR", "80.0", "90.0"])
+    setup_manager.accuracy_chain = CustomSamplingLLMChain(llm=llm, prompt=setup_manager.accuracy_prompt)
+    accuracy, deviation = await setup_manager._accuracy('simulation_text')
+
+    assert llm.requests == 1
+    assert accuracy == 0.85
+    assert deviation == 0.05
+
+
+@pytest.mark.asyncio
+async def test_accuracy_shots_fallback_when_n_is_not_supported(setup_manager):
+    llm = SamplingFakeListLLM(responses=["80.0", "90.0"], n=2)
+    setup_manager.accuracy_chain = CustomSamplingLLMChain(llm=llm, prompt=setup_manager.accuracy_prompt)
+    shots = await setup_manager._accuracy_shots('simulation_text', 5)
+
+    assert llm.requests == 3
+    assert shots == ["80.0", "90.0", "80.0", "90.0", "80.0"]
+
+
 @pytest.mark.asyncio
 async def test_perfect_completion(setup_manager):
     responses = ["bla bla bla bla", "bla bla bla bla", "bla bla bla bla"]
@@ -114,4 +157,182 @@ async def test_evaluate(setup_manager):
     for simulation in result:
         assert simulation.rationale == 'rationale'
         assert simulation.accuracy == 0.87
-        assert simulation.accuracy_deviation == 0.0
\ No newline at end of file
+        assert simulation.accuracy_deviation == 0.0
+
+
+@pytest.mark.asyncio
+async def test_evaluate_metrics_concurrently(setup_manager):
+    metric_definitions = [Mock(), Mock(), Mock()]
+    for i, metric_definition in enumerate(metric_definitions):
+        metric_definition.name = f"metric{i}"
+    setup_manager.metric_definitions = metric_definitions
+    running = []
+
+    async def evaluate_single(chat_history, metric_definition):
+        running.append(metric_definition.name)
+        await asyncio.sleep(0.01 * (3 - len(running)))
+        assert len(running) == 3   # all metrics started before any finished
+        if metric_definition.name == "metric1":
+            raise ValueError("metric failed")
+        return metric_definition.name
+
+    setup_manager._evaluate_single = evaluate_single
+    result = await setup_manager._evaluate('chat_history')
+    assert result == ["metric0", "metric2"]
+    assert setup_manager.failed_metrics == ["metric1"]
+
+
+@pytest.mark.asyncio
+async def test_multi_metric_rationale_with_fallback(setup_manager):
+    metric_definitions = [Mock(), Mock(), Mock()]
+    for i, metric_definition in enumerate(metric_definitions):
+        metric_definition.name = f"metric{i}"
+        metric_definition.definition = f"definition{i}"
+    setup_manager.metric_definitions = metric_definitions
+    setup_manager.multi_metric_rationale = True
+    setup_manager._init_multi_metric_rationale_chain()
+    multi_metric_llm = FakeListLLM(responses=['```json\n{"metric0": "rationale0", "metric2": "rationale2"}\n```'])
+    setup_manager.multi_metric_rationale_chain = CustomLLMChain(llm=multi_metric_llm,
+                                                                prompt=setup_manager.multi_metric_rationale_prompt)
+    rationale_llm = FakeListLLM(responses=["rationale1"])
+    setup_manager.rationale_chain = CustomLLMChain(llm=rationale_llm, prompt=setup_manager.rationale_prompt)
+    accuracy_llm = FakeListLLM(responses=["87.0"] * 20)
+    setup_manager.accuracy_chain = CustomLLMChain(llm=accuracy_llm, prompt=setup_manager.accuracy_prompt)
+
+    result = await setup_manager._evaluate('chat_history')
+    assert [evaluation.rationale for evaluation in result] == ["rationale0", "rationale1", "rationale2"]
+    assert rationale_llm.i == 1   # only the metric missing in the response got its own rationale call
+
+
+@pytest.mark.asyncio
+async def test_evaluate_chat_stream_merges_window_rationales(setup_manager):
+    metric_definitions = [Mock(), Mock()]
+    for i, metric_definition in enumerate(metric_definitions):
+        metric_definition.name = f"metric{i}"
+        metric_definition.definition = f"definition{i}"
+    setup_manager.metric_definitions = metric_definitions
+    rationale_llm = FakeListLLM(responses=["rationale"] * 6)
+    setup_manager.rationale_chain = CustomLLMChain(llm=rationale_llm, prompt=setup_manager.rationale_prompt)
+    accuracy_llm = FakeListLLM(responses=["87.0"] * 10)
+    setup_manager.accuracy_chain = CustomLLMChain(llm=accuracy_llm, prompt=setup_manager.accuracy_prompt)
+
+    message_queue = asyncio.Queue()
+    evaluation_task = asyncio.ensure_future(setup_manager.evaluate_chat_stream(message_queue, Mock(), window_messages=2))
+    for i in range(5):
+        message_queue.put_nowait(Message(author=MessageType.USER if i % 2 else MessageType.ASSISTANT, text=str(i)))
+        await asyncio.sleep(0.01)
+    assert rationale_llm.i == 4   # both complete windows are evaluated while the chat is still going
+    message_queue.put_nowait(None)
+    result = await evaluation_task
+
+    assert rationale_llm.i == 6
+    assert [evaluation.rationale for evaluation in result] == [
+        "Messages 1-2:\nrationale\n\nMessages 3-4:\nrationale\n\nMessages 5-5:\nrationale"
+    ] * 2
+    assert [evaluation.accuracy for evaluation in result] == [0.87, 0.87]
+
+
+def test_multi_metric_rationale_not_json(setup_manager):
+    assert setup_manager._parse_multi_metric_rationale("I can't evaluate it") == {}
+
+
+@pytest.mark.asyncio
+async def test_adaptive_accuracy_stops_when_shots_agree(setup_manager):
+    setup_manager.adaptive_accuracy = True
+    setup_manager.accuracy_tolerance = 0.04
+    first_llm = SamplingFakeListLLM(responses=["80.0", "90.0"], n=2)
+    batch_llm = SamplingFakeListLLM(responses=["85.0", "85.0", "99.0"], n=2)
+    setup_manager.accuracy_chain = CustomSamplingLLMChain(llm=first_llm, prompt=setup_manager.accuracy_prompt)
+    setup_manager.accuracy_batch_chains = {
+        2: CustomSamplingLLMChain(llm=batch_llm, prompt=setup_manager.accuracy_prompt),
+    }
+    accuracy, deviation, shots = await setup_manager._accuracy_with_shots('simulation_text')
+
+    assert first_llm.requests == 1
+    assert batch_llm.requests == 1
+    assert shots == 4
+    assert accuracy == 0.85
+    assert deviation <= setup_manager.accuracy_tolerance
+
+
+@pytest.mark.asyncio
+async def test_adaptive_accuracy_max_shots(setup_manager):
+    setup_manager.adaptive_accuracy = True
+    setup_manager.accuracy_max_shots = 3
+    setup_manager.accuracy_chain = CustomSamplingLLMChain(llm=SamplingFakeListLLM(responses=["0.0", "100.0"], n=2),
+                                                          prompt=setup_manager.accuracy_prompt)
+    setup_manager.accuracy_batch_chains = {
+        1: CustomSamplingLLMChain(llm=FakeListLLM(responses=["50.0"] * 5), prompt=setup_manager.accuracy_prompt),
+    }
+    accuracy, deviation, shots = await setup_manager._accuracy_with_shots('simulation_text')
+
+    assert shots == 3
+    assert accuracy == 0.5
+
+
+@pytest.mark.asyncio
+async def test_adaptive_accuracy_doubles_batches(setup_manager):
+    setup_manager.adaptive_accuracy = True
+    setup_manager.accuracy_min_shots = 1
+    setup_manager.accuracy_max_shots = 5
+    setup_manager.accuracy_tolerance = -1  # never converges
+    llms = {n: SamplingFakeListLLM(responses=["0.0", "100.0"], n=n) for n in (1, 2)}
+    setup_manager.accuracy_chain = CustomSamplingLLMChain(llm=llms[1], prompt=setup_manager.accuracy_prompt)
+    setup_manager.accuracy_batch_chains = {
+        n: CustomSamplingLLMChain(llm=llm, prompt=setup_manager.accuracy_prompt) for n, llm in llms.items()
+    }
+    accuracy, deviation, shots = await setup_manager._accuracy_with_shots('simulation_text')
+
+    # batches of 1, 1, 2 and 1 shots instead of five single-shot requests
+    assert shots == 5
+    assert llms[1].requests == 3
+    assert llms[2].requests == 1
+
+
+def test_adaptive_accuracy_unexpected_shots():
+    with pytest.raises(Exception):
+        EvaluationManager(
+            openai_api_key='test_api_key',
+            synthetic_user_persona_manager=Mock(),
+            metric_definitions=[Mock()],
+            adaptive_accuracy={"min_shots": 3, "max_shots": 2},
+        )
+
+
+def test_spawned_managers_share_chains():
+    prototype = EvaluationManager(
+        metric_definitions=[Mock()],
+        openai_api_key='test_api_key',
+        synthetic_user_persona_manager=Mock(),
+        llm_name_default='llm_default',
+    )
+    first, second = prototype.spawn(), prototype.spawn()
+    first.initialize_evaluation()
+    second.initialize_evaluation()
+
+    assert first.rationale_chain is second.rationale_chain is prototype.rationale_chain
+    assert first.accuracy_chain is second.accuracy_chain is prototype.accuracy_chain
+    assert first.cost_tracker_layer is not second.cost_tracker_layer
+
+
+@pytest.mark.asyncio
+async def test_spawned_managers_keep_no_state_in_shared_chains():
+    user_persona_manager = Mock(spec=["user"])
+    prototype = EvaluationManager(
+        metric_definitions=[Mock()],
+        openai_api_key='test_api_key',
+        synthetic_user_persona_manager=user_persona_manager,
+        llm_name_default='llm_default',
+    )
+    first, second = prototype.spawn(), prototype.spawn()
+    first.initialize_evaluation()
+    second.initialize_evaluation()
+    llm = PromptRecordingFakeListLLM(responses=["perfect"] * 2)
+    prototype.perfect_chat_chain.llm = llm
+    await first._generate_perfect_chat_message(Message(author=MessageType.ASSISTANT, text="first"), [])
+    await second._generate_perfect_chat_message(Message(author=MessageType.ASSISTANT, text="second"), [])
+
+    assert first.perfect_chat_chain is second.perfect_chat_chain
+    assert "first" not in llm.prompts[1]   # the second simulation doesn't see the first one's messages
+    # tracers are attached to spawned managers only, the shared user manager of the prototype is untouched
+    assert user_persona_manager.mock_calls == []
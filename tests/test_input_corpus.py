@@ -0,0 +1,62 @@
+import json
+import pytest
+from rich.console import Console
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.tracing.cost_calculation_tracing import CostCalculationManager
+from spelltest.ai_managers.raw_completion_manager import SyntheticUserCompletionManager, CustomLLMChain
+from spelltest.ai_managers.utils.input_corpus import UserInputCorpus, InputCorpusMode, InputKind, set_input_corpus
+from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
+
+cost_calculation_manager = CostCalculationManager(console=Console())
+
+
+def _user(description="test user"):
+    user_params = SyntheticUserParams(
+        temperature=0.7,
+        llm_name="some_llm",
+        description=description,
+        expectation="hello",
+        user_knowledge_about_app="app knowledge"
+    )
+    return SyntheticUser(name="name", params=user_params, metrics=[MetricDefinition(name="metric1", definition="definition1")])
+
+
+def _manager(target_prompt, responses):
+    manager = SyntheticUserCompletionManager(_user(), target_prompt, "test_key")
+    llm = FakeListLLM(responses=[json.dumps(response) for response in responses])
+    manager.chain = CustomLLMChain(llm=llm, prompt=manager.system_prompt)
+    return manager, llm
+
+
+def test_corpus_key_depends_on_persona_and_input_variables():
+    key = UserInputCorpus.make_key(_user(), InputKind.COMPLETION_INPUT, ["b", "a"])
+    assert key == UserInputCorpus.make_key(_user(), InputKind.COMPLETION_INPUT, ["a", "b"])
+    assert key != UserInputCorpus.make_key(_user("other user"), InputKind.COMPLETION_INPUT, ["a", "b"])
+    assert key != UserInputCorpus.make_key(_user(), InputKind.COMPLETION_INPUT, ["a"])
+    assert key != UserInputCorpus.make_key(_user(), InputKind.CHAT_FIRST_MESSAGE, ["a", "b"])
+
+
+@pytest.mark.asyncio
+async def test_corpus_replays_inputs_for_new_prompt_version(tmp_path):
+    path = str(tmp_path / "user_inputs.jsonl")
+    set_input_corpus(UserInputCorpus(path=path))
+    try:
+        manager, llm = _manager("My name is {name}", [{"name": "Ann"}, {"name": "Bob"}])
+        recorded = [(await manager.spawn().generate_user_input()).text for _ in range(2)]
+    finally:
+        set_input_corpus(None)
+
+    corpus = UserInputCorpus(path=path, mode=InputCorpusMode.READ_ONLY)
+    set_input_corpus(corpus)
+    try:
+        manager, llm = _manager("Hello, I am {name}!", [{"name": "Eve"}])
+        replayed = [(await manager.spawn().generate_user_input()).text for _ in range(3)]
+    finally:
+        set_input_corpus(None)
+
+    assert replayed[:2] == recorded
+    assert json.loads(replayed[2]) == {"name": "Eve"}   # the corpus is shorter than the run
+    assert llm.i == 1
+    assert (corpus.replayed, corpus.generated) == (2, 1)
+    with open(path) as file:
+        assert len(file.readlines()) == 2   # read-only corpus doesn't store new inputs
@@ -0,0 +1,96 @@
+import time
+import pytest
+from langchain import PromptTemplate
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.utils.chain import CustomLLMChain
+from spelltest.ai_managers.utils.llm_cache import LLMResponseCache, LLMCacheMode, set_llm_cache
+
+
+class SampledFakeListLLM(FakeListLLM):
+    """Fake LLM which params do not depend on responses"""
+    temperature: float = 0.0
+
+    @property
+    def _identifying_params(self):
+        return {"temperature": self.temperature}
+
+
+def _chain(llm):
+    return CustomLLMChain(llm=llm, prompt=PromptTemplate(template="Say {input}", input_variables=["input"]))
+
+
+def test_cache_key_sample_index(tmp_path):
+    cache = LLMResponseCache(path=str(tmp_path / "cache.sqlite"))
+    assert cache.make_key("llm", {"temperature": 0}, "prompt") == cache.make_key("llm", {"temperature": 0}, "prompt")
+    first = cache.make_key("llm", {"temperature": 0.7}, "prompt")
+    second = cache.make_key("llm", {"temperature": 0.7}, "prompt")
+    assert first != second
+    assert first.split(":")[0] == second.split(":")[0]
+    assert cache.make_key("llm", {"temperature": 0}, "prompt") != cache.make_key("llm", {"temperature": 0}, "other")
+
+
+def test_cache_key_samples_without_reported_temperature(tmp_path):
+    # chat models created without temperature only report the model name, the API samples with temperature 1
+    cache = LLMResponseCache(path=str(tmp_path / "cache.sqlite"))
+    params = {"model_name": "gpt-3.5-turbo"}
+    assert cache.make_key("llm", params, "prompt") != cache.make_key("llm", params, "prompt")
+
+
+def test_cache_eviction_by_age_and_size(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMResponseCache(path=path)
+    cache.set("old", {"text": "old"})
+    cache._connection.execute("UPDATE llm_cache SET created_at = ? WHERE key = 'old'", (time.time() - 10 ** 8,))
+    cache.set("least_recently_used", {"text": "a" * 100})
+    cache.set("recently_used", {"text": "b" * 100})
+    cache._connection.execute("UPDATE llm_cache SET accessed_at = 0 WHERE key = 'least_recently_used'")
+    cache.max_size_bytes = 150
+    cache.evict()
+    assert cache.get("old") is None
+    assert cache.get("least_recently_used") is None
+    assert cache.get("recently_used") == {"text": "b" * 100}
+
+
+def test_read_only_cache_does_not_write(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    LLMResponseCache(path=str(tmp_path / "missing.sqlite"), mode=LLMCacheMode.READ_ONLY).set("key", {"text": "a"})
+    cache = LLMResponseCache(path=path)
+    cache.set("key", {"text": "cached"})
+    cache.close()
+    read_only_cache = LLMResponseCache(path=path, mode=LLMCacheMode.READ_ONLY)
+    read_only_cache.set("other", {"text": "new"})
+    assert read_only_cache.get("key") == {"text": "cached"}
+    assert read_only_cache.get("other") is None
+
+
+@pytest.mark.asyncio
+async def test_chain_uses_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    set_llm_cache(LLMResponseCache(path=path))
+    try:
+        first_response = await _chain(SampledFakeListLLM(responses=["first"])).arun(input="hello")
+        set_llm_cache(LLMResponseCache(path=path))
+        second_response = await _chain(SampledFakeListLLM(responses=["second"])).arun(input="hello")
+        other_response = await _chain(SampledFakeListLLM(responses=["other"])).arun(input="bye")
+    finally:
+        set_llm_cache(None)
+    assert first_response["text"] == "first"
+    assert second_response["text"] == "first"
+    assert second_response["__run"].run_id != first_response["__run"].run_id
+    assert other_response["text"] == "other"
+
+
+@pytest.mark.asyncio
+async def test_chain_caches_samples_when_temperature(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    set_llm_cache(LLMResponseCache(path=path))
+    try:
+        chain = _chain(SampledFakeListLLM(responses=["first", "second"], temperature=0.7))
+        samples = [(await chain.arun(input="hello"))["text"] for _ in range(2)]
+        set_llm_cache(LLMResponseCache(path=path))
+        chain = _chain(SampledFakeListLLM(responses=["third", "fourth", "fifth"], temperature=0.7))
+        cached_samples = [(await chain.arun(input="hello"))["text"] for _ in range(3)]
+    finally:
+        set_llm_cache(None)
+    assert samples == ["first", "second"]
+    assert cached_samples == ["first", "second", "third"]
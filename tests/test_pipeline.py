@@ -0,0 +1,71 @@
+import asyncio
+import functools
+import pytest
+from spelltest.pipeline import run_two_stage_pipeline
+
+
+async def _evaluate(value, delay, running, peak):
+    running.append(value)
+    peak.append(len(running))
+    await asyncio.sleep(delay)
+    running.remove(value)
+    return value * 10
+
+
+async def _generate(value, delay, evaluation_delay, running, peak):
+    await asyncio.sleep(delay)
+    return functools.partial(_evaluate, value, evaluation_delay, running, peak)
+
+
+def _tasks(count, delay=0.001, evaluation_delay=0.001, running=None, peak=None):
+    running = [] if running is None else running
+    peak = [] if peak is None else peak
+    return [functools.partial(_generate, i, delay, evaluation_delay, running, peak) for i in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_order_and_counts_stages():
+    results, stats = await run_two_stage_pipeline(_tasks(6), generation_concurrency=3, evaluation_concurrency=2,
+                                                  queue_size=2)
+    assert results == [0, 10, 20, 30, 40, 50]
+    assert stats.generation.completed == stats.evaluation.completed == 6
+    assert stats.generation.workers == 3
+    assert stats.evaluation.workers == 2
+    assert stats.evaluation.throughput > 0
+    assert len(stats.queue_depths) == 6
+
+
+@pytest.mark.asyncio
+async def test_pipeline_limits_evaluation_and_bounds_queue():
+    peak = []
+    results, stats = await run_two_stage_pipeline(_tasks(8, evaluation_delay=0.02, peak=peak),
+                                                  generation_concurrency=8, evaluation_concurrency=2, queue_size=1)
+    assert results == [value * 10 for value in range(8)]
+    assert max(peak) == 2
+    assert stats.max_queue_depth <= 1
+    assert stats.generation_wait_seconds > 0   # slow evaluation holds generation back
+
+
+@pytest.mark.asyncio
+async def test_pipeline_stops_on_result():
+    results, stats = await run_two_stage_pipeline(_tasks(10, delay=0.01), generation_concurrency=1,
+                                                  evaluation_concurrency=1, queue_size=1,
+                                                  on_result=lambda value: value == 20)
+    assert results[:3] == [0, 10, 20]
+    assert stats.generation.completed < 10
+    assert results[stats.generation.completed:] == [None] * (10 - stats.generation.completed)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_evaluation_error_does_not_block_generation():
+    async def failing_evaluation():
+        raise ValueError("evaluation failed")
+
+    async def generate():
+        return failing_evaluation
+
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(
+            run_two_stage_pipeline([generate] * 5, generation_concurrency=5, evaluation_concurrency=1, queue_size=1),
+            timeout=1,
+        )
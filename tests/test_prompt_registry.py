@@ -0,0 +1,178 @@
+import pytest
+from spelltest.ai_managers.tracing import promtelligence_tracing
+from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient, PromptTemplate
+
+
+class _Response:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self.data
+
+
+class _Backend:
+    """Registry of one project with prompts `alias -> template`"""
+
+    def __init__(self, templates, bulk_latest=True, bulk_versions=True):
+        self.bulk_latest = bulk_latest
+        self.bulk_versions = bulk_versions
+        self.requests = []
+        self.usage_logs = []
+        self.prompts = [{"id": i + 1, "alias": alias} for i, alias in enumerate(templates)]
+        self.versions = [
+            {"id": 100 + i, "prompt_id": i + 1, "version_or_git_commit": "v1", "template_body": template}
+            for i, template in enumerate(templates.values())
+        ]
+
+    def session(self):
+        backend = self
+
+        class Session:
+            def get(self, url, params=None, headers=None):
+                path = url.split("8000", 1)[1]
+                backend.requests.append(("GET", path))
+                if path == "/api/projects/":
+                    return _Response([{"id": 1}])
+                if path == "/api/prompts/":
+                    return _Response(backend.prompts)
+                if path == "/api/prompt-versions/latest/":
+                    if not backend.bulk_latest:
+                        return _Response(None, status_code=404)
+                    return _Response([backend._latest(prompt["id"]) for prompt in backend.prompts])
+                return _Response(backend._latest(int(path.split("/")[3])))
+
+            def post(self, url, json=None, headers=None, timeout=None):
+                path = url.split("8000", 1)[1]
+                backend.requests.append(("POST", path))
+                if path.endswith("-usage-logs/bulk/"):
+                    return _Response(None, status_code=404)
+                if path.endswith("-usage-logs/"):
+                    backend.usage_logs.append(json)
+                    return _Response({**json, "id": len(backend.usage_logs)}, status_code=201)
+                if path == "/api/prompt-versions/bulk/":
+                    if not backend.bulk_versions:
+                        return _Response(None, status_code=405)
+                    return _Response([backend._add_version(data) for data in json])
+                return _Response(backend._add_version(json))
+
+            def mount(self, prefix, adapter):
+                pass
+
+            def close(self):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        return Session()
+
+    def _latest(self, prompt_id):
+        return [version for version in self.versions if version["prompt_id"] == prompt_id][-1]
+
+    def _add_version(self, data):
+        version = {**data, "id": 100 + len(self.versions)}
+        self.versions.append(version)
+        return version
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)   # the registry snapshot is saved in the working directory
+    previous_client = promtelligence_tracing.client
+    backend = _Backend({"Customer prompt": "Hi {name}", "Accuracy": "Rate {completion}"})
+    monkeypatch.setattr(promtelligence_tracing.requests, "Session", backend.session)
+    yield backend
+    promtelligence_tracing.client = previous_client
+
+
+def _client():
+    return PromptelligenceClient(base_url="http://127.0.0.1:8000", background_export=False)
+
+
+def test_registry_is_fetched_with_one_call_and_reused_from_snapshot(backend):
+    client = _client()
+    assert client.uploaded_prompts["Accuracy"]["last_version"]["id"] == 101
+    assert backend.requests == [("GET", "/api/projects/"), ("GET", "/api/prompts/"),
+                                ("GET", "/api/prompt-versions/latest/")]
+    backend.requests.clear()
+    assert _client().uploaded_prompts == client.uploaded_prompts
+    assert backend.requests == []
+
+
+def test_registry_falls_back_to_concurrent_fetch(backend):
+    backend.bulk_latest = False
+    client = _client()
+    assert client.uploaded_prompts["Customer prompt"]["last_version"]["id"] == 100
+    assert sorted(backend.requests[3:]) == [("GET", "/api/prompt-versions/1/latest/"),
+                                             ("GET", "/api/prompt-versions/2/latest/")]
+
+
+def test_batch_registration_registers_new_versions_with_one_request(backend):
+    client = _client()
+    backend.requests.clear()
+    with client.batch_registration():
+        prompts = [PromptTemplate(template=template, input_variables=["name"], alias="Customer prompt")
+                   for template in ["Hello {name}", "Hey {name}", "Hello {name}", "Hi {name}"]]
+        assert prompts[0].promptelligence_params.db_version_id is None
+    # the snapshot may be stale, the latest version is fetched once before the next version name is derived
+    assert backend.requests == [("GET", "/api/prompt-versions/1/latest/"), ("POST", "/api/prompt-versions/bulk/")]
+    version_ids = [prompt.promptelligence_params.db_version_id for prompt in prompts]
+    assert version_ids[0] == version_ids[2] != version_ids[1]
+    assert version_ids[3] == 100   # known version, not registered again
+    assert [version["version_or_git_commit"] for version in backend.versions[2:]] == ["v2", "v3"]
+    # the snapshot of the next client knows the new versions
+    backend.requests.clear()
+    assert _client().uploaded_prompts["Customer prompt"]["last_version"]["id"] == version_ids[1]
+    assert backend.requests == []
+
+
+def test_batch_registration_falls_back_to_registering_versions_one_by_one(backend):
+    backend.bulk_versions = False
+    client = _client()
+    with client.batch_registration():
+        prompts = [PromptTemplate(template=template, input_variables=["name"], alias="Customer prompt")
+                   for template in ["Hello {name}", "Hey {name}"]]
+    assert [prompt.promptelligence_params.db_version_id for prompt in prompts] == [102, 103]
+    assert backend.requests[-2:] == [("POST", "/api/prompt-versions/"), ("POST", "/api/prompt-versions/")]
+
+
+def test_new_version_name_follows_versions_of_other_processes(backend):
+    _client()   # saves the snapshot
+    # another process registers v2 while the snapshot is still fresh
+    backend._add_version({"prompt_id": 1, "version_or_git_commit": "v2", "template_body": "Hello {name}"})
+    client = _client()
+    assert client.uploaded_prompts["Customer prompt"]["last_version"]["version_or_git_commit"] == "v1"
+    known = PromptTemplate(template="Hello {name}", input_variables=["name"], alias="Customer prompt")
+    assert known.promptelligence_params.db_version_id == 102   # not registered again
+    new = PromptTemplate(template="Hey {name}", input_variables=["name"], alias="Customer prompt")
+    assert new.promptelligence_params.version == "v3"
+    assert [version["version_or_git_commit"] for version in backend.versions[2:]] == ["v2", "v3"]
+
+
+def test_completion_manager_reads_version_registered_after_batch(backend):
+    from spelltest.ai_managers.raw_completion_manager import AIModelDefaultCompletionManager
+    _client()
+    with promtelligence_tracing.batch_prompt_registration():
+        app_manager = AIModelDefaultCompletionManager("Greet {name}", "text-davinci-003", "test_key")
+        assert app_manager.prompt_version_id is None
+    assert app_manager.prompt_version_id is not None
+    assert app_manager.spawn().prompt_version_id == app_manager.target_prompt.promptelligence_params.db_version_id
+
+
+def test_usage_logs_fall_back_to_one_request_per_log(backend):
+    client = _client()
+    backend.requests.clear()
+    client._send_usage_log_batch(client.LLM_USAGE_LOGS_ENDPOINT, [{"n": 0}, {"n": 1}])
+    client._send_usage_log_batch(client.LLM_USAGE_LOGS_ENDPOINT, [{"n": 2}])
+    assert backend.usage_logs == [{"n": 0}, {"n": 1}, {"n": 2}]
+    # the missing bulk endpoint is tried once
+    assert backend.requests.count(("POST", "/api/llm-usage-logs/bulk/")) == 1
@@ -0,0 +1,61 @@
+import time
+import pytest
+from langchain import PromptTemplate
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.utils.chain import CustomLLMChain
+from spelltest.ai_managers.utils.rate_limit import TokenBucket, ModelRateLimiter, set_rate_limiter
+
+
+class NamedFakeListLLM(FakeListLLM):
+    model_name: str = "fake-model"
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(capacity=600)   # 10 tokens per second
+    await bucket.acquire(600)
+    start = time.monotonic()
+    await bucket.acquire(2)
+    assert time.monotonic() - start >= 0.15
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_lets_oversized_request_through():
+    bucket = TokenBucket(capacity=10)
+    await bucket.acquire(1000)
+    assert bucket.tokens < 1
+
+
+def test_rate_limiter_unexpected_keys():
+    with pytest.raises(ValueError):
+        ModelRateLimiter({"gpt-3.5-turbo": {"rph": 10}})
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_limits_only_configured_models():
+    rate_limiter = ModelRateLimiter({"limited": {"rpm": 60, "tpm": 600}})
+    rate_limiter.estimate_tokens = lambda model_name, text: len(text.split())
+    assert rate_limiter.is_limited("limited")
+    assert not rate_limiter.is_limited("other")
+
+    await rate_limiter.acquire("limited", "one two three")
+    assert rate_limiter.request_buckets["limited"].tokens == pytest.approx(59, abs=0.1)
+    assert rate_limiter.token_buckets["limited"].tokens == pytest.approx(597, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_chain_acquires_rate_limiter():
+    rate_limiter = ModelRateLimiter({"fake-model": {"rpm": 60, "tpm": 600}})
+    prompts = []
+    rate_limiter.estimate_tokens = lambda model_name, text: prompts.append(text) or 5
+    set_rate_limiter(rate_limiter)
+    try:
+        chain = CustomLLMChain(
+            llm=NamedFakeListLLM(responses=["ok"]),
+            prompt=PromptTemplate(template="Say {input}", input_variables=["input"]),
+        )
+        await chain.arun(input="hello")
+    finally:
+        set_rate_limiter(None)
+    assert prompts == ["Say hello"]
+    assert rate_limiter.token_buckets["fake-model"].tokens == pytest.approx(595, abs=0.1)
@@ -0,0 +1,92 @@
+import asyncio
+import functools
+import pytest
+from langchain.llms.fake import FakeListLLM
+from spelltest.ai_managers.chat_manager import SyntheticUserChatManager, AIModelDefaultChatManager, CustomLLMChain
+from spelltest.conversation_tree import conversation_prefixes
+from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams, MetricDefinition
+from spelltest.spelltest_execution import _run_tasks_in_window, _generate_chat
+
+
+async def _sleep_and_return(value, delay, started):
+    started.append(value)
+    await asyncio.sleep(delay)
+    return value
+
+
+@pytest.mark.asyncio
+async def test_run_tasks_in_window_keeps_order():
+    started = []
+    tasks = [functools.partial(_sleep_and_return, i, 0.01 * (5 - i), started) for i in range(5)]
+    result = await _run_tasks_in_window(tasks, max_concurrency=2)
+    assert result == [0, 1, 2, 3, 4]
+    assert sorted(started) == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_run_tasks_in_window_does_not_wait_for_slow_task():
+    started = []
+    # first task is slow, the rest must go through the second slot without waiting for it
+    tasks = [functools.partial(_sleep_and_return, 0, 0.5, started)] + \
+            [functools.partial(_sleep_and_return, i, 0.01, started) for i in range(1, 6)]
+    run = asyncio.ensure_future(_run_tasks_in_window(tasks, max_concurrency=2))
+    await asyncio.sleep(0.2)
+    assert started == [0, 1, 2, 3, 4, 5]
+    assert await run == [0, 1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_run_tasks_in_window_limits_concurrency():
+    in_flight = []
+    max_in_flight = []
+
+    async def task():
+        in_flight.append(1)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+
+    await _run_tasks_in_window([task for _ in range(10)], max_concurrency=3)
+    assert max(max_in_flight) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_tasks_in_window_stops_on_result():
+    started = []
+    tasks = [functools.partial(_sleep_and_return, i, 0.01, started) for i in range(10)]
+    result = await _run_tasks_in_window(tasks, max_concurrency=2, on_result=lambda value: value == 3)
+    assert result[:4] == [0, 1, 2, 3]
+    assert len(started) < 10
+    assert result[len(started):] == [None] * (10 - len(started))
+
+
+@pytest.mark.asyncio
+async def test_generate_chat_forks_shared_prefix():
+    user = SyntheticUser(
+        name="name",
+        params=SyntheticUserParams(temperature=0.7, llm_name="some_llm", description="test user",
+                                   expectation="hello", user_knowledge_about_app="app knowledge"),
+        metrics=[MetricDefinition(name="metric1", definition="definition1")],
+    )
+    user_prototype = SyntheticUserChatManager(user, "test_key")
+    user_llm = FakeListLLM(responses=[f"user {i}" for i in range(10)])
+    user_prototype.chain = CustomLLMChain(llm=user_llm, prompt=user_prototype.system_prompt)
+    app_prototype = AIModelDefaultChatManager("test prompt", "gpt-3.5-turbo", "test_key",
+                                              role="AI", opposite_role="Human")
+    app_llm = FakeListLLM(responses=[f"app {i}" for i in range(10)])
+    app_prototype.chain = CustomLLMChain(llm=app_llm, prompt=app_prototype.system_prompt)
+
+    prefixes = conversation_prefixes(size=3, fork_after_messages=2, branches=3)
+    results = await asyncio.gather(*[
+        _generate_chat(app_prototype.spawn(), user_prototype.spawn(), 4, conversation_prefix=prefix)
+        for prefix in prefixes
+    ])
+
+    # welcome message and 2 messages of the prefix are generated once, then every branch sends its own 2 messages
+    assert app_llm.i == user_llm.i == 2 + 3
+    chat_histories = [chat_history for _, _, chat_history in results]
+    assert all(len(chat_history) == 6 for chat_history in chat_histories)
+    assert all(chat_history[:4] == chat_histories[0][:4] for chat_history in chat_histories)
+    assert len({chat_history[4].text for chat_history in chat_histories}) == 3
+    assert len({user_manager.chat_id for _, user_manager, _ in results}) == 3
+    assert len({id(prefix) for prefix in prefixes}) == 1
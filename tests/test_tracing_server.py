@@ -0,0 +1,62 @@
+import time
+import pytest
+import requests
+from spelltest.ai_managers.tracing import promtelligence_tracing
+from spelltest.ai_managers.tracing.promtelligence_tracing import PromptelligenceClient, PromptTemplate, \
+    PromptVersionUsageLog
+from spelltest.tracing_server import TracingServer
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)   # the registry snapshot of the client is saved in the working directory
+    previous_client = promtelligence_tracing.client
+    server = TracingServer(port=0, db_path=":memory:").start()
+    yield server
+    server.shutdown()
+    promtelligence_tracing.client = previous_client
+
+
+def test_tracing_client_syncs_prompts_and_exports_logs(server):
+    client = PromptelligenceClient(project="load test", base_url=server.url, export_options={"batch_size": 2})
+    prompt = PromptTemplate(template="Hi {name}", input_variables=["name"], alias="Customer prompt")
+    assert prompt.promptelligence_params.db_version_id is not None
+    for run in range(3):
+        client.send_prompt_version_usage_log(PromptVersionUsageLog(
+            prompt_version_id=prompt.promptelligence_params.db_version_id,
+            run_id=str(run), parent_run_id="None", llm_name="some_llm", prompt="Hi Ann", invocation_params={},
+        ))
+    client.flush(timeout=5)
+    assert server.store.count("prompt-version-usage-logs") == 3
+
+    # a new version of the prompt is registered, the latest versions are fetched in bulk
+    PromptelligenceClient(project="load test", base_url=server.url, registry_snapshot_max_age_seconds=0)
+    new_prompt = PromptTemplate(template="Hello {name}", input_variables=["name"], alias="Customer prompt")
+    project_id = requests.get(server.url + "/api/projects/", params={"name": "load test"}).json()[0]["id"]
+    latest, = requests.get(server.url + "/api/prompt-versions/latest/", params={"project_id": project_id}).json()
+    assert latest["version_or_git_commit"] == "v2"
+    assert latest["id"] == new_prompt.promptelligence_params.db_version_id
+
+
+def test_tracing_server_serves_entities(server):
+    created = requests.post(server.url + "/api/metric-definitions/", json={"name": "accuracy", "definition": "d"})
+    assert created.status_code == 201
+    metric_id = created.json()["id"]
+    assert requests.get(server.url + "/api/metric-definitions/?name=accuracy").json()[0]["id"] == metric_id
+    assert requests.get(server.url + "/api/metric-definitions/?name=other").json() == []
+    patched = requests.patch(server.url + f"/api/metric-definitions/{metric_id}/", json={"definition": "new"})
+    assert patched.json() == {"name": "accuracy", "definition": "new", "id": metric_id}
+    assert requests.patch(server.url + f"/api/metric-definitions/{metric_id}/", json=["new"]).status_code == 400
+    assert requests.get(server.url + "/api/unknown/").status_code == 404
+
+
+def test_tracing_server_injects_latency_and_errors():
+    server = TracingServer(port=0, db_path=":memory:", latency_seconds=0.1, error_rate=1.0).start()
+    try:
+        started_at = time.monotonic()
+        response = requests.get(server.url + "/api/projects/")
+        assert time.monotonic() - started_at >= 0.1
+        assert response.status_code == 503
+        assert server.injected_errors == 1
+    finally:
+        server.shutdown()
@@ -0,0 +1,116 @@
+import threading
+import time
+from spelltest.ai_managers.tracing.usage_log_exporter import UsageLogExporter, OverflowPolicy
+from spelltest.ai_managers.tracing.usage_log_spool import SpoolUploader, list_segments
+
+
+class _Backend:
+    def __init__(self, block=None, fail=False):
+        self.batches = []
+        self.sending = threading.Event()
+        self.block = block
+        self.fail = fail
+
+    def send_batch(self, endpoint, logs):
+        self.sending.set()
+        if self.block is not None:
+            self.block.wait()
+        if self.fail:
+            raise Exception("backend is down")
+        self.batches.append((endpoint, [log["n"] for log in logs]))
+
+
+def test_exporter_batches_logs_by_endpoint():
+    backend = _Backend()
+    exporter = UsageLogExporter(backend.send_batch, batch_size=2, flush_interval_seconds=60)
+    for n in range(3):
+        exporter.submit("/a/", {"n": n})
+    exporter.submit("/b/", {"n": 3})
+    exporter.close()
+    assert ("/a/", [0, 1]) in backend.batches
+    assert sorted(backend.batches) == [("/a/", [0, 1]), ("/a/", [2]), ("/b/", [3])]
+    assert exporter.exported == 4
+
+
+def test_exporter_sends_partial_batch_after_interval():
+    backend = _Backend()
+    exporter = UsageLogExporter(backend.send_batch, batch_size=100, flush_interval_seconds=0.05)
+    exporter.submit("/a/", {"n": 0})
+    time.sleep(0.3)
+    assert backend.batches == [("/a/", [0])]
+    exporter.close()
+
+
+def test_exporter_submit_does_not_wait_for_backend():
+    block = threading.Event()
+    backend = _Backend(block=block)
+    exporter = UsageLogExporter(backend.send_batch, batch_size=1, queue_size=2)
+    started_at = time.monotonic()
+    accepted = [exporter.submit("/a/", {"n": n}) for n in range(10)]
+    assert time.monotonic() - started_at < 0.5
+    assert accepted.count(False) == exporter.dropped > 0
+    block.set()
+    exporter.close()
+    assert exporter.exported + exporter.dropped == 10
+
+
+def test_exporter_drop_oldest_keeps_newest_logs():
+    block = threading.Event()
+    backend = _Backend(block=block)
+    exporter = UsageLogExporter(backend.send_batch, batch_size=1, queue_size=2,
+                                overflow_policy=OverflowPolicy.DROP_OLDEST)
+    exporter.submit("/a/", {"n": 0})
+    backend.sending.wait(5)   # the first log keeps the worker busy while the queue fills up
+    for n in range(1, 6):
+        assert exporter.submit("/a/", {"n": n})
+    block.set()
+    exporter.close()
+    assert backend.batches == [("/a/", [0]), ("/a/", [4]), ("/a/", [5])]
+    assert exporter.dropped == 3
+
+
+def test_exporter_spills_overflow_to_spool(tmp_path):
+    block = threading.Event()
+    backend = _Backend(block=block)
+    exporter = UsageLogExporter(backend.send_batch, batch_size=1, queue_size=1,
+                                overflow_policy=OverflowPolicy.SPILL, spill_directory=str(tmp_path))
+    for n in range(5):
+        exporter.submit("/a/", {"n": n})
+    block.set()
+    exporter.close()
+    assert exporter.spilled > 0
+    assert exporter.exported + exporter.spilled == 5
+    # spilled logs are uploaded from the spool like logs of a spooling client (`spelltest trace-upload`)
+    upload_backend = _Backend()
+    assert SpoolUploader(str(tmp_path), upload_backend.send_batch).upload_pending() == exporter.spilled
+    assert sorted(n for _, logs in backend.batches + upload_backend.batches for n in logs) == [0, 1, 2, 3, 4]
+
+
+def test_exporter_spills_failed_batches_with_spill_policy(tmp_path):
+    exporter = UsageLogExporter(_Backend(fail=True).send_batch, batch_size=1,
+                                overflow_policy=OverflowPolicy.SPILL, spill_directory=str(tmp_path))
+    exporter.submit("/a/", {"n": 0})
+    exporter.close()
+    assert (exporter.failed, exporter.spilled) == (0, 1)
+    assert list_segments(str(tmp_path))
+
+
+def test_exporter_survives_backend_errors():
+    exporter = UsageLogExporter(_Backend(fail=True).send_batch, batch_size=1)
+    exporter.submit("/a/", {"n": 0})
+    assert exporter.flush(timeout=5)
+    exporter.close()
+    assert exporter.failed == 1
+
+
+def test_exporter_close_is_bounded():
+    block = threading.Event()
+    backend = _Backend(block=block)
+    exporter = UsageLogExporter(backend.send_batch, flush_interval_seconds=60)
+    exporter.submit("/a/", {"n": 0})
+    started = time.monotonic()
+    assert not exporter.close(timeout=0.1)
+    assert time.monotonic() - started < 1
+    block.set()
+    assert exporter.close(timeout=5)
+    assert backend.batches == [("/a/", [0])]
@@ -0,0 +1,133 @@
+import os
+import time
+from spelltest.ai_managers.tracing.usage_log_spool import UsageLogSpool, SpoolUploader, list_segments, try_lock
+
+
+class _Backend:
+    def __init__(self, fail_after=None):
+        self.batches = []
+        self.fail_after = fail_after
+
+    def send_batch(self, endpoint, logs):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise Exception("backend is down")
+        self.batches.append((endpoint, [log["n"] for log in logs]))
+
+
+def test_spool_rotates_segments(tmp_path):
+    spool = UsageLogSpool(str(tmp_path), segment_max_bytes=50)
+    for n in range(5):
+        spool.append("/a/", {"n": n})
+    spool.close()
+    assert len(list_segments(str(tmp_path))) > 1
+    # a new run starts a new segment
+    assert UsageLogSpool(str(tmp_path)).active_segment not in list_segments(str(tmp_path))
+
+
+def test_uploader_batches_by_endpoint_and_deletes_uploaded_segments(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    for n, endpoint in enumerate(["/a/", "/a/", "/a/", "/b/", "/a/"]):
+        spool.append(endpoint, {"n": n})
+    spool.close()
+    backend = _Backend()
+    assert SpoolUploader(str(tmp_path), backend.send_batch, batch_size=2).upload_pending() == 5
+    assert backend.batches == [("/a/", [0, 1]), ("/a/", [2]), ("/b/", [3]), ("/a/", [4])]
+    assert list_segments(str(tmp_path)) == []
+
+
+def test_uploader_keeps_active_segment_and_uploads_new_logs_once(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    backend = _Backend()
+    uploader = SpoolUploader(str(tmp_path), backend.send_batch, spool=spool)
+    spool.append("/a/", {"n": 0})
+    uploader.upload_pending()
+    spool.append("/a/", {"n": 1})
+    uploader.close()
+    spool.close()
+    assert backend.batches == [("/a/", [0]), ("/a/", [1])]
+    assert list_segments(str(tmp_path)) == [spool.active_segment]
+
+
+def test_uploader_resumes_from_offset_after_failure(tmp_path):
+    spool = UsageLogSpool(str(tmp_path), segment_max_bytes=50)
+    for n in range(6):
+        spool.append("/a/", {"n": n})
+    spool.close()
+    failing_backend = _Backend(fail_after=2)
+    uploaded = SpoolUploader(str(tmp_path), failing_backend.send_batch, batch_size=1).upload_pending()
+    assert uploaded == 2
+    backend = _Backend()
+    # a new uploader (e.g. `spelltest trace-upload` after a crash) continues from the stored offset
+    assert SpoolUploader(str(tmp_path), backend.send_batch, batch_size=10).upload_pending() == 4
+    assert [n for _, logs in backend.batches for n in logs] == [2, 3, 4, 5]
+
+
+def test_uploader_skips_partially_written_line(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    spool.append("/a/", {"n": 0})
+    with open(os.path.join(str(tmp_path), spool.active_segment), "a") as file:
+        file.write('{"endpoint":"/a/","log":{"n"')
+    backend = _Backend()
+    uploader = SpoolUploader(str(tmp_path), backend.send_batch, spool=spool)
+    assert uploader.upload_pending() == 1
+    with open(os.path.join(str(tmp_path), spool.active_segment), "a") as file:
+        file.write(':1}}\n')
+    assert uploader.upload_pending() == 1
+    assert backend.batches == [("/a/", [0]), ("/a/", [1])]
+    spool.close()
+
+
+def test_spools_of_processes_sharing_directory_keep_their_segments(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    other_spool = UsageLogSpool(str(tmp_path))   # e.g. another run started in the same directory
+    spool.append("/a/", {"n": 0})
+    other_spool.append("/a/", {"n": 1})
+    backend = _Backend()
+    uploader = SpoolUploader(str(tmp_path), backend.send_batch, spool=spool)
+    assert uploader.upload_pending() == 2
+    # neither active segment is deleted, the writer of the other one is still running
+    assert list_segments(str(tmp_path)) == sorted([spool.active_segment, other_spool.active_segment])
+    other_spool.append("/a/", {"n": 2})
+    other_spool.close()
+    assert uploader.upload_pending() == 1
+    assert list_segments(str(tmp_path)) == [spool.active_segment]
+    assert sorted(n for _, logs in backend.batches for n in logs) == [0, 1, 2]
+    spool.close()
+
+
+def test_uploader_waits_for_upload_of_another_process(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    spool.append("/a/", {"n": 0})
+    spool.close()
+    backend = _Backend()
+    uploader = SpoolUploader(str(tmp_path), backend.send_batch)
+    with open(os.path.join(str(tmp_path), SpoolUploader.UPLOAD_LOCK_FILE_NAME), "a+") as upload_lock_file:
+        assert try_lock(upload_lock_file)
+        assert uploader.upload_pending() == 0
+    assert uploader.upload_pending() == 1
+
+
+def test_background_upload_survives_errors(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    with open(spool.segment_path, "a") as file:
+        file.write("not json\n")
+    uploader = SpoolUploader(str(tmp_path), _Backend().send_batch, spool=spool)
+    uploader.start(interval_seconds=0.01)
+    time.sleep(0.1)
+    assert uploader._thread.is_alive()
+    uploader._stop.set()
+    spool.close()
+
+
+def test_uploader_close_is_bounded(tmp_path):
+    spool = UsageLogSpool(str(tmp_path))
+    for n in range(3):
+        spool.append("/a/", {"n": n})
+    spool.close()
+    uploader = SpoolUploader(str(tmp_path), lambda endpoint, logs: time.sleep(0.3), batch_size=1)
+    started = time.monotonic()
+    uploader.close(timeout=0.2)
+    # the batch in flight when the time ran out is sent, the rest stays in the spool
+    assert time.monotonic() - started < 0.6
+    assert uploader.uploaded == 1
+    assert list_segments(str(tmp_path))
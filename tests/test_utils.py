@@ -0,0 +1,70 @@
+import os
+from unittest.mock import Mock
+from spelltest import utils
+from spelltest.entities.synthetic_user import SyntheticUser, SyntheticUserParams
+
+
+def test_load_prompt_reads_file_again_only_when_changed(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "TEMPLATE_DIRECTORY", tmp_path)
+    prompt_file = tmp_path / "prompt.txt.jinja2"
+    prompt_file.write_text("first")
+    assert utils.load_prompt("prompt.txt.jinja2") == "first"
+
+    read_text = Mock(side_effect=AssertionError("must be served from cache"))
+    monkeypatch.setattr(type(prompt_file), "read_text", read_text)
+    assert utils.load_prompt("prompt.txt.jinja2") == "first"
+
+    monkeypatch.undo()
+    monkeypatch.setattr(utils, "TEMPLATE_DIRECTORY", tmp_path)
+    prompt_file.write_text("second")
+    os.utime(prompt_file, ns=(0, prompt_file.stat().st_mtime_ns + 10 ** 9))
+    assert utils.load_prompt("prompt.txt.jinja2") == "second"
+
+
+def test_jinja2_templates_are_compiled_once():
+    source = "Hello {{ NAME }}, test_jinja2_templates_are_compiled_once"
+    assert utils.render_jinja2_template(source, NAME="Bob") == \
+           "Hello Bob, test_jinja2_templates_are_compiled_once"
+    assert utils.compile_jinja2_template(source) is utils.compile_jinja2_template(source)
+
+
+def test_persona_prompt_rendered_once_per_user():
+    user = SyntheticUser(
+        name="name",
+        params=SyntheticUserParams(temperature=0.7, llm_name="llm", description="d", expectation="e",
+                                   user_knowledge_about_app="k"),
+        metrics=[],
+    )
+    pre_prompt = Mock(template="template")
+    pre_prompt.format_prompt.return_value.text = "rendered"
+    assert utils.render_persona_prompt(user, pre_prompt, USER_DESCRIPTION="d") == "rendered"
+    assert utils.render_persona_prompt(user, pre_prompt, USER_DESCRIPTION="d") == "rendered"
+    assert pre_prompt.format_prompt.call_count == 1
+
+
+def test_persona_prompt_rendered_again_for_other_variables():
+    user = SyntheticUser(
+        name="name",
+        params=SyntheticUserParams(temperature=0.7, llm_name="llm", description="d", expectation="e",
+                                   user_knowledge_about_app="k"),
+        metrics=[],
+    )
+    pre_prompt = Mock(template="template")
+    pre_prompt.format_prompt.side_effect = lambda **kwargs: Mock(text=f"rendered {kwargs['USER_DESCRIPTION']}")
+    assert utils.render_persona_prompt(user, pre_prompt, USER_DESCRIPTION="a") == "rendered a"
+    assert utils.render_persona_prompt(user, pre_prompt, USER_DESCRIPTION="b") == "rendered b"
+    assert utils.render_persona_prompt(user, pre_prompt, USER_DESCRIPTION="a") == "rendered a"
+    assert pre_prompt.format_prompt.call_count == 2
+
+
+def test_rolling_history_keeps_last_turns():
+    from spelltest.entities.managers import Message, MessageType
+    history = utils.RollingHistory(window=2)
+    history.extend([
+        Message(author=MessageType.SYSTEM, text="system"),
+        Message(author=MessageType.ASSISTANT, text="welcome"),
+        Message(author=MessageType.USER, text="question"),
+        Message(author=MessageType.ASSISTANT, text="answer"),
+    ])
+    assert history.text() == ">> Human:\n question\n> AI:\n answer"
+    assert utils.prep_history([Message(author=MessageType.USER, text="question")]) == ">> Human:\n question"
@@ -31,6 +31,29 @@ mock_config = {
 }
 
 
+@patch("spelltest.yaml_tests.spelltest_run_simulation")
+def test_run_from_config_with_empty_rate_limits(mock_spelltest_run_simulation):
+    config = yaml_tests.yaml.safe_load("""
+metrics: {}
+rate_limits:
+simulations:
+  test_simulation:
+    users: [user_1]
+    llm_name: ""
+    temperature: 0.7
+    size: 5
+    chat_mode: true
+    rate_limits:
+      gpt-3.5-turbo: {requests_per_minute: 60}
+users:
+  user_1: {llm_name: "", temperature: 0.7, description: "", expectation: "", user_knowledge_about_app: ""}
+""")
+    yaml_tests.run_from_config(config, prompt_text="prompt text")
+    assert mock_spelltest_run_simulation.call_args.kwargs["rate_limits"] == {
+        "gpt-3.5-turbo": {"requests_per_minute": 60}
+    }
+
+
 # @patch("builtins.open", new_callable=mock_open, read_data="prompt text")
 # @patch("spelltest.yaml_tests.spelltest_run_simulation")
 # @patch("spelltest.yaml_tests.parse_config")